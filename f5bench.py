@@ -0,0 +1,274 @@
+#!/usr/bin/env python26
+"""Benchmark the deploy scripts against f5fake.py as the trees grow
+
+Generates pools/, monitors/ and irules/ trees of each size, runs each way of
+deploying them against a fake BIG-IP with a fixed latency per call, and reports
+the SOAP calls made, bytes sent and received, wall time and peak memory of
+each stage.  Call counts are compared with bench/baseline.json and the run
+fails if any stage makes more calls than it used to.
+
+    ./f5bench.py --sizes 10,100,1000,5000
+    ./f5bench.py --save        # after a change that is meant to alter the counts
+"""
+
+import ConfigParser
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import f5fake
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench')
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+def move_members(tree):
+    """Replace the second member of every pool with a new host"""
+
+    hosts = open(os.path.join(tree, 'hosts'), 'a')
+    for pool_file in sorted(os.listdir(os.path.join(tree, 'pools'))):
+        path = os.path.join(tree, 'pools', pool_file)
+        members = open(path).read().replace('-b.example.com', '-c.example.com')
+        pool = open(path, 'w')
+        pool.write(members)
+        pool.close()
+
+        number = int(pool_file[len('svc'):-len('_pool')])
+        hosts.write('10.%d.%d.3 %s-c.example.com\n' % (number / 250, number % 250, pool_file[:-len('_pool')]))
+    hosts.close()
+
+# (mode, transaction, start from an empty f5, change to the tree first, [(stage, module)])
+MODES = [('scripts', 'no', True, None, [('monitors', 'f5monitor_deploy'), ('pools', 'f5pool_deploy'),
+                                        ('irules', 'f5irule_deploy')]),
+         ('deploy', 'no', True, None, [('all', 'f5deploy')]),
+         ('transaction', 'yes', True, None, [('all', 'f5deploy')]),
+         # Everything is already there, so this is the cost of finding nothing to do
+         ('rerun', 'no', False, None, [('all', 'f5deploy')]),
+         # and of making sure of that, without going by what changed since the last deploy
+         ('reconcile', 'no', False, None, [('full', 'f5deploy')]),
+         # One member of every pool replaced, with the outgoing ones drained first
+         ('drain', 'no', False, move_members, [('pools', 'f5pool_deploy')])]
+
+def generate(tree, size):
+    """Write a tree of size pools, monitors and vhost files, and a hosts file for the members"""
+
+    for directory in ('pools', 'monitors', os.path.join('irules', 'http')):
+        os.makedirs(os.path.join(tree, directory))
+
+    hosts = open(os.path.join(tree, 'hosts'), 'w')
+    for number in range(size):
+        name = 'svc%04d' % number
+        vhost = '%s.example.com' % name
+
+        monitor = open(os.path.join(tree, 'monitors', '%s_health' % name), 'w')
+        monitor.write('[Health]\ntype=TTYPE_HTTP\n')
+        monitor.write('send_string=GET /%s/ HTTP/1.1\\r\\nHost: %s\\r\\nConnection: Close\\r\\n\\r\\n\n' % (name, vhost))
+        monitor.write('receive_string=OK\ninterval=20\ntimeout=60\n')
+        monitor.close()
+
+        pool = open(os.path.join(tree, 'pools', '%s_pool' % name), 'w')
+        for member in ('a', 'b'):
+            hostname = '%s-%s.example.com' % (name, member)
+            pool.write('%s:8080\n' % hostname)
+            hosts.write('10.%d.%d.%d %s\n' % (number / 250, number % 250, member == 'a' and 1 or 2, hostname))
+        pool.close()
+
+        rule = open(os.path.join(tree, 'irules', 'http', '%s.conf' % vhost), 'w')
+        rule.write('"%s" {\n    pool %s_pool\n}\n' % (vhost, name))
+        rule.close()
+    hosts.close()
+
+def write_config(tree, base_config, port, transaction, wsdl_cache):
+    """Point a copy of the config at the fake, with the pacing that's only there for a real f5 turned off"""
+
+    config = ConfigParser.RawConfigParser()
+    config.read(base_config)
+    settings = [('LoadBalancer', 'hostname', '127.0.0.1:%d' % port),
+                ('LoadBalancer', 'proto', 'http'),
+                ('Resolver', 'hosts', 'hosts'),
+                ('Resolver', 'cache', ''),
+                ('Governor', 'rate', '0'),
+                ('Pool', 'pace', '0'),
+                ('Pool', 'drain', 'yes'),
+                ('Pool', 'poll_interval', '0'),
+                ('Deploy', 'transaction', transaction),
+                ('Cache', 'directory', wsdl_cache)]
+    for section, name, value in settings:
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, name, value)
+
+    config_file = open(os.path.join(tree, 'f5.cfg'), 'w')
+    config.write(config_file)
+    config_file.close()
+
+def clean(tree):
+    """Forget what earlier runs left behind, so a fresh run starts cold"""
+
+    for name in ('.irulecache', '.rulestats', '.dnscache', '.f5deployed'):
+        if os.path.exists(os.path.join(tree, name)):
+            os.remove(os.path.join(tree, name))
+
+def run_stage(tree, module, stage, stats_file):
+    """Run one deploy in its own process, returns its peak memory in KB"""
+
+    log_file = os.path.join(tree, 'bench-%s.log' % module)
+    log = open(log_file, 'w')
+    try:
+        status = subprocess.call([sys.executable, os.path.abspath(__file__), '--child', module, stage, stats_file],
+                                 cwd=tree, stdout=log, stderr=subprocess.STDOUT)
+    finally:
+        log.close()
+
+    if status != 0:
+        print open(log_file).read()[-2000:]
+        sys.exit("%s %s failed against the fake, see above" % (module, stage))
+    return json.load(open(stats_file))['maxrss']
+
+def child(module, stage, stats_file):
+    """The process run_stage starts: one deploy, then note the peak memory"""
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    deploy = __import__(module)
+    if module == 'f5deploy':
+        deploy.main([name for name, stage_module in deploy.STAGES], stage == 'full')
+    else:
+        deploy.main()
+
+    output = open(stats_file, 'w')
+    json.dump({'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, output)
+    output.close()
+
+def difference(before, after):
+    """Calls and bytes between two lots of fake counters"""
+
+    calls = 0
+    for method, count in after[0].items():
+        calls += count - before[0].get(method, 0)
+    return calls, after[1] - before[1], after[2] - before[2]
+
+def bench(sizes, base_config, latency, work):
+    """Run every mode at every size, returns {size: {mode/stage: results}}"""
+
+    bigip = f5fake.FakeBIGIP(latency=latency)
+    server = f5fake.serve(bigip)
+    port = server.server_address[1]
+    wsdl_cache = os.path.join(work, 'wsdlcache')
+    stats_file = os.path.join(work, 'stats.json')
+
+    results = {}
+    try:
+        for size in sizes:
+            tree = os.path.join(work, str(size))
+            generate(tree, size)
+            results[str(size)] = {}
+
+            for mode, transaction, fresh, change, stages in MODES:
+                if fresh:
+                    bigip.reset()
+                    clean(tree)
+                if change is not None:
+                    change(tree)
+                write_config(tree, base_config, port, transaction, wsdl_cache)
+
+                for stage, module in stages:
+                    before = bigip.counters()
+                    started = time.time()
+                    maxrss = run_stage(tree, module, stage, stats_file)
+                    wall = time.time() - started
+                    calls, bytes_in, bytes_out = difference(before, bigip.counters())
+
+                    results[str(size)]['%s/%s' % (mode, stage)] = {
+                        'calls': calls, 'bytes_sent': bytes_in, 'bytes_received': bytes_out,
+                        'wall': round(wall, 3), 'peak_kb': maxrss}
+                    print "%6d %-22s %8d calls %10d bytes %8.2fs %8.1fMB" % (
+                        size, '%s/%s' % (mode, stage), calls, bytes_in + bytes_out, wall, maxrss / 1024.0)
+    finally:
+        server.shutdown()
+
+    return results
+
+def compare(results, baseline):
+    """Returns a message for every stage making more calls than its baseline"""
+
+    regressions = []
+    for size in sorted(results.keys(), key=int):
+        for run in sorted(results[size].keys()):
+            if size not in baseline or run not in baseline[size]:
+                print "No baseline for %s at size %s" % (run, size)
+                continue
+            calls = results[size][run]['calls']
+            expected = baseline[size][run]['calls']
+            if calls > expected:
+                regressions.append("%s at size %s made %d calls, baseline is %d" % (run, size, calls, expected))
+            elif calls < expected:
+                print "%s at size %s made %d calls, down from %d, --save to keep it" % (run, size, calls, expected)
+    return regressions
+
+def main():
+    """Benchmark the deploy scripts"""
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='10,100', help='comma separated numbers of pools, monitors and vhosts')
+    parser.add_option('--latency', type='float', default=0.005, help='seconds the fake takes over every call')
+    parser.add_option('--config', default='f5.cfg', help='config to base the runs on')
+    parser.add_option('--output', help='write the results to this JSON file as well')
+    parser.add_option('--save', action='store_true', default=False, help='store the call counts as the baseline')
+    parser.add_option('--keep', action='store_true', default=False, help='keep the generated trees')
+    parser.add_option('--child', action='store_true', default=False, help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        child(*args)
+        return
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    work = tempfile.mkdtemp(prefix='f5bench')
+    try:
+        results = bench(sizes, os.path.abspath(options.config), options.latency, work)
+    finally:
+        if options.keep:
+            print "Generated trees left in %s" % work
+        else:
+            shutil.rmtree(work, True)
+
+    if options.output:
+        output = open(options.output, 'w')
+        json.dump(results, output, indent=1, sort_keys=True, separators=(',', ': '))
+        output.close()
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        baseline = json.load(open(BASELINE))
+
+    if options.save:
+        for size in results:
+            baseline.setdefault(size, {})
+            for run, result in results[size].items():
+                baseline[size][run] = {'calls': result['calls']}
+        if not os.path.isdir(BENCH_DIR):
+            os.makedirs(BENCH_DIR)
+        output = open(BASELINE, 'w')
+        json.dump(baseline, output, indent=1, sort_keys=True, separators=(',', ': '))
+        output.write('\n')
+        output.close()
+        print "Baseline saved to %s" % BASELINE
+        return
+
+    regressions = compare(results, baseline)
+    if regressions != []:
+        print " "
+        for regression in regressions:
+            print regression
+        sys.exit("More iControl calls than the baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python26
+"""Deploy monitors, pools and irules in one go
+
+    ./f5deploy.py [--full] [monitors] [pools] [irules]
+    ./f5deploy.py plan [monitors] [pools] [irules]
+    ./f5deploy.py apply
+
+A deploy only checks the files that have changed since the last successful deploy
+to the f5, and whatever depends on them, unless --full is given.
+plan takes one snapshot of the f5, works out everything a deploy would do from it
+without touching the f5 again, prints it and saves it.  apply makes those changes,
+as long as neither the f5 nor the files have changed in the meantime.
+"""
+
+import ConfigParser
+import hashlib
+import os
+import sys
+import f5utility
+import f5monitor_deploy
+import f5pool_deploy
+import f5irule_deploy
+
+# In dependency order: a pool needs its monitor, and the rules pick the pools
+STAGES = [('monitors', f5monitor_deploy),
+          ('pools', f5pool_deploy),
+          ('irules', f5irule_deploy)]
+
+def commit_stages(f5, checked):
+    """Commit the queues of the checked stages, in one transaction if they're enabled,
+    returns the names of the stages that changed anything"""
+
+    def commit_all():
+        return [name for name, stage, queue in checked if stage.commit(f5, queue)]
+
+    if [queue for done, module, queue in checked if queue != []] == []:
+        return commit_all()
+    return f5.transaction.apply(commit_all)
+
+def scope(record, digests, full):
+    """The names of the objects each stage has to check, {stage: names},
+    or None for a stage where everything has to be checked"""
+
+    scopes = {}
+    for name in digests:
+        files = None
+        if not full:
+            files = record.changed(name, digests[name])
+        if files is None:
+            scopes[name] = None
+        else:
+            stage = dict(STAGES)[name]
+            # Files that have gone take nothing with them, nothing is ever removed from the f5
+            scopes[name] = set([stage.owner(infile) for infile in files]) & set(stage.names())
+    return scopes
+
+def main(stages, full=False):
+    """Run the named stages over one connection and sync once at the end,
+    checking only what has changed since the last deploy unless full is set"""
+
+    record = f5utility.DeployRecord()
+    digests = tree_digests(stages)
+    scopes = scope(record, digests, full)
+
+    if [name for name in scopes if scopes[name] != set()] == []:
+        print "Nothing has changed since the last deploy, run %s --full to check everything anyway." % sys.argv[0]
+        return
+
+    #Create Connection to the f5
+    f5 = f5utility.f5Connection()
+
+    changed = []
+    checked = []
+    # Objects of later stages that have to be checked again because of earlier changes
+    rechecked = set()
+    for name, stage in STAGES:
+        if name not in stages:
+            continue
+
+        # Each stage is checked against what the stages before it did.  In a transaction
+        # that only means committing first when the f5 itself has to see new objects, as
+        # it does the pools a rule names when validating it.  Anything else can wait and
+        # all go in together.
+        if checked != [] and (not f5.transaction.enabled or
+                              [done for done, module, queue in checked if module.creates(queue)] != []):
+            changed.extend(commit_stages(f5, checked))
+            checked = []
+
+        print " "
+        print "=============================="
+        print " Deploying %s" % name
+        print "=============================="
+
+        only = scopes[name]
+        if only is not None:
+            only = only | (rechecked & set(stage.names()))
+            if only == set():
+                print " "
+                print "No %s have changed since the last deploy" % name
+                checked.append((name, stage, []))
+                continue
+            print " "
+            print "Checking %d %s changed since the last deploy" % (len(only), name)
+
+        queue = stage.check(f5, only)
+        stage.assume(f5, queue)
+        rechecked.update(stage.dependants(queue))
+        checked.append((name, stage, queue))
+
+    changed.extend(commit_stages(f5, checked))
+
+    print " "
+    if changed == []:
+        print "No Changes made, nothing to sync."
+    else:
+        print "------------------------------"
+        print " Syncing Changes to %s" % ', '.join(changed)
+        print "------------------------------"
+        print " "
+
+        # sync the F5s
+        f5.config_sync.sync_all()
+
+    # Only now is everything the files say on the f5
+    record.save(digests)
+
+    print " "
+    print "done."
+
+def plan_file():
+    """Where plans are saved, from [Deploy]"""
+
+    config = ConfigParser.ConfigParser()
+    config.read('f5.cfg')
+    return f5utility.config_option(config, 'Deploy', 'plan', '.f5plan')
+
+def tree_digests(stages):
+    """sha1 of every file the named stages are built from, {stage: {file: digest}}"""
+
+    digests = {}
+    for name, stage in STAGES:
+        if name in stages:
+            digests[name] = {}
+            for infile in stage.sources():
+                digests[name][infile] = hashlib.sha1(open(infile, 'rb').read()).hexdigest()
+    return digests
+
+def source_digests(digests):
+    """The digests from tree_digests in one {file: digest}, as plans keep them"""
+
+    sources = {}
+    for files in digests.values():
+        sources.update(files)
+    return sources
+
+def snapshot(f5, stages):
+    """One bulk snapshot of the objects the named stages deploy, and of the monitors
+    the pools need"""
+
+    names = {}
+    for name, stage in STAGES:
+        names[name] = []
+        if name in stages:
+            names[name] = stage.names()
+
+    # New pools are only made if their monitor is there, whether or not we deploy monitors too
+    for pool_name in names['pools']:
+        monitor_name = f5utility.swap_suffix('_health', pool_name)
+        if monitor_name not in names['monitors']:
+            names['monitors'].append(monitor_name)
+
+    with f5.tracer.span('snapshot'):
+        return f5.take_snapshot(names['pools'], names['monitors'], names['irules'])
+
+def work_out(f5, stages):
+    """Check the named stages against the restored snapshot alone, each one assuming the
+    ones before it went through.  Returns [(name, stage, queue, [change lines])]"""
+
+    planned = []
+    for name, stage in STAGES:
+        if name not in stages:
+            continue
+
+        print " "
+        print "=============================="
+        print " Planning %s" % name
+        print "=============================="
+
+        queue = stage.check(f5)
+        changes = []
+        for item in queue:
+            changes.extend(stage.describe(f5, item))
+        stage.assume(f5, queue)
+        planned.append((name, stage, queue, changes))
+    return planned
+
+def plan(stages):
+    """Work out and save what deploying the named stages would change"""
+
+    f5 = f5utility.f5Connection()
+    taken = snapshot(f5, stages)
+    f5.restore(taken)
+    planned = work_out(f5, stages)
+
+    print " "
+    print "=============================="
+    print " Plan"
+    print "=============================="
+    print " "
+    count = 0
+    for name, stage, queue, changes in planned:
+        for line in changes:
+            print line
+        count += len(queue)
+    if count == 0:
+        print "Nothing to change."
+        return
+
+    saved = {'stages': stages,
+             'snapshot': taken,
+             'digest': f5utility.snapshot_digest(taken),
+             'sources': source_digests(tree_digests(stages)),
+             'changes': dict([(name, changes) for name, stage, queue, changes in planned])}
+    output = open(plan_file(), 'w')
+    f5utility.json.dump(saved, output, indent=1, sort_keys=True)
+    output.close()
+
+    print " "
+    print "%d objects to change, plan saved to %s.  Run %s apply to make the changes." % (
+        count, plan_file(), sys.argv[0])
+
+def apply():
+    """Make the changes in the saved plan, if it still holds"""
+
+    if not os.path.exists(plan_file()):
+        sys.exit("No plan in %s, run %s plan first" % (plan_file(), sys.argv[0]))
+    saved = f5utility.json.load(open(plan_file()))
+    stages = [str(name) for name in saved['stages']]
+
+    digests = tree_digests(stages)
+    if source_digests(digests) != saved['sources']:
+        sys.exit("Files have changed since the plan was made, run %s plan again" % sys.argv[0])
+
+    # The only questions asked of the f5 before committing: is it as it was?
+    f5 = f5utility.f5Connection()
+    taken = snapshot(f5, stages)
+    if f5utility.snapshot_digest(taken) != saved['digest']:
+        sys.exit("The f5 has changed since the plan was made, run %s plan again" % sys.argv[0])
+
+    f5.restore(taken)
+    planned = work_out(f5, stages)
+    for name, stage, queue, changes in planned:
+        if changes != saved['changes'].get(name, []):
+            sys.exit("The %s no longer come out as planned, run %s plan again" % (name, sys.argv[0]))
+
+    print " "
+    print "=============================="
+    print " Applying the plan"
+    print "=============================="
+
+    changed = commit_stages(f5, [(name, stage, queue) for name, stage, queue, changes in planned])
+    os.remove(plan_file())
+
+    print " "
+    if changed != []:
+        print "------------------------------"
+        print " Syncing Changes to %s" % ', '.join(changed)
+        print "------------------------------"
+        print " "
+        f5.config_sync.sync_all()
+
+    # The plan checked everything, so the files it was made from are all on the f5 now
+    f5utility.DeployRecord().save(digests)
+
+    print " "
+    print "done."
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    mode = 'deploy'
+    if args != [] and args[0] in ('plan', 'apply'):
+        mode = args.pop(0)
+
+    full = '--full' in args
+    stages = [name for name in args if name != '--full']
+    unknown = [name for name in stages if name not in [stage[0] for stage in STAGES]]
+    if unknown != [] or (mode == 'apply' and stages != []) or (full and mode != 'deploy'):
+        sys.exit("Usage: %s [--full] [monitors] [pools] [irules]\n       %s plan [monitors] [pools] [irules]\n"
+                 "       %s apply" % (sys.argv[0], sys.argv[0], sys.argv[0]))
+    if stages == []:
+        stages = [stage[0] for stage in STAGES]
+
+    if mode == 'apply':
+        apply()
+    elif mode == 'plan':
+        f5utility.check_cvs(stages)
+        plan(stages)
+    else:
+        f5utility.check_cvs(stages)
+        main(stages, full)
@@ -0,0 +1,978 @@
+#!/usr/bin/env python26
+"""A stand-in for the iControl interface of a BIG-IP, for working offline
+
+Serves wsdls for the interfaces these scripts use, generated from the
+signatures below, and answers their SOAP calls from an in-memory model of
+pools, monitors, rules and data groups.  Calls can be slowed down, and made
+to fail now and then, to see how the scripts cope and how long they take.
+
+Point f5.cfg at it with hostname=127.0.0.1:8443 and proto=http in the
+[LoadBalancer] section, then run e.g.
+
+    ./f5fake.py --port 8443 --latency 0.05 --fault-rate 0.01
+"""
+
+import BaseHTTPServer
+import SocketServer
+import copy
+import optparse
+import random
+import re
+import sys
+import threading
+import time
+from xml.dom import minidom
+from xml.sax.saxutils import escape
+import f5lint
+
+SOAP_ENV = 'http://schemas.xmlsoap.org/soap/envelope/'
+SOAP_ENC = 'http://schemas.xmlsoap.org/soap/encoding/'
+XSI = 'http://www.w3.org/2001/XMLSchema-instance'
+ICONTROL_URI = '/iControl/iControlPortal.cgi'
+
+# Type definitions, as in the real wsdls.  A struct is a list of (field, type),
+# an enum a list of values, and a sequence the type of its items.
+STRUCTS = {
+    'Common.IPPortDefinition': [('address', 'xsd:string'), ('port', 'xsd:long')],
+    'Common.ULong64': [('high', 'xsd:long'), ('low', 'xsd:long')],
+    'Common.TimeStamp': [('year', 'xsd:long'), ('month', 'xsd:long'), ('day', 'xsd:long'),
+                         ('hour', 'xsd:long'), ('minute', 'xsd:long'), ('second', 'xsd:long')],
+    'Common.Statistic': [('type', 'Common.StatisticType'), ('value', 'Common.ULong64'), ('time_stamp', 'xsd:long')],
+    'Common.ObjectStatus': [('availability_status', 'Common.AvailabilityStatus'),
+                            ('enabled_status', 'Common.EnabledStatus'), ('status_description', 'xsd:string')],
+    'LocalLB.MonitorRule': [('type', 'LocalLB.MonitorRuleType'), ('quorum', 'xsd:long'),
+                            ('monitor_templates', 'Common.StringSequence')],
+    'LocalLB.MonitorIPPort': [('address_type', 'LocalLB.AddressType'), ('ipport', 'Common.IPPortDefinition')],
+    'LocalLB.Pool.MonitorAssociation': [('pool_name', 'xsd:string'), ('monitor_rule', 'LocalLB.MonitorRule')],
+    'LocalLB.PoolMember.MemberSessionState': [('member', 'Common.IPPortDefinition'),
+                                              ('session_state', 'Common.EnabledState')],
+    'LocalLB.PoolMember.MemberStatisticEntry': [('member', 'Common.IPPortDefinition'),
+                                                ('statistics', 'Common.StatisticSequence')],
+    'LocalLB.PoolMember.MemberStatistics': [('statistics', 'LocalLB.PoolMember.MemberStatisticEntrySequence'),
+                                            ('time_stamp', 'Common.TimeStamp')],
+    'LocalLB.Monitor.MonitorTemplate': [('template_name', 'xsd:string'), ('template_type', 'LocalLB.TemplateType')],
+    'LocalLB.Monitor.CommonAttributes': [('parent_template', 'xsd:string'), ('interval', 'xsd:long'),
+                                         ('timeout', 'xsd:long'), ('dest_ipport', 'LocalLB.MonitorIPPort'),
+                                         ('is_read_only', 'xsd:boolean'), ('is_directly_usable', 'xsd:boolean')],
+    'LocalLB.Monitor.StringValue': [('type', 'LocalLB.Monitor.StrPropertyType'), ('value', 'xsd:string')],
+    'LocalLB.Monitor.IntegerValue': [('type', 'LocalLB.Monitor.IntPropertyType'), ('value', 'xsd:long')],
+    'LocalLB.Rule.RuleDefinition': [('rule_name', 'xsd:string'), ('rule_definition', 'xsd:string')],
+    'LocalLB.Rule.RuleStatisticEntry': [('rule_name', 'xsd:string'), ('event_name', 'xsd:string'),
+                                        ('priority', 'xsd:long'), ('statistics', 'Common.StatisticSequence')],
+    'LocalLB.Rule.RuleStatistics': [('statistics', 'LocalLB.Rule.RuleStatisticEntrySequence'),
+                                    ('time_stamp', 'Common.TimeStamp')],
+    'LocalLB.Class.StringClass': [('name', 'xsd:string'), ('members', 'Common.StringSequence')],
+}
+
+ENUMS = {
+    'Common.EnabledState': ['STATE_DISABLED', 'STATE_ENABLED'],
+    'Common.AvailabilityStatus': ['AVAILABILITY_STATUS_NONE', 'AVAILABILITY_STATUS_GREEN',
+                                  'AVAILABILITY_STATUS_YELLOW', 'AVAILABILITY_STATUS_RED',
+                                  'AVAILABILITY_STATUS_BLUE', 'AVAILABILITY_STATUS_GRAY'],
+    'Common.EnabledStatus': ['ENABLED_STATUS_NONE', 'ENABLED_STATUS_ENABLED', 'ENABLED_STATUS_DISABLED',
+                             'ENABLED_STATUS_DISABLED_BY_PARENT'],
+    'Common.StatisticType': ['STATISTIC_SERVER_SIDE_CURRENT_CONNECTIONS', 'STATISTIC_SERVER_SIDE_TOTAL_CONNECTIONS',
+                             'STATISTIC_RULE_ABORTS', 'STATISTIC_RULE_AVERAGE_CYCLES', 'STATISTIC_RULE_FAILURES',
+                             'STATISTIC_RULE_MAXIMUM_CYCLES', 'STATISTIC_RULE_MINIMUM_CYCLES',
+                             'STATISTIC_RULE_TOTAL_EXECUTIONS'],
+    'LocalLB.LBMethod': ['LB_METHOD_ROUND_ROBIN', 'LB_METHOD_RATIO_MEMBER', 'LB_METHOD_LEAST_CONNECTION_MEMBER',
+                         'LB_METHOD_OBSERVED_MEMBER', 'LB_METHOD_PREDICTIVE_MEMBER', 'LB_METHOD_RATIO_NODE_ADDRESS',
+                         'LB_METHOD_LEAST_CONNECTION_NODE_ADDRESS', 'LB_METHOD_FASTEST_NODE_ADDRESS',
+                         'LB_METHOD_OBSERVED_NODE_ADDRESS', 'LB_METHOD_PREDICTIVE_NODE_ADDRESS',
+                         'LB_METHOD_DYNAMIC_RATIO', 'LB_METHOD_FASTEST_APP_RESPONSE',
+                         'LB_METHOD_LEAST_SESSIONS', 'LB_METHOD_DYNAMIC_RATIO_MEMBER', 'LB_METHOD_L3_ADDR',
+                         'LB_METHOD_UNKNOWN', 'LB_METHOD_WEIGHTED_LEAST_CONNECTION_MEMBER',
+                         'LB_METHOD_WEIGHTED_LEAST_CONNECTION_NODE_ADDRESS', 'LB_METHOD_RATIO_SESSION',
+                         'LB_METHOD_RATIO_LEAST_CONNECTION_MEMBER', 'LB_METHOD_RATIO_LEAST_CONNECTION_NODE_ADDRESS'],
+    'LocalLB.MonitorRuleType': ['MONITOR_RULE_TYPE_UNDEFINED', 'MONITOR_RULE_TYPE_NONE', 'MONITOR_RULE_TYPE_SINGLE',
+                                'MONITOR_RULE_TYPE_AND_LIST', 'MONITOR_RULE_TYPE_M_OF_N'],
+    'LocalLB.AddressType': ['ATYPE_UNSET', 'ATYPE_STAR_ADDRESS_STAR_PORT', 'ATYPE_STAR_ADDRESS_EXPLICIT_PORT',
+                            'ATYPE_EXPLICIT_ADDRESS_EXPLICIT_PORT', 'ATYPE_STAR_ADDRESS', 'ATYPE_EXPLICIT_ADDRESS'],
+    'LocalLB.TemplateType': ['TTYPE_UNSET', 'TTYPE_ICMP', 'TTYPE_TCP', 'TTYPE_TCP_ECHO', 'TTYPE_EXTERNAL',
+                             'TTYPE_HTTP', 'TTYPE_HTTPS', 'TTYPE_NNTP', 'TTYPE_FTP', 'TTYPE_POP3', 'TTYPE_SMTP',
+                             'TTYPE_MSSQL', 'TTYPE_GATEWAY', 'TTYPE_IMAP', 'TTYPE_RADIUS', 'TTYPE_LDAP',
+                             'TTYPE_WMI', 'TTYPE_SNMP_DCA', 'TTYPE_SNMP_DCA_BASE', 'TTYPE_REAL_SERVER',
+                             'TTYPE_UDP', 'TTYPE_NONE', 'TTYPE_ORACLE', 'TTYPE_SOAP', 'TTYPE_GATEWAY_ICMP',
+                             'TTYPE_SIP', 'TTYPE_TCP_HALF_OPEN', 'TTYPE_SCRIPTED', 'TTYPE_WAP', 'TTYPE_RPC',
+                             'TTYPE_SMB', 'TTYPE_SASP', 'TTYPE_MODULE_SCORE', 'TTYPE_FIREPASS',
+                             'TTYPE_INBAND', 'TTYPE_RADIUS_ACCOUNTING', 'TTYPE_DIAMETER', 'TTYPE_VIRTUAL_LOCATION',
+                             'TTYPE_MYSQL', 'TTYPE_POSTGRESQL'],
+    'LocalLB.Monitor.StrPropertyType': ['STYPE_UNSET', 'STYPE_SEND', 'STYPE_GET', 'STYPE_RECEIVE',
+                                        'STYPE_USERNAME', 'STYPE_PASSWORD', 'STYPE_RUN', 'STYPE_NEWSGROUP',
+                                        'STYPE_DATABASE', 'STYPE_DOMAIN', 'STYPE_ARGUMENTS', 'STYPE_FOLDER',
+                                        'STYPE_BASE', 'STYPE_FILTER', 'STYPE_SECRET', 'STYPE_METHOD',
+                                        'STYPE_URL', 'STYPE_COMMAND', 'STYPE_METRICS', 'STYPE_POST',
+                                        'STYPE_USERAGENT', 'STYPE_AGENT_TYPE', 'STYPE_CPU_COEFFICIENT',
+                                        'STYPE_CPU_THRESHOLD', 'STYPE_MEMORY_COEFFICIENT',
+                                        'STYPE_MEMORY_THRESHOLD', 'STYPE_DISK_COEFFICIENT',
+                                        'STYPE_DISK_THRESHOLD', 'STYPE_SNMP_VERSION', 'STYPE_COMMUNITY',
+                                        'STYPE_SEND_PACKETS', 'STYPE_TIMEOUT_PACKETS', 'STYPE_RECEIVE_DRAIN',
+                                        'STYPE_RECEIVE_ROW', 'STYPE_RECEIVE_COLUMN', 'STYPE_DEBUG',
+                                        'STYPE_SECURITY', 'STYPE_MODE', 'STYPE_CIPHER_LIST', 'STYPE_NAMESPACE',
+                                        'STYPE_PARAMETER_NAME', 'STYPE_PARAMETER_VALUE', 'STYPE_PARAMETER_TYPE',
+                                        'STYPE_RETURN_TYPE', 'STYPE_RETURN_VALUE', 'STYPE_SOAP_FAULT',
+                                        'STYPE_SSL_OPTIONS', 'STYPE_CLIENT_CERTIFICATE', 'STYPE_PROTOCOL',
+                                        'STYPE_MANDATORY_ATTRS', 'STYPE_FILENAME', 'STYPE_ACCOUNTING_NODE',
+                                        'STYPE_ACCOUNTING_PORT', 'STYPE_SERVER_ID', 'STYPE_CALL_ID',
+                                        'STYPE_SESSION_ID', 'STYPE_FRAMED_ADDRESS', 'STYPE_PROGRAM',
+                                        'STYPE_VERSION', 'STYPE_SERVER', 'STYPE_SERVICE', 'STYPE_GW_MONITOR_ADDRESS',
+                                        'STYPE_GW_MONITOR_SERVICE', 'STYPE_GW_MONITOR_INTERVAL',
+                                        'STYPE_GW_MONITOR_PROTOCOL', 'STYPE_DB_COUNT', 'STYPE_REQUEST',
+                                        'STYPE_HEADERS', 'STYPE_FILTER_NEG', 'STYPE_SERVER_IP',
+                                        'STYPE_SNMP_PORT', 'STYPE_POOL_NAME', 'STYPE_NAS_IP',
+                                        'STYPE_CLIENT_KEY', 'STYPE_MAX_LOAD_AVERAGE', 'STYPE_CONCURRENCY_LIMIT',
+                                        'STYPE_FAILURES', 'STYPE_FAILURE_INTERVAL', 'STYPE_RESPONSE_TIME',
+                                        'STYPE_RETRY_TIME', 'STYPE_DIAMETER_ACCT_APPLICATION_ID',
+                                        'STYPE_DIAMETER_AUTH_APPLICATION_ID', 'STYPE_DIAMETER_ORIGIN_HOST',
+                                        'STYPE_DIAMETER_ORIGIN_REALM', 'STYPE_DIAMETER_HOST_IP_ADDRESS',
+                                        'STYPE_DIAMETER_VENDOR_ID', 'STYPE_DIAMETER_PRODUCT_NAME',
+                                        'STYPE_DIAMETER_VENDOR_SPECIFIC_VENDOR_ID',
+                                        'STYPE_DIAMETER_VENDOR_SPECIFIC_ACCT_APPLICATION_ID',
+                                        'STYPE_DIAMETER_VENDOR_SPECIFIC_AUTH_APPLICATION_ID',
+                                        'STYPE_RUN_V2', 'STYPE_CLIENT_CERTIFICATE_V2', 'STYPE_CLIENT_KEY_V2'],
+    'LocalLB.Monitor.IntPropertyType': ['ITYPE_UNSET', 'ITYPE_INTERVAL', 'ITYPE_TIMEOUT', 'ITYPE_PROBE_INTERVAL',
+                                        'ITYPE_PROBE_TIMEOUT', 'ITYPE_PROBE_NUM_PROBES',
+                                        'ITYPE_PROBE_NUM_SUCCESSES', 'ITYPE_TIME_UNTIL_UP', 'ITYPE_UP_INTERVAL'],
+    'System.ConfigSync.SyncMode': ['CONFIGSYNC_BASIC', 'CONFIGSYNC_RUNNING', 'CONFIGSYNC_ALL'],
+}
+
+SEQUENCES = {
+    'Common.StringSequence': 'xsd:string',
+    'Common.StringSequenceSequence': 'Common.StringSequence',
+    'Common.IPPortDefinitionSequence': 'Common.IPPortDefinition',
+    'Common.IPPortDefinitionSequenceSequence': 'Common.IPPortDefinitionSequence',
+    'Common.StatisticSequence': 'Common.Statistic',
+    'Common.ObjectStatusSequence': 'Common.ObjectStatus',
+    'Common.EnabledStateSequence': 'Common.EnabledState',
+    'LocalLB.LBMethodSequence': 'LocalLB.LBMethod',
+    'LocalLB.Pool.MonitorAssociationSequence': 'LocalLB.Pool.MonitorAssociation',
+    'LocalLB.PoolMember.MemberSessionStateSequence': 'LocalLB.PoolMember.MemberSessionState',
+    'LocalLB.PoolMember.MemberSessionStateSequenceSequence': 'LocalLB.PoolMember.MemberSessionStateSequence',
+    'LocalLB.PoolMember.MemberStatisticEntrySequence': 'LocalLB.PoolMember.MemberStatisticEntry',
+    'LocalLB.PoolMember.MemberStatisticsSequence': 'LocalLB.PoolMember.MemberStatistics',
+    'LocalLB.Monitor.MonitorTemplateSequence': 'LocalLB.Monitor.MonitorTemplate',
+    'LocalLB.Monitor.CommonAttributesSequence': 'LocalLB.Monitor.CommonAttributes',
+    'LocalLB.Monitor.StringValueSequence': 'LocalLB.Monitor.StringValue',
+    'LocalLB.Monitor.IntegerValueSequence': 'LocalLB.Monitor.IntegerValue',
+    'LocalLB.Monitor.StrPropertyTypeSequence': 'LocalLB.Monitor.StrPropertyType',
+    'LocalLB.Monitor.IntPropertyTypeSequence': 'LocalLB.Monitor.IntPropertyType',
+    'LocalLB.Rule.RuleDefinitionSequence': 'LocalLB.Rule.RuleDefinition',
+    'LocalLB.Rule.RuleStatisticEntrySequence': 'LocalLB.Rule.RuleStatisticEntry',
+    'LocalLB.Class.StringClassSequence': 'LocalLB.Class.StringClass',
+}
+
+# The methods of each interface that these scripts call: name -> ([(parameter, type)], return type)
+INTERFACES = {
+    'LocalLB.Pool': {
+        'get_version': ([], 'xsd:string'),
+        'get_list': ([], 'Common.StringSequence'),
+        'create': ([('pool_names', 'Common.StringSequence'), ('lb_methods', 'LocalLB.LBMethodSequence'),
+                    ('members', 'Common.IPPortDefinitionSequenceSequence')], None),
+        'delete_pool': ([('pool_names', 'Common.StringSequence')], None),
+        'get_lb_method': ([('pool_names', 'Common.StringSequence')], 'LocalLB.LBMethodSequence'),
+        'set_lb_method': ([('pool_names', 'Common.StringSequence'), ('lb_methods', 'LocalLB.LBMethodSequence')], None),
+        'get_member': ([('pool_names', 'Common.StringSequence')], 'Common.IPPortDefinitionSequenceSequence'),
+        'add_member': ([('pool_names', 'Common.StringSequence'),
+                        ('members', 'Common.IPPortDefinitionSequenceSequence')], None),
+        'remove_member': ([('pool_names', 'Common.StringSequence'),
+                           ('members', 'Common.IPPortDefinitionSequenceSequence')], None),
+        'get_monitor_association': ([('pool_names', 'Common.StringSequence')],
+                                    'LocalLB.Pool.MonitorAssociationSequence'),
+        'set_monitor_association': ([('monitor_associations', 'LocalLB.Pool.MonitorAssociationSequence')], None),
+        'remove_monitor_association': ([('pool_names', 'Common.StringSequence')], None),
+        'get_object_status': ([('pool_names', 'Common.StringSequence')], 'Common.ObjectStatusSequence'),
+    },
+    'LocalLB.PoolMember': {
+        'get_version': ([], 'xsd:string'),
+        'set_session_enabled_state': ([('pool_names', 'Common.StringSequence'),
+                                       ('session_states', 'LocalLB.PoolMember.MemberSessionStateSequenceSequence')],
+                                      None),
+        'get_statistics': ([('pool_names', 'Common.StringSequence'),
+                            ('members', 'Common.IPPortDefinitionSequenceSequence')],
+                           'LocalLB.PoolMember.MemberStatisticsSequence'),
+    },
+    'LocalLB.Monitor': {
+        'get_version': ([], 'xsd:string'),
+        'get_template_list': ([], 'LocalLB.Monitor.MonitorTemplateSequence'),
+        'create_template': ([('templates', 'LocalLB.Monitor.MonitorTemplateSequence'),
+                             ('template_attributes', 'LocalLB.Monitor.CommonAttributesSequence')], None),
+        'delete_template': ([('template_names', 'Common.StringSequence')], None),
+        'get_template_string_property': ([('template_names', 'Common.StringSequence'),
+                                          ('property_types', 'LocalLB.Monitor.StrPropertyTypeSequence')],
+                                         'LocalLB.Monitor.StringValueSequence'),
+        'set_template_string_property': ([('template_names', 'Common.StringSequence'),
+                                          ('values', 'LocalLB.Monitor.StringValueSequence')], None),
+        'get_template_integer_property': ([('template_names', 'Common.StringSequence'),
+                                           ('property_types', 'LocalLB.Monitor.IntPropertyTypeSequence')],
+                                          'LocalLB.Monitor.IntegerValueSequence'),
+    },
+    'LocalLB.Rule': {
+        'get_version': ([], 'xsd:string'),
+        'get_list': ([], 'Common.StringSequence'),
+        'query_rule': ([('rule_names', 'Common.StringSequence')], 'LocalLB.Rule.RuleDefinitionSequence'),
+        'create': ([('rules', 'LocalLB.Rule.RuleDefinitionSequence')], None),
+        'modify_rule': ([('rules', 'LocalLB.Rule.RuleDefinitionSequence')], None),
+        'delete_rule': ([('rule_names', 'Common.StringSequence')], None),
+        'get_statistics': ([('rule_names', 'Common.StringSequence')], 'LocalLB.Rule.RuleStatistics'),
+    },
+    'LocalLB.Class': {
+        'get_version': ([], 'xsd:string'),
+        'get_string_class_list': ([], 'Common.StringSequence'),
+        'create_string_class': ([('classes', 'LocalLB.Class.StringClassSequence')], None),
+        'modify_string_class': ([('classes', 'LocalLB.Class.StringClassSequence')], None),
+        'set_string_class_member_data_value': ([('class_members', 'LocalLB.Class.StringClassSequence'),
+                                                ('values', 'Common.StringSequenceSequence')], None),
+    },
+    'System.ConfigSync': {
+        'get_version': ([], 'xsd:string'),
+        'synchronize_configuration': ([('sync_flag', 'System.ConfigSync.SyncMode')], None),
+    },
+    'System.Session': {
+        'get_version': ([], 'xsd:string'),
+        'get_session_identifier': ([], 'xsd:long'),
+        'start_transaction': ([], None),
+        'submit_transaction': ([], None),
+        'rollback_transaction': ([], None),
+    },
+}
+
+# Just enough of the SOAP encoding schema for the array types above, the real one lives on the internet
+SOAP_ENCODING_SCHEMA = '''<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="%(enc)s" targetNamespace="%(enc)s">
+ <xs:attribute name="root"><xs:simpleType><xs:restriction base="xs:boolean"><xs:pattern value="0|1"/></xs:restriction></xs:simpleType></xs:attribute>
+ <xs:attributeGroup name="commonAttributes">
+  <xs:attribute name="id" type="xs:ID"/>
+  <xs:attribute name="href" type="xs:anyURI"/>
+  <xs:anyAttribute namespace="##other" processContents="lax"/>
+ </xs:attributeGroup>
+ <xs:attribute name="arrayType" type="xs:string"/>
+ <xs:attribute name="offset" type="xs:string"/>
+ <xs:attributeGroup name="arrayAttributes">
+  <xs:attribute ref="tns:arrayType"/>
+  <xs:attribute ref="tns:offset"/>
+ </xs:attributeGroup>
+ <xs:group name="Array"><xs:sequence><xs:any namespace="##any" minOccurs="0" maxOccurs="unbounded" processContents="lax"/></xs:sequence></xs:group>
+ <xs:element name="Array" type="tns:Array"/>
+ <xs:complexType name="Array">
+  <xs:group ref="tns:Array" minOccurs="0"/>
+  <xs:attributeGroup ref="tns:arrayAttributes"/>
+  <xs:attributeGroup ref="tns:commonAttributes"/>
+ </xs:complexType>
+</xs:schema>
+''' % {'enc': SOAP_ENC}
+
+
+def short_name(name):
+    """The part of a /partition/name path after the partition"""
+
+    return name.rsplit('/', 1)[-1]
+
+def type_ref(type_name):
+    """The qualified name of a type in the wsdl"""
+
+    if type_name.startswith('xsd:'):
+        return type_name
+    return 'tns:' + type_name
+
+def used_types(interface):
+    """Every type an interface's methods refer to, directly or through other types"""
+
+    pending = []
+    for params, returns in INTERFACES[interface].values():
+        pending.extend([param_type for param, param_type in params])
+        if returns is not None:
+            pending.append(returns)
+
+    found = set()
+    while pending != []:
+        type_name = pending.pop()
+        if type_name in found or type_name.startswith('xsd:'):
+            continue
+        found.add(type_name)
+        if type_name in STRUCTS:
+            pending.extend([field_type for field, field_type in STRUCTS[type_name]])
+        elif type_name in SEQUENCES:
+            pending.append(SEQUENCES[type_name])
+    return sorted(found)
+
+def wsdl(interface, base_url):
+    """Generate the wsdl for an interface, in the same shape as the ones a BIG-IP serves"""
+
+    module, name = interface.split('.')
+    namespace = 'urn:iControl:%s/%s' % (module, name)
+    methods = sorted(INTERFACES[interface].keys())
+
+    out = []
+    out.append('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.append('<definitions name="%s" targetNamespace="urn:iControl" xmlns:tns="urn:iControl" '
+               'xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:SOAP-ENC="%s" '
+               'xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+               'xmlns="http://schemas.xmlsoap.org/wsdl/">\n' % (interface, SOAP_ENC))
+
+    out.append(' <types>\n  <xsd:schema targetNamespace="urn:iControl">\n')
+    out.append('   <xsd:import namespace="%s" schemaLocation="%s/soap-encoding.xsd"/>\n' % (SOAP_ENC, base_url))
+    for type_name in used_types(interface):
+        if type_name in ENUMS:
+            out.append('   <xsd:simpleType name="%s">\n    <xsd:restriction base="xsd:string">\n' % type_name)
+            for value in ENUMS[type_name]:
+                out.append('     <xsd:enumeration value="%s"/>\n' % value)
+            out.append('    </xsd:restriction>\n   </xsd:simpleType>\n')
+        elif type_name in STRUCTS:
+            out.append('   <xsd:complexType name="%s">\n    <xsd:all>\n' % type_name)
+            for field, field_type in STRUCTS[type_name]:
+                out.append('     <xsd:element name="%s" type="%s"/>\n' % (field, type_ref(field_type)))
+            out.append('    </xsd:all>\n   </xsd:complexType>\n')
+        else:
+            out.append('   <xsd:complexType name="%s">\n    <xsd:complexContent>\n'
+                       '     <xsd:restriction base="SOAP-ENC:Array">\n'
+                       '      <xsd:attribute ref="SOAP-ENC:arrayType" wsdl:arrayType="%s[]"/>\n'
+                       '     </xsd:restriction>\n    </xsd:complexContent>\n   </xsd:complexType>\n'
+                       % (type_name, type_ref(SEQUENCES[type_name])))
+    out.append('  </xsd:schema>\n </types>\n')
+
+    for method in methods:
+        params, returns = INTERFACES[interface][method]
+        out.append(' <message name="%s.%sRequest">\n' % (interface, method))
+        for param, param_type in params:
+            out.append('  <part name="%s" type="%s"/>\n' % (param, type_ref(param_type)))
+        out.append(' </message>\n <message name="%s.%sResponse">\n' % (interface, method))
+        if returns is not None:
+            out.append('  <part name="return" type="%s"/>\n' % type_ref(returns))
+        out.append(' </message>\n')
+
+    out.append(' <portType name="%s.%sPortType">\n' % (module, name))
+    for method in methods:
+        out.append('  <operation name="%s">\n   <input message="tns:%s.%sRequest"/>\n'
+                   '   <output message="tns:%s.%sResponse"/>\n  </operation>\n'
+                   % (method, interface, method, interface, method))
+    out.append(' </portType>\n')
+
+    body = '<soap:body use="encoded" namespace="%s" encodingStyle="%s"/>' % (namespace, SOAP_ENC)
+    out.append(' <binding name="%s.%sBinding" type="tns:%s.%sPortType">\n' % (module, name, module, name))
+    out.append('  <soap:binding style="rpc" transport="http://schemas.xmlsoap.org/soap/http"/>\n')
+    for method in methods:
+        out.append('  <operation name="%s">\n   <soap:operation soapAction="%s"/>\n'
+                   '   <input>%s</input>\n   <output>%s</output>\n  </operation>\n'
+                   % (method, namespace, body, body))
+    out.append(' </binding>\n')
+
+    out.append(' <service name="%s">\n  <port name="%s.%sPort" binding="tns:%s.%sBinding">\n'
+               '   <soap:address location="%s%s"/>\n  </port>\n </service>\n'
+               % (interface, module, name, module, name, base_url, ICONTROL_URI))
+    out.append('</definitions>\n')
+    return ''.join(out)
+
+
+def decode(node):
+    """Turn an element of a SOAP request into plain python: lists, dicts and strings"""
+
+    if node.getAttributeNS(XSI, 'nil') in ('true', '1'):
+        return None
+
+    children = [child for child in node.childNodes if child.nodeType == child.ELEMENT_NODE]
+    is_array = node.getAttributeNS(SOAP_ENC, 'arrayType') != '' or 'Array' in node.getAttributeNS(XSI, 'type')
+    if is_array or (children != [] and [child for child in children if child.localName != 'item'] == []):
+        return [decode(child) for child in children]
+    if children != []:
+        value = {}
+        for child in children:
+            value[str(child.localName)] = decode(child)
+        return value
+    return ''.join([child.data for child in node.childNodes if child.nodeType == child.TEXT_NODE])
+
+def enum(value):
+    """An enum from a request, which suds sends as text or, when built up field by field, as a value"""
+
+    if isinstance(value, dict):
+        return value.get('value')
+    return value
+
+def encode(value, type_name, tag):
+    """Turn python values into the SOAP encoding of type_name"""
+
+    if value is None:
+        return '<%s xsi:nil="true"/>' % tag
+    if type_name in SEQUENCES:
+        item_type = SEQUENCES[type_name]
+        items = ''.join([encode(item, item_type, 'item') for item in value])
+        return '<%s xsi:type="SOAP-ENC:Array" SOAP-ENC:arrayType="%s[%d]">%s</%s>' % (
+            tag, type_ref(item_type), len(value), items, tag)
+    if type_name in STRUCTS:
+        fields = ''.join([encode(value.get(field), field_type, field) for field, field_type in STRUCTS[type_name]])
+        return '<%s xsi:type="%s">%s</%s>' % (tag, type_ref(type_name), fields, tag)
+    if type_name == 'xsd:boolean':
+        value = value and 'true' or 'false'
+    return '<%s xsi:type="%s">%s</%s>' % (tag, type_ref(type_name), escape(str(value)), tag)
+
+def envelope(body):
+    """Wrap a response body in a SOAP envelope"""
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<E:Envelope xmlns:E="%s" xmlns:SOAP-ENC="%s" xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+            'xmlns:xsi="%s" xmlns:tns="urn:iControl" E:encodingStyle="%s"><E:Body>%s</E:Body></E:Envelope>'
+            % (SOAP_ENV, SOAP_ENC, XSI, SOAP_ENC, body))
+
+
+class Fault(Exception):
+    """An error the BIG-IP reports back as a SOAP fault"""
+
+
+def ulong64(value):
+    """A Common.ULong64 for a number"""
+
+    return {'high': value >> 32, 'low': value & 0xffffffff}
+
+def statistic(type_name, value):
+    """A Common.Statistic"""
+
+    return {'type': type_name, 'value': ulong64(value), 'time_stamp': 0}
+
+def time_stamp():
+    """A Common.TimeStamp for now"""
+
+    now = time.gmtime()
+    return {'year': now[0], 'month': now[1], 'day': now[2], 'hour': now[3], 'minute': now[4], 'second': now[5]}
+
+
+class Model:
+    """The configuration of the fake BIG-IP, with a method for each iControl call"""
+
+    def __init__(self, version='BIG-IP_v11.5.0', partition='Common'):
+        self.version = version
+        self.partition = partition
+        self.pools = {}
+        self.monitors = {}
+        self.rules = {}
+        self.classes = {}
+        self.syncs = 0
+
+    def path(self, name):
+        """The full /partition/name path of an object"""
+
+        if name.startswith('/'):
+            return str(name)
+        return '/%s/%s' % (self.partition, name)
+
+    def find(self, table, kind, name):
+        """Look an object up by name, faulting like the BIG-IP if it isn't there"""
+
+        path = self.path(name)
+        if path not in table:
+            raise Fault('01020036:3: The requested %s (%s) was not found.' % (kind, path))
+        return table[path]
+
+    def sockets(self, members):
+        """address:port strings for a decoded member sequence"""
+
+        return ['%s:%s' % (member['address'], member['port']) for member in members or []]
+
+    # LocalLB.Pool
+
+    def pool_get_version(self):
+        return self.version
+
+    def pool_get_list(self):
+        return sorted(self.pools.keys())
+
+    def pool_create(self, pool_names, lb_methods, members):
+        for index, name in enumerate(pool_names):
+            path = self.path(name)
+            if path in self.pools:
+                raise Fault('01020066:3: The requested pool (%s) already exists in partition %s.'
+                            % (path, self.partition))
+            for member in members[index] or []:
+                if not re.match(r'^\d+\.\d+\.\d+\.\d+$', member['address']) or not member['port'].isdigit():
+                    raise Fault('01070226:3: Pool Member %s:%s is not valid.' % (member['address'], member['port']))
+            self.pools[path] = {'method': enum(lb_methods[index]), 'members': self.sockets(members[index]),
+                                'monitors': [], 'disabled': []}
+
+    def pool_delete_pool(self, pool_names):
+        for name in pool_names:
+            self.find(self.pools, 'pool', name)
+            del self.pools[self.path(name)]
+
+    def pool_get_lb_method(self, pool_names):
+        return [self.find(self.pools, 'pool', name)['method'] for name in pool_names]
+
+    def pool_set_lb_method(self, pool_names, lb_methods):
+        for index, name in enumerate(pool_names):
+            self.find(self.pools, 'pool', name)['method'] = enum(lb_methods[index])
+
+    def pool_get_member(self, pool_names):
+        members = []
+        for name in pool_names:
+            sockets = self.find(self.pools, 'pool', name)['members']
+            members.append([{'address': sock.rsplit(':', 1)[0], 'port': sock.rsplit(':', 1)[1]} for sock in sockets])
+        return members
+
+    def pool_add_member(self, pool_names, members):
+        for index, name in enumerate(pool_names):
+            pool = self.find(self.pools, 'pool', name)
+            for sock in self.sockets(members[index]):
+                if sock not in pool['members']:
+                    pool['members'].append(sock)
+
+    def pool_remove_member(self, pool_names, members):
+        for index, name in enumerate(pool_names):
+            pool = self.find(self.pools, 'pool', name)
+            for sock in self.sockets(members[index]):
+                if sock not in pool['members']:
+                    raise Fault('01020036:3: The requested pool member (%s %s) was not found.' % (name, sock))
+                pool['members'].remove(sock)
+
+    def pool_get_monitor_association(self, pool_names):
+        associations = []
+        for name in pool_names:
+            pool = self.find(self.pools, 'pool', name)
+            rule_type = pool['monitors'] and 'MONITOR_RULE_TYPE_SINGLE' or 'MONITOR_RULE_TYPE_NONE'
+            associations.append({'pool_name': self.path(name),
+                                 'monitor_rule': {'type': rule_type, 'quorum': 0,
+                                                  'monitor_templates': pool['monitors']}})
+        return associations
+
+    def pool_set_monitor_association(self, monitor_associations):
+        for association in monitor_associations:
+            pool = self.find(self.pools, 'pool', association['pool_name'])
+            templates = association['monitor_rule']['monitor_templates'] or []
+            for template in templates:
+                self.find(self.monitors, 'monitor', template)
+            pool['monitors'] = [self.path(template) for template in templates]
+
+    def pool_remove_monitor_association(self, pool_names):
+        for name in pool_names:
+            self.find(self.pools, 'pool', name)['monitors'] = []
+
+    def pool_get_object_status(self, pool_names):
+        statuses = []
+        for name in pool_names:
+            pool = self.find(self.pools, 'pool', name)
+            if pool['members'] == []:
+                status = 'AVAILABILITY_STATUS_RED'
+            elif pool['monitors'] == []:
+                status = 'AVAILABILITY_STATUS_BLUE'
+            else:
+                status = 'AVAILABILITY_STATUS_GREEN'
+            statuses.append({'availability_status': status, 'enabled_status': 'ENABLED_STATUS_ENABLED',
+                             'status_description': 'The pool is available'})
+        return statuses
+
+    # LocalLB.PoolMember
+
+    def member_get_version(self):
+        return self.version
+
+    def member_set_session_enabled_state(self, pool_names, session_states):
+        for index, name in enumerate(pool_names):
+            pool = self.find(self.pools, 'pool', name)
+            for state in session_states[index] or []:
+                sock = '%s:%s' % (state['member']['address'], state['member']['port'])
+                if enum(state['session_state']) == 'STATE_DISABLED':
+                    if sock not in pool['disabled']:
+                        pool['disabled'].append(sock)
+                elif sock in pool['disabled']:
+                    pool['disabled'].remove(sock)
+
+    def member_get_statistics(self, pool_names, members):
+        statistics = []
+        for index, name in enumerate(pool_names):
+            self.find(self.pools, 'pool', name)
+            # Nobody is ever connected to the fake, so members drain straight away
+            entries = [{'member': member,
+                        'statistics': [statistic('STATISTIC_SERVER_SIDE_CURRENT_CONNECTIONS', 0)]}
+                       for member in members[index] or []]
+            statistics.append({'statistics': entries, 'time_stamp': time_stamp()})
+        return statistics
+
+    # LocalLB.Monitor
+
+    def monitor_get_version(self):
+        return self.version
+
+    def monitor_get_template_list(self):
+        return [{'template_name': name, 'template_type': self.monitors[name]['type']}
+                for name in sorted(self.monitors.keys())]
+
+    def monitor_create_template(self, templates, template_attributes):
+        for index, template in enumerate(templates):
+            path = self.path(template['template_name'])
+            if path in self.monitors:
+                raise Fault('01020066:3: The requested monitor (%s) already exists in partition %s.'
+                            % (path, self.partition))
+            attributes = template_attributes[index]
+            self.monitors[path] = {'type': enum(template['template_type']),
+                                   'interval': int(attributes['interval']), 'timeout': int(attributes['timeout']),
+                                   'strings': {}}
+
+    def monitor_delete_template(self, template_names):
+        for name in template_names:
+            self.find(self.monitors, 'monitor', name)
+            for pool in self.pools.values():
+                if self.path(name) in pool['monitors']:
+                    raise Fault('01070083:3: Monitor %s is in use.' % self.path(name))
+            del self.monitors[self.path(name)]
+
+    def monitor_get_template_string_property(self, template_names, property_types):
+        values = []
+        for index, name in enumerate(template_names):
+            property_type = enum(property_types[index])
+            values.append({'type': property_type,
+                           'value': self.find(self.monitors, 'monitor', name)['strings'].get(property_type, '')})
+        return values
+
+    def monitor_set_template_string_property(self, template_names, values):
+        for index, name in enumerate(template_names):
+            monitor = self.find(self.monitors, 'monitor', name)
+            value = values[index]
+            monitor['strings'][enum(value['type'])] = value['value'] or ''
+
+    def monitor_get_template_integer_property(self, template_names, property_types):
+        values = []
+        for index, name in enumerate(template_names):
+            property_type = enum(property_types[index])
+            monitor = self.find(self.monitors, 'monitor', name)
+            value = {'ITYPE_INTERVAL': monitor['interval'], 'ITYPE_TIMEOUT': monitor['timeout']}.get(property_type, 0)
+            values.append({'type': property_type, 'value': value})
+        return values
+
+    # LocalLB.Rule
+
+    def rule_get_version(self):
+        return self.version
+
+    def rule_get_list(self):
+        return sorted(self.rules.keys())
+
+    def check_rule(self, rule):
+        """Fault on a rule the BIG-IP wouldn't accept, as far as the linter can tell"""
+
+        errors = f5lint.lint(rule['rule_definition'] or '', rule['rule_name'])
+        if errors != []:
+            infile, line, message = errors[0]
+            raise Fault('01070151:3: Rule [%s] error: line %d: %s' % (self.path(rule['rule_name']), line, message))
+
+    def rule_query_rule(self, rule_names):
+        return [{'rule_name': self.path(name), 'rule_definition': self.find(self.rules, 'rule', name)['text']}
+                for name in rule_names]
+
+    def rule_create(self, rules):
+        for rule in rules:
+            path = self.path(rule['rule_name'])
+            if path in self.rules:
+                raise Fault('01020066:3: The requested rule (%s) already exists in partition %s.'
+                            % (path, self.partition))
+            self.check_rule(rule)
+            self.rules[path] = {'text': rule['rule_definition'], 'executions': 0}
+
+    def rule_modify_rule(self, rules):
+        for rule in rules:
+            self.find(self.rules, 'rule', rule['rule_name'])
+            self.check_rule(rule)
+            # Replacing a rule resets its statistics
+            self.rules[self.path(rule['rule_name'])] = {'text': rule['rule_definition'], 'executions': 0}
+
+    def rule_delete_rule(self, rule_names):
+        for name in rule_names:
+            self.find(self.rules, 'rule', name)
+            del self.rules[self.path(name)]
+
+    def rule_get_statistics(self, rule_names):
+        entries = []
+        for name in rule_names:
+            rule = self.find(self.rules, 'rule', name)
+            # Every look sees some more traffic through the rule
+            rule['executions'] += 1000
+            text = rule['text']
+            entries.append({'rule_name': self.path(name), 'event_name': 'HTTP_REQUEST', 'priority': 500,
+                            'statistics': [statistic('STATISTIC_RULE_MINIMUM_CYCLES', 10 * len(text)),
+                                           statistic('STATISTIC_RULE_AVERAGE_CYCLES', 20 * len(text)),
+                                           statistic('STATISTIC_RULE_MAXIMUM_CYCLES', 80 * len(text)),
+                                           statistic('STATISTIC_RULE_TOTAL_EXECUTIONS', rule['executions']),
+                                           statistic('STATISTIC_RULE_FAILURES', 0),
+                                           statistic('STATISTIC_RULE_ABORTS', 0)]})
+        return {'statistics': entries, 'time_stamp': time_stamp()}
+
+    # LocalLB.Class
+
+    def data_group_get_version(self):
+        return self.version
+
+    def data_group_get_string_class_list(self):
+        return sorted(self.classes.keys())
+
+    def data_group_create_string_class(self, classes):
+        for string_class in classes:
+            path = self.path(string_class['name'])
+            if path in self.classes:
+                raise Fault('01020066:3: The requested class (%s) already exists in partition %s.'
+                            % (path, self.partition))
+            self.classes[path] = dict([(member, '') for member in string_class['members'] or []])
+
+    def data_group_modify_string_class(self, classes):
+        for string_class in classes:
+            self.find(self.classes, 'class', string_class['name'])
+            self.classes[self.path(string_class['name'])] = dict([(member, '')
+                                                                  for member in string_class['members'] or []])
+
+    def data_group_set_string_class_member_data_value(self, class_members, values):
+        for index, string_class in enumerate(class_members):
+            data_group = self.find(self.classes, 'class', string_class['name'])
+            for position, member in enumerate(string_class['members'] or []):
+                if member not in data_group:
+                    raise Fault('01020036:3: The requested class member (%s) was not found.' % member)
+                data_group[member] = values[index][position]
+
+    # System.ConfigSync
+
+    def sync_get_version(self):
+        return self.version
+
+    def sync_synchronize_configuration(self, sync_flag):
+        self.syncs += 1
+
+
+# Which Model methods answer each interface
+PREFIXES = {'LocalLB.Pool': 'pool', 'LocalLB.PoolMember': 'member', 'LocalLB.Monitor': 'monitor',
+            'LocalLB.Rule': 'rule', 'LocalLB.Class': 'data_group', 'System.ConfigSync': 'sync'}
+
+
+class FakeBIGIP:
+    """Answers iControl calls from a Model, with latency and faults thrown in"""
+
+    def __init__(self, model=None, latency=0, jitter=0, fault_rate=0, seed=None):
+        if model is None:
+            model = Model()
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+        self.fault_rate = fault_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # Transactions queue up changes per session until they're submitted
+        self.sessions = {}
+        self.next_session = 1000
+
+        # What the scripts asked for, for benchmarks to read.  Bytes are SOAP traffic only, not wsdls
+        self.calls = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def call(self, interface, method, args, session):
+        """Run one iControl call against the model, returns the response body"""
+
+        if interface not in INTERFACES or method not in INTERFACES[interface]:
+            raise Fault('Unknown method %s::%s' % (interface, method))
+        params, returns = INTERFACES[interface][method]
+        values = [args.get(param) for param, param_type in params]
+
+        self.lock.acquire()
+        try:
+            key = '%s.%s' % (interface, method)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+            if interface == 'System.Session':
+                result = self.session_call(method, session)
+            elif session in self.sessions and self.sessions[session] is not None and not self.is_query(method):
+                # Inside a transaction changes wait for the submit
+                self.sessions[session].append((interface, method, values))
+                result = None
+            else:
+                result = getattr(self.model, '%s_%s' % (PREFIXES[interface], method))(*values)
+        finally:
+            self.lock.release()
+
+        if returns is None:
+            return ''
+        return encode(result, returns, 'return')
+
+    def transferred(self, received, sent):
+        """Count the bytes of a request and its response"""
+
+        self.lock.acquire()
+        try:
+            self.bytes_in += received
+            self.bytes_out += sent
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        """Start again from an empty configuration"""
+
+        self.lock.acquire()
+        try:
+            self.model = Model(self.model.version, self.model.partition)
+            self.sessions = {}
+        finally:
+            self.lock.release()
+
+    def counters(self):
+        """A copy of the counters, (calls by method, bytes in, bytes out)"""
+
+        self.lock.acquire()
+        try:
+            return dict(self.calls), self.bytes_in, self.bytes_out
+        finally:
+            self.lock.release()
+
+    def is_query(self, method):
+        """Queries are answered straight away, even in a transaction"""
+
+        return method.startswith('get_') or method.startswith('query_')
+
+    def session_call(self, method, session):
+        """System.Session, called with the lock held"""
+
+        if method == 'get_version':
+            return self.model.version
+        if method == 'get_session_identifier':
+            self.next_session += 1
+            self.sessions[str(self.next_session)] = None
+            return self.next_session
+        if session not in self.sessions:
+            raise Fault('No session, set the X-iControl-Session header to a session identifier')
+        if method == 'start_transaction':
+            if self.sessions[session] is not None:
+                raise Fault('A transaction is already in progress')
+            self.sessions[session] = []
+            return None
+
+        queued = self.sessions[session]
+        if queued is None:
+            raise Fault('No transaction is in progress')
+        self.sessions[session] = None
+        if method == 'submit_transaction':
+            # All or nothing, so work on a copy
+            model = copy.deepcopy(self.model)
+            for interface, queued_method, values in queued:
+                getattr(model, '%s_%s' % (PREFIXES[interface], queued_method))(*values)
+            self.model.__dict__.update(model.__dict__)
+        return None
+
+    def delay(self):
+        """Sleep for the configured latency, give or take the jitter"""
+
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def injected_fault(self):
+        """Decide if this call should fail for no good reason"""
+
+        return self.fault_rate > 0 and self.random.random() < self.fault_rate
+
+    def handle(self, request_body, session):
+        """Returns (status, response) for a SOAP request"""
+
+        self.delay()
+        try:
+            document = minidom.parseString(request_body)
+            body = document.getElementsByTagNameNS(SOAP_ENV, 'Body')[0]
+            call = [node for node in body.childNodes if node.nodeType == node.ELEMENT_NODE][0]
+            # The namespace is urn:iControl:LocalLB/Pool
+            interface = call.namespaceURI.split(':')[-1].replace('/', '.')
+            method = str(call.localName)
+            args = {}
+            for node in call.childNodes:
+                if node.nodeType == node.ELEMENT_NODE:
+                    args[str(node.localName)] = decode(node)
+
+            if self.injected_fault():
+                raise Fault('Injected fault in %s::%s' % (interface, method))
+
+            result = self.call(interface, method, args, session)
+            response = '<m:%sResponse xmlns:m="urn:iControl:%s">%s</m:%sResponse>' % (
+                method, interface.replace('.', '/'), result, method)
+            return 200, envelope(response)
+        except Fault as detail:
+            error = str(detail)
+        except Exception as detail:
+            # A request the model can't make sense of, most likely a malformed array,
+            # should fail as clearly as a modelled error rather than drop the connection
+            error = 'f5fake could not handle the request: %s: %s' % (detail.__class__.__name__, detail)
+
+        message = 'Exception caught in %s::%s()\nException: Common::OperationFailed\n\terror_string : %s' % (
+            locals().get('interface', '?'), locals().get('method', '?'), error)
+        return 500, envelope('<E:Fault><faultcode>E:Server</faultcode><faultstring>%s</faultstring></E:Fault>'
+                             % escape(message))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP side of the fake, wsdls on GET and SOAP calls on POST"""
+
+    def base_url(self):
+        return 'http://%s' % self.headers.get('Host', '%s:%d' % self.server.server_address)
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        match = re.match(r'^%s\?WSDL=([A-Za-z]+\.[A-Za-z]+)$' % re.escape(ICONTROL_URI), self.path)
+        if match and match.group(1) in INTERFACES:
+            self.reply(200, 'text/xml; charset=utf-8', wsdl(match.group(1), self.base_url()))
+        elif self.path == '/soap-encoding.xsd':
+            self.reply(200, 'text/xml; charset=utf-8', SOAP_ENCODING_SCHEMA)
+        else:
+            self.reply(404, 'text/plain', 'Not found\n')
+
+    def do_POST(self):
+        if self.path != ICONTROL_URI:
+            self.reply(404, 'text/plain', 'Not found\n')
+            return
+        request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, response = self.server.bigip.handle(request_body, self.headers.get('X-iControl-Session'))
+        self.reply(status, 'text/xml; charset=utf-8', response)
+        self.server.bigip.transferred(len(request_body), len(response))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """The fake BIG-IP listening on a port, one thread per request"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, bigip, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.bigip = bigip
+        self.verbose = verbose
+
+def serve(bigip, port=0, host='127.0.0.1'):
+    """Start a fake BIG-IP in a background thread, returns the server; port 0 picks a free one"""
+
+    server = Server((host, port), bigip)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def main():
+    """Run the fake BIG-IP until interrupted"""
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_option('--port', type='int', default=8443, help='port to listen on')
+    parser.add_option('--latency', type='float', default=0, help='seconds added to every call')
+    parser.add_option('--jitter', type='float', default=0, help='latency varies by up to this many seconds')
+    parser.add_option('--fault-rate', type='float', default=0, help='fraction of calls that fail at random')
+    parser.add_option('--seed', type='int', help='seed for the latency and faults')
+    parser.add_option('--version', default='BIG-IP_v11.5.0', help='BIG-IP version to report')
+    parser.add_option('--verbose', action='store_true', default=False, help='log every request')
+    options, args = parser.parse_args()
+
+    bigip = FakeBIGIP(Model(options.version), options.latency, options.jitter, options.fault_rate, options.seed)
+    server = Server((options.host, options.port), bigip, options.verbose)
+    print "Fake BIG-IP listening on http://%s:%d%s" % (options.host, options.port, ICONTROL_URI)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,51 @@
 #!/usr/bin/env python26
 """irule deployment"""
 
+import difflib
+import glob
 import os
 import sys
 import f5utility
 import suds
-import subprocess
 
-def main():
-    """Evalutes irules in subdirs, tests them individually on the
-    load balancer before collating rules and pushing to f5"""
+def subdirs():
+    """The subdirectories of irules/, one rule each"""
 
-    f5 = f5utility.f5Connection()
+    return sorted([dirs for dirs in os.listdir('./irules')
+                   if dirs != 'CVS' and os.path.isdir(os.path.join('./irules', dirs))])
+
+def sources():
+    """The files the rules are built from"""
+
+    return [infile for dirs in subdirs() for infile in sorted(glob.glob(os.path.join('./irules', dirs, '*.conf')))]
+
+def names():
+    """The names of the rules built from the subdirectories"""
+
+    return [dirs+"_rule" for dirs in subdirs()]
+
+def owner(infile):
+    """The name of the rule a file goes into, after its subdirectory"""
+
+    return os.path.basename(os.path.dirname(infile))+"_rule"
+
+@f5utility.stage('check irules')
+def check(f5, only=None):
+    """Evalutes irules in subdirs, or just those for the rules named in only, tests them
+    on the load balancer and collates them, returns the queue of (subdirectory, rule)
+    that differ from the f5"""
 
     # Fetching a list of subdirectories which we need to process
 
-    subdirs = os.listdir('./irules')
-    for dirs in subdirs:
+    rule_dirs = [dirs for dirs in subdirs() if only is None or dirs+"_rule" in only]
+
+    # One call tells us what every rule on the f5 looks like now
+
+    f5.irule.load_deployed([dirs+"_rule" for dirs in rule_dirs])
+
+    queue = []
+
+    for dirs in rule_dirs:
         if dirs == 'CVS':
             continue
         print " "
@@ -29,31 +58,114 @@ def main():
 
             # Build the rule
 
-            rule_def = f5.irule.rule_build(full_path, dirs)
+            with f5.tracer.span(dirs):
+                rule_def = f5.irule.rule_build(full_path, dirs)
 
             # Check the rule for basic errors
 
             print "Built rules for "+dirs
 
-            # Check if the rule exists, create if it doesn't
+            f = open(dirs+"_rule",'w')
+            f.write(str(rule_def))
+            f.close()
 
-            try:
-                rule = f5.irule.rule.query_rule(rule_names=[dirs+"_rule"])
-            except:
-                rule = f5.irule.rule.create(rules=[rule_def])
+            # Nothing to do if the f5 already has this rule
+
+            if f5.irule.is_current(rule_def):
+                print "Rule unchanged, not uploading"
+                continue
+            queue.append((dirs, rule_def))
+
+    return queue
+
+@f5utility.stage('commit irules')
+def commit(f5, queue):
+    """Push the queued rules to the f5, returns True if anything changed"""
+
+    if queue == []:
+        print " "
+        print "No rules changed"
+        return False
+
+    # Keep the timing statistics of the old rules to compare the new ones against,
+    # all in one snapshot, which is only saved once the new rules have gone in
+
+    replacing = [dirs+"_rule" for dirs, rule_def in queue if f5.inventory.has_rule(dirs+"_rule")]
+    baseline = None
+    if replacing != []:
+        try:
+            baseline = f5.rule_stats.take(replacing, 'deploy')
+        except suds.WebFault as detail:
+            print "Couldn't take the statistics for %s: %s" % (', '.join(replacing), detail)
 
-            # Modify the rule if it exists already
+    for dirs, rule_def in queue:
 
-            try:
+        # Any data group the rule looks hostnames up in has to be there first
+
+        f5.irule.push_hosts(dirs)
+
+        # Modify the rule if it exists already, create it if it doesn't
+
+        try:
+            if f5.inventory.has_rule(dirs+"_rule"):
                 rule = f5.irule.rule.modify_rule(rules=[rule_def])
-            except suds.WebFault as detail:
-                print "Failed to update the rule, probably due to a syntax error"
-                sys.exit(detail)
-            f = open(dirs+"_rule",'w')
-            f.write(str(rule_def))
-            f.close()
+            else:
+                rule = f5.irule.rule.create(rules=[rule_def])
+                f5.inventory.add_rule(dirs+"_rule")
+        except suds.WebFault as detail:
+            print "Failed to update the rule, probably due to a syntax error"
+            sys.exit(detail)
+        f5.irule.uploaded(rule_def)
+
+        print "Rules for %s uploaded to f5" % dirs
+
+    if baseline is not None:
+        f5.transaction.defer(f5.rule_stats.save, baseline)
+
+    print "Run f5rulestats.py once the new rules have seen some traffic to compare their timings"
+    return True
+
+def describe(f5, queued):
+    """Lines saying what uploading a queued rule would change on the f5, as a diff"""
+
+    dirs, rule_def = queued
+    new = [line for line in str(rule_def.rule_definition).splitlines() if not line.startswith('# Last Modified')]
+    deployed = f5.irule.deployed_text.get(f5.inventory.key(dirs+"_rule"))
+    if deployed is None:
+        return ["+ rule %s_rule (%d lines)" % (dirs, len(new))]
+
+    old = [line for line in str(deployed).splitlines() if not line.startswith('# Last Modified')]
+    lines = ["~ rule %s_rule" % dirs]
+    for line in difflib.unified_diff(old, new, 'f5', 'irules/' + dirs, n=1, lineterm=''):
+        lines.append("    " + line)
+    return lines
+
+def assume(f5, queue):
+    """Nothing is checked after the rules, so nothing relies on them"""
+
+    pass
+
+def dependants(queue):
+    """Nothing is checked after the rules, so nothing relies on them"""
+
+    return []
+
+def creates(queue):
+    """Nothing is checked after the rules, so nothing relies on them"""
+
+    return False
+
+def main():
+    """Evalutes irules in subdirs, tests them individually on the
+    load balancer before collating rules and pushing to f5"""
+
+    f5 = f5utility.f5Connection()
 
-            print "Rules uploaded to f5"
+    # Check outside of any transaction, validation makes its own temporary rules
+    queue = check(f5)
+    if queue == [] or not f5.transaction.apply(commit, f5, queue):
+        print "Nothing to sync"
+        return
 
     print " "
     print "------------------------------"
@@ -66,10 +178,5 @@ def main():
 
       
 if __name__ == "__main__":
-    try:
-        with open(os.devnull,'wb') as devnull:
-            subprocess.check_call(["/usr/bin/cvs","diff","irules"],stdout=devnull,stderr=devnull)
-    except subprocess.CalledProcessError:
-        print "Changes have not been committed to cvs.  Run 'cvs diff' confirm the changes and then commit them"
-        sys.exit(1)
+    f5utility.check_cvs(["irules"])
     main()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python26
+"""Offline syntax checking for iRules
+
+Tokenises iRule (Tcl) source the way the load balancer does, following
+quoting, comments, command substitution and nested braces, and checks the
+structure of the commands we care about (when, if/elseif/else, switch and
+the loops) so most mistakes are caught without a round trip to the F5.
+"""
+
+import re
+import sys
+
+# Characters that separate words and commands
+SPACE = ' \t\r\f\v'
+SEPARATORS = SPACE + '\n;'
+
+# The interesting characters inside each kind of word, everything else is skipped in one go
+BRACED = re.compile(r'[{}\\]')
+QUOTED = re.compile(r'["\\\[]')
+QUOTED_LITERAL = re.compile(r'["\\]')
+BARE = re.compile(r'[\s;\\\[\]$}]')
+BARE_LITERAL = re.compile(r'[\s\\]')
+EXPRESSION = re.compile(r'[()"{\\\[]')
+
+# Commands whose arguments are scripts or expressions, by argument position
+SCRIPT_ARGS = {'while': [2], 'for': [1, 3, 4], 'foreach': [-1], 'catch': [1], 'proc': [-1], 'when': [-1]}
+EXPR_ARGS = {'while': [1], 'for': [2], 'expr': [1]}
+
+
+class Word:
+    """A single word of a command"""
+
+    def __init__(self, kind, start, end, content_start, content_end):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.content_start = content_start
+        self.content_end = content_end
+
+
+class Linter:
+    """Lints iRule source, collecting (filename, line, message) errors"""
+
+    def __init__(self, text, filename='<rule>', line=1):
+        self.text = text
+        self.filename = filename
+        self.line = line
+        self.errors = []
+
+    def error(self, offset, message):
+        """Record an error at an offset into the text"""
+
+        line = self.line + self.text.count('\n', 0, offset)
+        self.errors.append((self.filename, line, message))
+
+    def literal(self, word):
+        """Returns the text of a word, without its braces or quotes"""
+
+        return self.text[word.content_start:word.content_end]
+
+    def script(self, pos, end, close=None):
+        """Lint the commands from pos to end, or up to the close character.
+        Returns the position the script stopped at"""
+
+        previous = None
+        while True:
+            words, pos = self.next_command(pos, end, close)
+            if words is None:
+                return pos
+            previous = self.check_command(words, previous)
+
+    def next_command(self, pos, end, close=None):
+        """Skip to the next command and split it into words.
+        Returns the words, or None at the end of the script, and the position after them"""
+
+        text = self.text
+        while pos < end:
+            char = text[pos]
+            if char in SEPARATORS:
+                pos += 1
+            elif char == '\\' and text.startswith('\\\n', pos):
+                pos += 2
+            elif close is not None and char == close:
+                return None, pos
+            elif char == '#':
+                # Comments run to the end of the line, unless the newline is escaped
+                while pos < end and text[pos] != '\n':
+                    if text[pos] == '\\':
+                        pos += 1
+                    pos += 1
+            else:
+                return self.command(pos, end, close)
+
+        return None, end
+
+    def command(self, pos, end, close):
+        """Split a single command into words"""
+
+        text = self.text
+        words = []
+        while pos < end:
+            char = text[pos]
+            if char in SPACE:
+                pos += 1
+            elif char == '\\' and text.startswith('\\\n', pos):
+                pos += 2
+            elif char in '\n;' or (close is not None and char == close):
+                break
+            else:
+                word, pos = self.word(pos, end, close)
+                words.append(word)
+
+        return words, pos
+
+    def word(self, pos, end, close, subst=True):
+        """Read the word starting at pos, returns the word and the position after it"""
+
+        char = self.text[pos]
+        if char == '{':
+            return self.braced(pos, end, close)
+        if char == '"':
+            return self.quoted(pos, end, close, subst)
+        return self.bare(pos, end, close, subst)
+
+    def braced(self, pos, end, close, strict=True):
+        """Read a {braced} word, nothing inside it is substituted"""
+
+        depth = 1
+        index = pos + 1
+        while True:
+            match = BRACED.search(self.text, index, end)
+            if match is None:
+                self.error(pos, 'missing close-brace')
+                return Word('braced', pos, end, pos + 1, end), end
+            index = match.end()
+            char = match.group()
+            if char == '\\':
+                index += 1
+            elif char == '{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    break
+
+        # Braces in comments still count, a classic way to end a body early
+        line_start = self.text.rfind('\n', pos, index - 1)
+        if line_start != -1 and self.text[line_start + 1:index - 1].lstrip().startswith('#'):
+            self.error(index - 1, 'close-brace in a comment ends the enclosing braces')
+
+        word = Word('braced', pos, index, pos + 1, index - 1)
+        if strict:
+            # The F5 accepts a brace straight after a close-brace, as in "}{", Tcl doesn't
+            self.check_follows(index, end, close, 'close-brace', '{')
+        return word, index
+
+    def quoted(self, pos, end, close, subst=True, strict=True):
+        """Read a "quoted" word, which may contain [command substitution]"""
+
+        pattern = subst and QUOTED or QUOTED_LITERAL
+        index = pos + 1
+        while True:
+            match = pattern.search(self.text, index, end)
+            if match is None:
+                self.error(pos, 'missing "')
+                return Word('quoted', pos, end, pos + 1, end), end
+            char = match.group()
+            if char == '\\':
+                index = match.end() + 1
+            elif char == '[':
+                index = self.substitution(match.start(), end)
+            else:
+                index = match.end()
+                break
+
+        word = Word('quoted', pos, index, pos + 1, index - 1)
+        if strict:
+            self.check_follows(index, end, close, 'close-quote')
+        return word, index
+
+    def bare(self, pos, end, close, subst=True):
+        """Read a bare word, up to the next separator"""
+
+        text = self.text
+        pattern = subst and BARE or BARE_LITERAL
+        index = pos
+        while True:
+            match = pattern.search(text, index, end)
+            if match is None:
+                index = end
+                break
+            char = match.group()
+            if char == '\\':
+                index = match.end() + 1
+            elif char == '[':
+                index = self.substitution(match.start(), end)
+            elif char == '$' and text.startswith('${', match.start()):
+                # ${name} variable references can contain anything but a close-brace
+                index = text.find('}', match.end(), end)
+                if index == -1:
+                    self.error(match.start(), 'missing close-brace for variable name')
+                    index = end
+                else:
+                    index += 1
+            elif char == '$':
+                index = match.end()
+            elif char == '}':
+                # Inside a braced body this can't happen, so we're at the top of a file
+                self.error(match.start(), 'unmatched close-brace')
+                index = match.end()
+            elif char == ']' and close != ']':
+                index = match.end()
+            else:
+                index = match.start()
+                break
+
+        return Word('bare', pos, index, pos, index), index
+
+    def substitution(self, pos, end):
+        """Lint a [command substitution] starting at pos, returns the position after it"""
+
+        index = self.script(pos + 1, end, ']')
+        if index >= end:
+            self.error(pos, 'missing close-bracket')
+            return end
+        return index + 1
+
+    def check_follows(self, index, end, close, what, allowed=''):
+        """Make sure a braced or quoted word is followed by a separator"""
+
+        if index >= end:
+            return
+        char = self.text[index]
+        if char in SEPARATORS or char in allowed or (close is not None and char == close):
+            return
+        self.error(index, 'extra characters after %s' % what)
+
+    def expression(self, word):
+        """Lint a word used as an expression"""
+
+        if word.kind != 'braced':
+            # Quoted and bare expressions have already been checked as words
+            return
+
+        text = self.text
+        parens = []
+        index = word.content_start
+        end = word.content_end
+        while True:
+            match = EXPRESSION.search(text, index, end)
+            if match is None:
+                break
+            char = match.group()
+            if char == '(':
+                parens.append(match.start())
+                index = match.end()
+            elif char == ')':
+                if parens == []:
+                    self.error(match.start(), 'unbalanced close paren in expression')
+                else:
+                    parens.pop()
+                index = match.end()
+            elif char == '"':
+                index = self.quoted(match.start(), end, None, True, False)[1]
+            elif char == '{':
+                index = self.braced(match.start(), end, None, False)[1]
+            elif char == '[':
+                index = self.substitution(match.start(), end)
+            else:
+                index = match.end() + 1
+
+        for offset in parens:
+            self.error(offset, 'missing close paren in expression')
+
+    def body(self, word):
+        """Lint a word used as a script"""
+
+        if word.kind == 'braced':
+            self.script(word.content_start, word.content_end)
+
+    def list_words(self, start, end):
+        """Split a braced list into its elements"""
+
+        text = self.text
+        words = []
+        pos = start
+        while pos < end:
+            char = text[pos]
+            if char in SPACE or char == '\n':
+                pos += 1
+            elif char == '}':
+                self.error(pos, 'unmatched close-brace')
+                pos += 1
+            elif char == '{':
+                word, pos = self.braced(pos, end, None)
+                words.append(word)
+            elif char == '"':
+                word, pos = self.quoted(pos, end, None, False)
+                words.append(word)
+            else:
+                word, pos = self.bare(pos, end, None, False)
+                words.append(word)
+
+        return words
+
+    def check_command(self, words, previous):
+        """Check the structure of a command, and lint any scripts or expressions it takes.
+        Returns the name of the command, so an if can be continued on a following line"""
+
+        if words == []:
+            return previous
+
+        name = self.literal(words[0])
+        if name == 'if':
+            self.check_if(words, 1)
+        elif name in ('elseif', 'else'):
+            # The F5 lets elseif and else start a new line after an if's closing brace
+            if previous != 'if':
+                self.error(words[0].start, '%s without a preceding if' % name)
+                return name
+            if name == 'elseif':
+                self.check_if(words, 1)
+            else:
+                self.check_else(words, 1)
+            return 'if'
+        elif name == 'switch':
+            self.check_switch(words)
+        else:
+            for index in SCRIPT_ARGS.get(name, []):
+                if -len(words) < index < len(words) and index != 0:
+                    self.body(words[index])
+            for index in EXPR_ARGS.get(name, []):
+                if index < len(words):
+                    self.expression(words[index])
+
+        return name
+
+    def check_if(self, words, index):
+        """Check the expressions and bodies of an if, starting at its first expression"""
+
+        while True:
+            if index >= len(words):
+                self.error(words[-1].end, 'no expression after "%s"' % self.literal(words[index - 1]))
+                return
+            self.expression(words[index])
+            index += 1
+            if index < len(words) and self.literal(words[index]) == 'then':
+                index += 1
+            if index >= len(words):
+                self.error(words[-1].end, 'no script following expression')
+                return
+            self.body(words[index])
+            index += 1
+
+            if index >= len(words):
+                return
+            if self.literal(words[index]) == 'elseif':
+                index += 1
+                continue
+            if self.literal(words[index]) == 'else':
+                index += 1
+            self.check_else(words, index)
+            return
+
+    def check_else(self, words, index):
+        """Check the final body of an if"""
+
+        if index >= len(words):
+            self.error(words[-1].end, 'no script following "else"')
+            return
+        self.body(words[index])
+        if index + 1 < len(words):
+            self.error(words[index + 1].start, 'extra words after "else" body')
+
+    def check_switch(self, words):
+        """Check a switch has a string and pattern/body pairs, and lint the bodies"""
+
+        index = 1
+        while index < len(words) and self.literal(words[index]).startswith('-'):
+            index += 1
+            if self.literal(words[index - 1]) == '--':
+                break
+        if index >= len(words):
+            self.error(words[0].start, 'switch has no string to match')
+            return
+
+        cases = words[index + 1:]
+        if len(cases) == 1 and cases[0].kind == 'braced':
+            self.check_cases(cases[0].content_start, cases[0].content_end)
+        else:
+            self.check_pairs(cases, False)
+
+    def check_cases(self, start, end):
+        """Check a block of switch pattern/body pairs"""
+
+        self.check_pairs(self.list_words(start, end), True)
+
+    def check_pairs(self, cases, in_list):
+        """Check switch pattern/body pairs"""
+
+        if cases == []:
+            return
+
+        for index in range(0, len(cases), 2):
+            pattern = cases[index]
+            if in_list and pattern.kind == 'bare' and self.literal(pattern).startswith('#'):
+                self.error(pattern.start, 'comments between switch cases are taken as patterns')
+            if index + 1 >= len(cases):
+                self.error(pattern.start, 'extra switch pattern with no body')
+                return
+            body = cases[index + 1]
+            if self.literal(body) == '-' and body.kind == 'bare':
+                if index + 2 >= len(cases):
+                    self.error(body.start, 'no body specified for last pattern')
+            else:
+                self.body(body)
+
+
+def lint(text, filename='<rule>', line=1):
+    """Lint a complete rule, returns a list of (filename, line, message) errors"""
+
+    linter = Linter(text, filename, line)
+    linter.script(0, len(text))
+    return linter.errors
+
+def lint_cases(text, filename='<rule>', line=1):
+    """Lint a file of switch cases as used under irules/, returns a list of (filename, line, message) errors"""
+
+    linter = Linter(text, filename, line)
+    linter.check_cases(0, len(text))
+    return linter.errors
+
+def commands(text):
+    """Split a script into its top level commands, each a list of word texts, without linting it"""
+
+    linter = Linter(text)
+    result = []
+    pos = 0
+    while True:
+        words, pos = linter.next_command(pos, len(text))
+        if words is None:
+            return result
+        result.append([linter.literal(word) for word in words])
+
+def main():
+    """Lint the files given on the command line, .conf files are taken to be switch cases"""
+
+    if len(sys.argv) < 2:
+        sys.exit("Usage: %s file..." % sys.argv[0])
+
+    errors = []
+    for filename in sys.argv[1:]:
+        source = open(filename, 'r').read()
+        if filename.endswith('.conf'):
+            errors.extend(lint_cases(source, filename))
+        else:
+            errors.extend(lint(source, filename))
+
+    for filename, line, message in errors:
+        print "%s:%d: %s" % (filename, line, message)
+
+    if errors != []:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
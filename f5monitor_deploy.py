@@ -6,64 +6,92 @@ import glob
 import os
 import sys
 import f5utility
-import subprocess
 
-def main():
+def check_monitor(f5, infile):
+    """Build a monitor from its config file and compare it with the f5,
+    returns the monitor if it needs committing, otherwise None"""
 
-    """Create Monitors from config files"""
+    #Build a monitor from the config file and check that its valid
+    monitor = f5.monitor.build(infile)
 
-    #Set directory for monitor conf files
-    src_dir = 'monitors/'
+    name = monitor['monitor_template'].template_name
 
-    #Create Connection to the f5
-    f5 = f5utility.f5Connection()
+    # Check if the monitor already exists
+    if f5.monitor.exists(name):
 
-    print " "
-    print "------------------------------"
-    print " Checking Configuration"
-    print "------------------------------"
-    print " "
+        # Check if the monitor has changed
+        changed = f5.monitor.changed(monitor)
+        if (changed == 2):
+            if f5.monitor.test(monitor):
+                print "Marking monitor %s for re-creation" % name
+                monitor['operation'] = 'recreate'
+                return monitor
 
-    #Create empty queue for monitor create/changes
-    queue = []
+        elif (changed == 1):
 
-    for infile in sorted(glob.glob(os.path.join(src_dir, '*_health'))):
+            # if the monitor is valid add it to the queue
+            # if the monitor is not valid this will fail and exit the script
+            if f5.monitor.test(monitor):
 
-        #Build a monitor from the config file and check that its valid
-        monitor = f5.monitor.build(infile)
+                print "Marking monitor %s for modification" % name
+                monitor['operation'] = 'modify'
+                return monitor
 
-        name = monitor['monitor_template'].template_name
+        else:
+            print "No Changes made to %s" % name
+    else:
 
-        # Check if the monitor already exists
-        if f5.monitor.exists(name):
+        # Add monitor to queue for creation
+        print "Marking monitor %s for creation" % name
+        monitor['operation'] = 'create'
+        return monitor
 
-            # Check if the monitor has changed
-            changed = f5.monitor.changed(monitor)
-            if (changed == 2):
-                if f5.monitor.test(monitor):
-                    print "Marking monitor %s for re-creation" % name
-                    monitor['operation'] = 'recreate'
-                    queue.append(monitor)
+    return None
 
-            elif (changed == 1):
+def sources():
+    """The monitor config files"""
 
-                # if the monitor is valid add it to the queue
-                # if the monitor is not valid this will fail and exit the script
-                if f5.monitor.test(monitor):
+    return sorted(glob.glob(os.path.join('monitors/', '*_health')))
 
-                    print "Marking monitor %s for modification" % name
-                    monitor['operation'] = 'modify'
-                    queue.append(monitor)
+def names():
+    """The names of the monitors the config files make"""
 
-            else:
-                print "No Changes made to %s" % name
-        else:
+    return [os.path.basename(infile) for infile in sources()]
+
+def owner(infile):
+    """The name of the monitor a config file makes"""
+
+    return os.path.basename(infile)
+
+@f5utility.stage('check monitors')
+def check(f5, only=None):
+    """Compare the monitor config files with the f5, or just those for the monitors
+    named in only, returns the queue of monitors to commit"""
+
+    print " "
+    print "------------------------------"
+    print " Checking Configuration"
+    print "------------------------------"
+    print " "
+
+    #Create empty queue for monitor create/changes
+    queue = []
+
+    monitor_files = [infile for infile in sources() if only is None or owner(infile) in only]
 
-            # Add monitor to queue for creation
-            print "Marking monitor %s for creation" % name
-            monitor['operation'] = 'create'
+    # Fetch the current properties of all our monitors from the f5 in one go
+    f5.monitor.snapshot([os.path.basename(infile) for infile in monitor_files])
+
+    # Each monitor is built, compared and tested independently, several at once
+    for monitor in f5.pipeline.run(lambda infile: check_monitor(f5, infile), monitor_files):
+        if monitor is not None:
             queue.append(monitor)
 
+    return queue
+
+@f5utility.stage('commit monitors')
+def commit(f5, queue):
+    """Commit the queued monitors to the f5, returns True if anything changed"""
 
     #Process the queue and commit changes to f5
     print " "
@@ -76,12 +104,72 @@ def main():
     if queue == []:
 
         print "No Changes to Commit."
+        return False
 
-    else:
-
-        for monitor in queue:
+    for monitor in queue:
+        with f5.tracer.span(monitor['monitor_template'].template_name):
             f5.monitor.commit(monitor)
 
+    return True
+
+def describe(f5, monitor):
+    """Lines saying what committing a queued monitor would change on the f5"""
+
+    template = monitor['monitor_template']
+    name = template.template_name
+    if monitor['operation'] == 'create':
+        return ["+ monitor %s (%s)" % (name, template.template_type)]
+
+    existing = f5.monitor.existing(name)
+    lines = ["~ monitor %s%s" % (name, monitor['operation'] == 'recreate' and ', recreated' or '')]
+    fields = [('type', template.template_type),
+              ('interval', monitor['common_attributes'].interval),
+              ('timeout', monitor['common_attributes'].timeout)]
+    if 'send_string_value' in monitor:
+        fields.extend([('send', monitor['send_string_value'].value),
+                       ('receive', monitor['receive_string_value'].value),
+                       ('username', monitor['username_string_value'].value),
+                       ('password', monitor['password_string_value'].value)])
+    for field, value in fields:
+        old = existing.get(field) or ''
+        if str(old) != str(value or ''):
+            if field == 'password':
+                old, value = '********', '********'
+            lines.append("    %s: %r -> %r" % (field, str(old), str(value)))
+    return lines
+
+def assume(f5, queue):
+    """Take the queued monitors as made, for the pools checked after them"""
+
+    for monitor in queue:
+        f5.inventory.add_monitor(monitor['monitor_template'].template_name,
+                                 monitor['monitor_template'].template_type)
+
+def dependants(queue):
+    """The pools to check again after committing the queue, the pools of new and recreated monitors"""
+
+    return [f5utility.swap_suffix('_pool', monitor['monitor_template'].template_name)
+            for monitor in queue if monitor['operation'] != 'modify']
+
+def creates(queue):
+    """The pool checks only look for their monitors in the inventory, which assume()
+    has filled in, so nothing needs the monitors on the f5 before the commit"""
+
+    return False
+
+def main():
+
+    """Create Monitors from config files"""
+
+    #Create Connection to the f5
+    f5 = f5utility.f5Connection()
+
+    # Check outside of any transaction, the tests make their own temporary changes
+    queue = check(f5)
+    if queue == []:
+        commit(f5, queue)
+    elif f5.transaction.apply(commit, f5, queue):
+
         print " "
         print "------------------------------"
         print " Syncing Changes"
@@ -95,11 +183,5 @@ def main():
     print "done."
 
 if __name__ == "__main__":
-    try:
-        with open(os.devnull,'wb') as devnull:
-            subprocess.check_call(["/usr/bin/cvs","diff","monitors"],stdout=devnull,stderr=devnull)
-    except subprocess.CalledProcessError:
-        print "Changes have not been committed to cvs.  Run 'cvs diff' confirm the changes and then commit them"
-        sys.exit(1)
+    f5utility.check_cvs(["monitors"])
     main()
-
@@ -6,19 +6,69 @@ import os
 import sys
 import f5utility
 import logging
-import subprocess
-from time import sleep
 
-def main():
+def check_pool(f5, infile):
+    """Build a pool from its config file and compare it with the f5,
+    returns the pool if it needs committing, otherwise None"""
 
-    """Create pools from pool config files"""
+    #Build a pool from the config file and check that its valid
+    pool = f5.pool.build(infile)
 
-    #Set directory for pool conf files
-    src_dir = 'pools/'
+    name = pool['name']
+    
+    # Check if the pool already exists
+    if f5.pool.exists(name):
 
-    #Create Connection to the f5
-    f5 = f5utility.f5Connection()
+        # Check if the pool has changed
+        if f5.pool.changed(pool):
+
+            # if the pool is valid add it to the queue
+            # if the pool is not valid this will fail and exit the script
+            if f5.pool.test(pool):
+
+                print "Marking pool %s for modification" % name
+                pool['operation'] = 'modify'
+                return pool
+
+        else:
+            print "No Changes made to %s" % name
+    else:
+        # Check if there is a monitor available for the pool, exit if not.
+        monitor_name = f5utility.swap_suffix("_health", name)
+        if f5.monitor.exists(monitor_name):
+
+            # Add pool to queue for creation
+            print "Marking pool %s for creation" % name
+            pool['operation'] = 'create'
+            return pool
+
+        else:
+            print "NO Monitor exists for %s ... STOPPING!" % name
+            sys.exit("exit.")
+
+    return None
+
+def sources():
+    """The pool config files"""
+
+    return sorted(glob.glob(os.path.join('pools/', '*_pool')))
+
+def names():
+    """The names of the pools the config files make"""
+
+    return [os.path.basename(infile) for infile in sources()]
 
+def owner(infile):
+    """The name of the pool a config file makes"""
+
+    return os.path.basename(infile)
+
+@f5utility.stage('check pools')
+def check(f5, only=None):
+    """Compare the pool config files with the f5, or just those for the pools
+    named in only, returns the queue of pools to commit"""
+
+    #Set directory for pool conf files
     print " "
     print "------------------------------"
     print " Checking Configuration"
@@ -28,43 +78,23 @@ def main():
     #Create empty queue for pool create/changes
     queue = []
 
-    for infile in sorted(glob.glob(os.path.join(src_dir, '*_pool'))):
-
-        #Build a pool from the config file and check that its valid
-        pool = f5.pool.build(infile)
+    pool_files = [infile for infile in sources() if only is None or owner(infile) in only]
 
-        name = pool['name']
-        
-        # Check if the pool already exists
-        if f5.pool.exists(name):
+    # Look up all the member hostnames up front, then fetch the current
+    # state of all our pools from the f5 in one go
+    f5.pool.resolve(pool_files)
+    f5.pool.snapshot([os.path.basename(infile) for infile in pool_files])
 
-            # Check if the pool has changed
-            if f5.pool.changed(pool):
+    # Each pool is built, compared and tested independently, several at once
+    for pool in f5.pipeline.run(lambda infile: check_pool(f5, infile), pool_files):
+        if pool is not None:
+            queue.append(pool)
 
-                # if the pool is valid add it to the queue
-                # if the pool is not valid this will fail and exit the script
-                if f5.pool.test(pool):
-
-                    print "Marking pool %s for modification" % name
-                    pool['operation'] = 'modify'
-                    queue.append(pool)
-
-            else:
-                print "No Changes made to %s" % name
-        else:
-            # Check if there is a monitor available for the pool, exit if not.
-            monitor_name = f5utility.swap_suffix("_health", name)
-            if f5.monitor.exists(monitor_name):
-
-                # Add pool to queue for creation
-                print "Marking pool %s for creation" % name
-                pool['operation'] = 'create'
-                queue.append(pool)
-
-            else:
-                print "NO Monitor exists for %s ... STOPPING!" % name
-                sys.exit("exit.")
+    return queue
 
+@f5utility.stage('commit pools')
+def commit(f5, queue):
+    """Commit the queued pools to the f5, returns True if anything changed"""
 
     #Process the queue and commit changes to f5
     print " "
@@ -77,12 +107,60 @@ def main():
     if queue == []:
 
         print "No Changes to Commit."
+        return False
 
-    else:
+    f5.pool.commit_all(queue)
+
+    return True
+
+def describe(f5, pool):
+    """Lines saying what committing a queued pool would change on the f5"""
+
+    name = pool['name']
+    new_sockets = f5.pool.member_sockets(pool['members'])
+    if pool['operation'] == 'create':
+        return ["+ pool %s (%s): %s" % (name, pool['method'], ', '.join(new_sockets))]
+
+    existing = f5.pool.existing(name)
+    lines = ["~ pool %s" % name]
+    if str(pool['method']) != existing['method']:
+        lines.append("    method: %s -> %s" % (existing['method'], pool['method']))
+    for sock in new_sockets:
+        if sock not in existing['members']:
+            lines.append("    + %s" % sock)
+    for sock in existing['members']:
+        if sock not in new_sockets:
+            lines.append("    - %s" % sock)
+    return lines
+
+def assume(f5, queue):
+    """The rules are validated on the f5 itself, so new pools have to be committed
+    before them, see creates()"""
+
+    pass
+
+def dependants(queue):
+    """The rules only name pools, so none of them need checking again"""
 
-        for pool in queue:
-            f5.pool.commit(pool)
-            sleep(5)
+    return []
+
+def creates(queue):
+    """Checks if committing the queue creates pools the rules have to be validated against"""
+
+    return [pool for pool in queue if pool['operation'] == 'create'] != []
+
+def main():
+
+    """Create pools from pool config files"""
+
+    #Create Connection to the f5
+    f5 = f5utility.f5Connection()
+
+    # Check outside of any transaction, the tests make their own temporary changes
+    queue = check(f5)
+    if queue == []:
+        commit(f5, queue)
+    elif f5.transaction.apply(commit, f5, queue):
 
         print " "
         print "------------------------------"
@@ -97,10 +175,5 @@ def main():
     print "done."
 
 if __name__ == "__main__":
-    try:
-        with open(os.devnull,'wb') as devnull:
-            subprocess.check_call(["/usr/bin/cvs","diff","pools"],stdout=devnull,stderr=devnull)
-    except subprocess.CalledProcessError:
-        print "Changes have not been committed to cvs.  Run 'cvs diff' confirm the changes and then commit them"
-        sys.exit(1)
+    f5utility.check_cvs(["pools"])
     main()
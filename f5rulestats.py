@@ -0,0 +1,70 @@
+#!/usr/bin/env python26
+"""Report the timing statistics of the generated iRules"""
+
+import os
+import sys
+import time
+import f5utility
+
+def rule_names():
+    """The rules f5irule_deploy.py builds, one per subdirectory of ./irules"""
+
+    names = []
+    for dirs in sorted(os.listdir('./irules')):
+        if dirs != 'CVS' and os.path.isdir('./irules/' + dirs):
+            names.append(dirs + '_rule')
+    return names
+
+def report(rows, since):
+    """Print the comparison from f5utility.compare_rule_statistics"""
+
+    print "%-20s %-16s %12s %14s %14s %8s %8s %8s" % ('Rule', 'Event', 'Executions', 'Avg cycles', 'Avg since', 'Change',
+                                                      'Failures', 'Aborts')
+    for rule, event, executions, old_avg, new_avg, failures, aborts in rows:
+        change = ''
+        if old_avg and new_avg is not None:
+            change = '%+.1f%%' % ((new_avg - old_avg) * 100.0 / old_avg)
+        if old_avg is None:
+            old_avg = '-'
+        if new_avg is None:
+            new_avg = '-'
+        print "%-20s %-16s %12d %14s %14s %8s %8d %8d" % (rule, event, executions, old_avg, new_avg, change,
+                                                          failures, aborts)
+    print " "
+    for line in since:
+        print "Compared against the snapshot taken %s" % line
+
+def main():
+    """Snapshot the rule statistics and compare them with the last snapshot taken by a deploy,
+    or with the last snapshot of any kind with --last"""
+
+    label = 'deploy'
+    args = sys.argv[1:]
+    if '--last' in args:
+        args.remove('--last')
+        label = None
+    if args == []:
+        args = rule_names()
+
+    #Create Connection to the f5
+    f5 = f5utility.f5Connection()
+
+    previous = f5.rule_stats.history(label)
+    snapshot = f5.rule_stats.record(args, 'report')
+
+    # Each rule is compared with the latest snapshot it is in, a deploy only snapshots the rules it replaces
+    before, reset, taken = f5utility.rule_baselines(previous, args)
+
+    since = []
+    for rule in args:
+        if rule not in taken:
+            since.append('never, no earlier snapshot, for %s' % rule)
+        else:
+            since.append('%s (%s) for %s' % (time.strftime("%a, %d %b %Y %H:%M:%S",
+                                                            time.localtime(taken[rule]['time'])),
+                                             taken[rule]['label'], rule))
+
+    report(f5utility.compare_rule_statistics(before, snapshot['rules'], reset), since)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python26
+"""Analysis and compilation of the vhost switch in the generated iRules
+
+The files under irules/<dir>/ are pattern/body pairs for a switch -glob on
+[HTTP::host].  This splits them into cases so that hostnames which only
+pick a pool can be moved into a data group and looked up with class match,
+cases that an earlier pattern always beats can be reported, and the busiest
+files can be moved up the switch without changing which case wins.
+"""
+
+import re
+import f5lint
+
+# Tcl string match patterns are compiled once
+_globs = {}
+
+def glob_regex(pattern):
+    """Returns a compiled regex matching the same strings as a Tcl string match pattern"""
+
+    if pattern in _globs:
+        return _globs[pattern]
+
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '*':
+            regex.append('.*')
+        elif char == '?':
+            regex.append('.')
+        elif char == '\\' and index + 1 < len(pattern):
+            index += 1
+            regex.append(re.escape(pattern[index]))
+        elif char == '[' and pattern.find(']', index + 1) != -1:
+            close = pattern.find(']', index + 1)
+            regex.append('[%s]' % ''.join([c in '\\^[]' and '\\' + c or c for c in pattern[index + 1:close]]))
+            index = close
+        else:
+            regex.append(re.escape(char))
+        index += 1
+
+    _globs[pattern] = re.compile('^%s$' % ''.join(regex), re.DOTALL)
+    return _globs[pattern]
+
+def glob_match(pattern, string):
+    """Tcl's string match"""
+
+    return glob_regex(pattern).match(string) is not None
+
+def is_literal(pattern):
+    """Checks if a glob pattern only matches itself"""
+
+    for char in '*?[\\':
+        if char in pattern:
+            return False
+    return True
+
+
+class Case:
+    """A single pattern and its body from a switch"""
+
+    def __init__(self, pattern, body, infile, line):
+        self.pattern = pattern
+        self.body = body
+        self.infile = infile
+        self.line = line
+
+    def fallthrough(self):
+        """Checks if this pattern shares the body of the next one"""
+        return self.body == '-'
+
+    def pool(self):
+        """Returns the pool if all the body does is pick one, otherwise None"""
+
+        if self.fallthrough():
+            return None
+        commands = f5lint.commands(self.body)
+        if len(commands) == 1 and len(commands[0]) == 2 and commands[0][0] == 'pool':
+            pool = commands[0][1]
+            # A pool chosen at run time can't go in a data group
+            if '$' not in pool and '[' not in pool:
+                return pool
+        return None
+
+
+def parse_cases(text, infile='<rule>'):
+    """Split a file of switch cases into a list of Cases"""
+
+    linter = f5lint.Linter(text, infile)
+    words = linter.list_words(0, len(text))
+
+    cases = []
+    for index in range(0, len(words) - 1, 2):
+        pattern = words[index]
+        body = words[index + 1]
+        line = 1 + text.count('\n', 0, pattern.start)
+        cases.append(Case(linter.literal(pattern), linter.literal(body), infile, line))
+
+    return cases
+
+def compile_hosts(fragments):
+    """Split the (file, lines) fragments into a hostname to pool map for a data group,
+    and the fragments that still need the switch.
+
+    A file is only moved into the data group if every case in it is a literal hostname
+    that just picks a pool, and no earlier case in the switch would have matched it first,
+    so looking the hostname up before the switch gives exactly the same pool."""
+
+    host_pools = {}
+    remaining = []
+    earlier = []
+
+    for fragment in fragments:
+        infile, lines = fragment
+        cases = parse_cases(''.join(lines), infile)
+
+        compiled = {}
+        for case in cases:
+            pool = case.pool()
+            if pool is None or not is_literal(case.pattern) or case.pattern in compiled:
+                compiled = None
+                break
+            for previous in earlier:
+                if glob_match(previous.pattern, case.pattern):
+                    compiled = None
+                    break
+            if compiled is None:
+                break
+            compiled[case.pattern] = pool
+
+        if compiled:
+            host_pools.update(compiled)
+        else:
+            remaining.append(fragment)
+        earlier.extend(cases)
+
+    return host_pools, remaining
+
+def tokens(pattern):
+    """Split a glob pattern into '*' and the set of characters each other position can match,
+    None standing for any character"""
+
+    result = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '*':
+            # Runs of stars match the same as one
+            if result == [] or result[-1] != '*':
+                result.append('*')
+        elif char == '?':
+            result.append(None)
+        elif char == '\\' and index + 1 < len(pattern):
+            index += 1
+            result.append(frozenset(pattern[index]))
+        elif char == '[' and pattern.find(']', index + 1) != -1:
+            close = pattern.find(']', index + 1)
+            body = pattern[index + 1:close]
+            chars = set()
+            position = 0
+            while position < len(body):
+                if position + 2 < len(body) and body[position + 1] == '-':
+                    low, high = sorted([body[position], body[position + 2]])
+                    chars.update([chr(code) for code in range(ord(low), ord(high) + 1)])
+                    position += 3
+                else:
+                    chars.add(body[position])
+                    position += 1
+            result.append(frozenset(chars))
+            index = close
+        else:
+            result.append(frozenset(char))
+        index += 1
+
+    return result
+
+def subsumes(pattern, other):
+    """Checks if every hostname other matches is also matched by pattern"""
+
+    if is_literal(other):
+        return glob_match(pattern, other)
+    if is_literal(pattern):
+        return False
+
+    outer = tokens(pattern)
+    inner = tokens(other)
+    seen = {}
+
+    def covers(i, j):
+        """Can outer[i:] match everything inner[j:] matches"""
+        if (i, j) in seen:
+            return seen[(i, j)]
+        seen[(i, j)] = False
+        if i == len(outer):
+            result = j == len(inner)
+        elif outer[i] == '*':
+            # The star takes nothing, or swallows the next position of inner, whatever it is
+            result = covers(i + 1, j) or (j < len(inner) and covers(i, j + 1))
+        elif j == len(inner) or inner[j] == '*':
+            result = False
+        elif outer[i] is None:
+            result = covers(i + 1, j + 1)
+        else:
+            result = inner[j] is not None and inner[j] <= outer[i] and covers(i + 1, j + 1)
+        seen[(i, j)] = result
+        return result
+
+    return covers(0, 0)
+
+def overlaps(pattern, other):
+    """Checks if any hostname could be matched by both patterns"""
+
+    if is_literal(pattern):
+        return glob_match(other, pattern)
+    if is_literal(other):
+        return glob_match(pattern, other)
+
+    first = tokens(pattern)
+    second = tokens(other)
+    seen = {}
+
+    def meet(i, j):
+        """Can first[i:] and second[j:] match a common string"""
+        if (i, j) in seen:
+            return seen[(i, j)]
+        seen[(i, j)] = False
+        if i == len(first) and j == len(second):
+            result = True
+        elif i < len(first) and first[i] == '*':
+            result = meet(i + 1, j) or (j < len(second) and second[j] != '*' and meet(i, j + 1))
+            if not result and j < len(second) and second[j] == '*':
+                result = meet(i, j + 1)
+        elif j < len(second) and second[j] == '*':
+            result = meet(i, j + 1) or (i < len(first) and meet(i + 1, j))
+        elif i == len(first) or j == len(second):
+            result = False
+        else:
+            common = first[i] is None or second[j] is None or len(first[i] & second[j]) > 0
+            result = common and meet(i + 1, j + 1)
+        seen[(i, j)] = result
+        return result
+
+    return meet(0, 0)
+
+def analyse(fragments):
+    """Look for cases that can never match because an earlier case always matches first.
+    Returns a list of (file, line, message) warnings"""
+
+    warnings = []
+    literals = {}
+    wildcards = []
+
+    for infile, lines in fragments:
+        for case in parse_cases(''.join(lines), infile):
+            if case.pattern in literals:
+                first = literals[case.pattern]
+                warnings.append((case.infile, case.line, 'duplicate of "%s" at %s:%d, never matched' %
+                                 (case.pattern, first.infile, first.line)))
+                continue
+
+            for earlier in wildcards:
+                if subsumes(earlier.pattern, case.pattern):
+                    warnings.append((case.infile, case.line, '"%s" is shadowed by "%s" at %s:%d, never matched' %
+                                     (case.pattern, earlier.pattern, earlier.infile, earlier.line)))
+                    break
+
+            if is_literal(case.pattern):
+                literals[case.pattern] = case
+            else:
+                wildcards.append(case)
+
+    return warnings
+
+def read_profile(profile_file):
+    """Reads a request frequency profile, lines of 'hostname count'"""
+
+    profile = {}
+    for line in open(profile_file, 'r'):
+        fields = line.split()
+        if len(fields) == 2 and not fields[0].startswith('#'):
+            profile[fields[0]] = profile.get(fields[0], 0) + int(fields[1])
+
+    return profile
+
+def reorder(fragments, profile):
+    """Move the files holding the busiest hostnames up the switch.
+
+    A file only ever moves ahead of files none of whose patterns overlap any of its own,
+    so whichever case matched a hostname before is still the first to match it."""
+
+    units = []
+    for fragment in fragments:
+        units.append([fragment, parse_cases(''.join(fragment[1]), fragment[0]), 0])
+
+    # Each hostname's requests count towards the file holding the case that matches it first
+    for host, count in profile.items():
+        for unit in units:
+            if [case for case in unit[1] if glob_match(case.pattern, host)] != []:
+                unit[2] += count
+                break
+
+    def disjoint(first, second):
+        for case in first[1]:
+            for other in second[1]:
+                if overlaps(case.pattern, other.pattern):
+                    return False
+        return True
+
+    ordered = []
+    for unit in units:
+        position = len(ordered)
+        while position > 0 and ordered[position - 1][2] < unit[2] and disjoint(ordered[position - 1], unit):
+            position -= 1
+        ordered.insert(position, unit)
+
+    return [unit[0] for unit in ordered]
@@ -1,6 +1,5 @@
 #!/bin/bash
 
 # This script MUST be run from within this directory or it will not work. To fix this, change to use absolute paths
-./f5monitor_deploy.py
-./f5pool_deploy.py
-./f5irule_deploy.py
+# Monitors, pools and irules are deployed in one process over one connection, with a single sync at the end
+./f5deploy.py
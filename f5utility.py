@@ -9,13 +9,636 @@ import sys
 import copy
 import logging
 import suds
+import suds.plugin
+import atexit
 from socket import gethostname
 import pycontrol.pycontrol as pc
+from suds.cache import ObjectCache
 from time import strftime, localtime
 import pprint
+import base64
+import shutil
+import tempfile
+import urllib2
+import threading
+import time
+import hashlib
+import subprocess
+import f5lint
+import f5switch
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 DEBUG = 0
 
+# All the iControl interfaces used by these scripts, loaded once per session
+WSDLS = ['LocalLB.Pool', 'LocalLB.PoolMember', 'LocalLB.Monitor', 'LocalLB.Rule', 'LocalLB.Class',
+         'System.ConfigSync']
+
+# Bump this if the layout of the wsdl cache ever changes
+CACHE_FORMAT = 1
+
+# Open sessions to the f5, keyed by config file
+_sessions = {}
+
+class BIGIP(pc.BIGIP):
+    """BIGIP connection which fetches wsdls over the configured protocol, not always https"""
+
+    def _set_url(self, wsdl):
+        """pycontrol hardcodes https for wsdls from the f5"""
+        if self.fromurl:
+            return '%s://%s%s?WSDL=%s' % (self.proto, self.hostname, pc.ICONTROL_URI, wsdl)
+        return pc.BIGIP._set_url(self, wsdl)
+
+class CachedBIGIP(BIGIP):
+    """BIGIP connection which parses wsdls through our own object cache"""
+
+    def _get_suds_client(self, url, **kw):
+        """Make sure suds uses our cache when first loading the wsdl"""
+        kw['cache'] = self.cache
+        return pc.BIGIP._get_suds_client(self, url, **kw)
+
+def wsdl_cache_dir(config):
+    """Returns the wsdl cache directory for the configured f5, or None if caching is off"""
+
+    directory = config_option(config, 'Cache', 'directory', '')
+    if not directory:
+        return None
+
+    return os.path.join(directory, 'v%d' % CACHE_FORMAT, config.get('LoadBalancer', 'hostname'))
+
+def fetch_wsdl(config, wsdl):
+    """Download a single wsdl from the f5"""
+
+    url = '%s://%s%s?WSDL=%s' % (config_option(config, 'LoadBalancer', 'proto', 'https'),
+                                 config.get('LoadBalancer', 'hostname'), pc.ICONTROL_URI, wsdl)
+    credentials = '%s:%s' % (config.get('LoadBalancer', 'username'), config.get('LoadBalancer', 'password'))
+
+    request = urllib2.Request(url)
+    request.add_header('Authorization', 'Basic %s' % base64.b64encode(credentials))
+    response = urllib2.urlopen(request)
+    try:
+        return response.read()
+    finally:
+        response.close()
+
+def store_wsdls(config, host_dir, version, wsdls=WSDLS):
+    """Save the f5's wsdls into the cache under its BIG-IP version"""
+
+    if not os.path.isdir(host_dir):
+        os.makedirs(host_dir)
+
+    # Write into a scratch directory and move it into place so a half written cache is never used
+    scratch = tempfile.mkdtemp(dir=host_dir)
+    try:
+        for wsdl in wsdls:
+            wsdl_file = open(os.path.join(scratch, wsdl + '.wsdl'), 'w')
+            wsdl_file.write(fetch_wsdl(config, wsdl))
+            wsdl_file.close()
+
+        version_dir = os.path.join(host_dir, version)
+        if os.path.isdir(version_dir):
+            shutil.rmtree(version_dir)
+        os.rename(scratch, version_dir)
+    except:
+        shutil.rmtree(scratch, True)
+        raise
+
+    version_file = open(os.path.join(host_dir, 'version'), 'w')
+    version_file.write(version)
+    version_file.close()
+
+def cached_version(host_dir, wsdls=WSDLS):
+    """Returns the BIG-IP version the wsdl cache was last filled from, or None"""
+
+    try:
+        version_file = open(os.path.join(host_dir, 'version'), 'r')
+    except IOError:
+        return None
+    version = version_file.read().strip()
+    version_file.close()
+
+    # Only trust the cache if every wsdl we need is in it
+    for wsdl in wsdls:
+        if not os.path.isfile(os.path.join(host_dir, version, wsdl + '.wsdl')):
+            return None
+
+    return version
+
+def device_version(connection):
+    """Returns the BIG-IP version of the f5 a connection is to, asking it only once"""
+
+    if getattr(connection, 'bigip_version', None) is None:
+        connection.bigip_version = connection.LocalLB.Pool.get_version()
+
+    return connection.bigip_version
+
+class Governor:
+    """Schedules every iControl call, so that we go easy on the f5.
+
+    At most limit calls are in flight at once and no more than rate start each second.
+    The limit adapts to how the f5 is coping: it creeps up by one per limit calls answered
+    within target_latency, and is halved by a slow answer or one that never arrived."""
+
+    def __init__(self, config):
+        """Read the limits from the [Governor] section of the config"""
+
+        self.max_inflight = int(config_option(config, 'Governor', 'max_inflight', 4))
+        self.rate = float(config_option(config, 'Governor', 'rate', 20))
+        self.target_latency = float(config_option(config, 'Governor', 'target_latency', 2))
+
+        self.limit = float(self.max_inflight)
+        self.inflight = 0
+        # Token bucket holding up to a second's worth of calls
+        self.tokens = max(self.rate, 1)
+        self.stamp = time.time()
+        self.calls = 0
+        self.backoffs = 0
+        self.lock = threading.Condition()
+
+    def acquire(self):
+        """Wait for a slot and a token"""
+
+        self.lock.acquire()
+        try:
+            while True:
+                now = time.time()
+                if self.rate > 0:
+                    self.tokens = min(max(self.rate, 1), self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+
+                if self.inflight < int(self.limit):
+                    if self.rate <= 0 or self.tokens >= 1:
+                        break
+                    self.lock.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.lock.wait(1)
+
+            self.inflight += 1
+            self.calls += 1
+            if self.rate > 0:
+                self.tokens -= 1
+        finally:
+            self.lock.release()
+
+    def release(self, latency, failed):
+        """Give the slot back and adjust the limit by how the call went"""
+
+        self.lock.acquire()
+        try:
+            self.inflight -= 1
+            if failed or latency > self.target_latency:
+                self.limit = max(1.0, self.limit / 2)
+                self.backoffs += 1
+            else:
+                self.limit = min(float(self.max_inflight), self.limit + 1 / self.limit)
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def wrap(self, method):
+        """Returns method with every call going through the governor"""
+
+        def governed(*args, **kwargs):
+            self.acquire()
+            started = time.time()
+            failed = True
+            try:
+                result = method(*args, **kwargs)
+                failed = False
+            except suds.WebFault:
+                # The f5 answered, it just didn't like what we asked
+                failed = False
+                raise
+            finally:
+                self.release(time.time() - started, failed)
+            return result
+
+        # pycontrol hangs these off each method for reference
+        governed.params = getattr(method, 'params', None)
+        governed.response_type = getattr(method, 'response_type', None)
+        return governed
+
+def govern(connection, governor):
+    """Route every method of every interface on the connection through the governor"""
+
+    for client in connection.clients:
+        module = connection._get_module_object(client)
+        interface = connection._get_interface_object(client, module)
+        for method in connection._get_methods(client):
+            setattr(interface, method, governor.wrap(getattr(interface, method)))
+    connection.governor = governor
+
+class Transaction:
+    """Groups the changes made over a connection into a single iControl transaction,
+    so that the f5 applies all of them or none"""
+
+    def __init__(self, connection, enabled):
+        self.connection = connection
+        self.enabled = enabled
+        self.open = False
+        self.deferred = []
+
+    def defer(self, function, *args):
+        """Run function now, or once the transaction is submitted if one is open.
+        Anything that waits on the f5 to act on a change has to go through here"""
+
+        if self.open:
+            self.deferred.append((function, args))
+        else:
+            function(*args)
+
+    def apply(self, function, *args):
+        """Returns function(*args), with every change it makes in one transaction if they're enabled"""
+
+        if not self.enabled:
+            return function(*args)
+
+        session = self.connection.System.Session
+        session.start_transaction()
+        self.open = True
+        try:
+            result = function(*args)
+        except:
+            failure = sys.exc_info()
+            self.open = False
+            self.deferred = []
+            print "Rolling back the transaction, nothing was changed"
+            try:
+                session.rollback_transaction()
+            except suds.WebFault as detail:
+                print "Rollback failed: %s" % detail
+            raise failure[0], failure[1], failure[2]
+
+        print "Submitting the transaction"
+        try:
+            session.submit_transaction()
+        except suds.WebFault as detail:
+            self.open = False
+            self.deferred = []
+            sys.exit("Transaction failed, nothing was changed: %s" % detail)
+        self.open = False
+
+        deferred = self.deferred
+        self.deferred = []
+        for later, later_args in deferred:
+            later(*later_args)
+
+        return result
+
+class Span:
+    """A stretch of a run, such as a stage or one object, that iControl calls are grouped under"""
+
+    def __init__(self, tracer, name, parent=None):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.record = None
+
+    def start(self):
+        """Open the span in this thread, nested in the current span unless given a parent"""
+
+        if self.tracer.enabled:
+            self.record = self.tracer.open_span(self.name, self.parent)
+        return self
+
+    def stop(self, error=None):
+        """Close the span"""
+
+        if self.record is not None:
+            self.tracer.close_span(self.record, error)
+            self.record = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, kind, value, traceback):
+        if value is not None:
+            self.stop(str(value) or kind.__name__)
+        else:
+            self.stop()
+        return False
+
+class TracePlugin(suds.plugin.MessagePlugin):
+    """Notes the size of each SOAP envelope, suds sends and receives on the calling thread"""
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def sending(self, context):
+        self.tracer.local.sent = len(str(context.envelope))
+
+    def received(self, context):
+        self.tracer.local.received = len(str(context.reply))
+
+class Tracer:
+    """Records every iControl call, with its latency, payload and the span it was made in"""
+
+    def __init__(self, config):
+        self.summary = config_option(config, 'Trace', 'summary', 'no').lower() in ('yes', 'true', 'on', '1')
+        self.output = config_option(config, 'Trace', 'output', '')
+        self.format = config_option(config, 'Trace', 'format', 'json')
+        self.enabled = self.summary or self.output != ''
+
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # The stack of open spans, and the size of the last call's envelopes, per thread
+        self.local = threading.local()
+        self.spans = []
+        self.calls = []
+
+    def span(self, name, parent=None):
+        """Returns a Span to use with the with statement"""
+
+        return Span(self, name, parent)
+
+    def current(self):
+        """The innermost span open in this thread, or None"""
+
+        stack = getattr(self.local, 'spans', None)
+        if not stack:
+            return None
+        return stack[-1]
+
+    def open_span(self, name, parent=None):
+        if parent is None:
+            parent = self.current()
+        parent_id = None
+        if parent is not None:
+            parent_id = parent['id']
+        self.lock.acquire()
+        try:
+            record = {'id': len(self.spans), 'name': name, 'parent': parent_id,
+                      'thread': threading.currentThread().getName(), 'start': time.time() - self.started,
+                      'end': None, 'error': None}
+            self.spans.append(record)
+        finally:
+            self.lock.release()
+
+        if getattr(self.local, 'spans', None) is None:
+            self.local.spans = []
+        self.local.spans.append(record)
+        return record
+
+    def close_span(self, record, error=None):
+        record['end'] = time.time() - self.started
+        record['error'] = error
+        if record in self.local.spans:
+            self.local.spans.remove(record)
+
+    def wrap(self, name, method):
+        """Returns method with every call recorded"""
+
+        def traced(*args, **kwargs):
+            self.local.sent = 0
+            self.local.received = 0
+            started = time.time()
+            error = None
+            try:
+                return method(*args, **kwargs)
+            except:
+                error = str(sys.exc_info()[1]).split('\n')[-1].strip() or sys.exc_info()[0].__name__
+                raise
+            finally:
+                finished = time.time()
+                # Array calls are per object, so note how many objects each one was about
+                lists = [len(arg) for arg in list(args) + kwargs.values() if isinstance(arg, (list, tuple))]
+                span = self.current()
+                if span is not None:
+                    span = span['id']
+                self.lock.acquire()
+                try:
+                    self.calls.append({'method': name, 'objects': max(lists + [0]),
+                                       'start': started - self.started, 'duration': finished - started,
+                                       'sent': self.local.sent, 'received': self.local.received, 'error': error,
+                                       'span': span,
+                                       'thread': threading.currentThread().getName()})
+                finally:
+                    self.lock.release()
+
+        # pycontrol hangs these off each method for reference
+        traced.params = getattr(method, 'params', None)
+        traced.response_type = getattr(method, 'response_type', None)
+        return traced
+
+    def finish(self):
+        """Print the summary and write the trace, whichever are configured"""
+
+        if self.summary:
+            self.print_summary()
+        if self.output != '':
+            output = open(self.output, 'w')
+            if self.format == 'chrome':
+                json.dump(self.chrome_trace(), output)
+            else:
+                json.dump({'spans': self.spans, 'calls': self.calls}, output, indent=1)
+            output.close()
+            print "Trace of %d iControl calls written to %s" % (len(self.calls), self.output)
+
+    def totals(self):
+        """Calls made and time spent in them under each span, including the spans inside it"""
+
+        totals = {}
+        for call in self.calls:
+            span_id = call['span']
+            while span_id is not None:
+                count, spent = totals.get(span_id, (0, 0))
+                totals[span_id] = (count + 1, spent + call['duration'])
+                span_id = self.spans[span_id]['parent']
+        return totals
+
+    def print_summary(self):
+        """Print where the time went, by method, by stage and by slowest object"""
+
+        methods = {}
+        for call in self.calls:
+            entry = methods.setdefault(call['method'], {'calls': 0, 'objects': 0, 'time': 0, 'max': 0,
+                                                       'sent': 0, 'received': 0, 'errors': 0})
+            entry['calls'] += 1
+            entry['objects'] += call['objects']
+            entry['time'] += call['duration']
+            entry['max'] = max(entry['max'], call['duration'])
+            entry['sent'] += call['sent']
+            entry['received'] += call['received']
+            if call['error'] is not None:
+                entry['errors'] += 1
+
+        print " "
+        print "%-50s %6s %8s %9s %8s %8s %9s %9s %6s" % ('Method', 'Calls', 'Objects', 'Total s', 'Mean ms',
+                                                      'Max ms', 'KB sent', 'KB recv', 'Errors')
+        for name, entry in sorted(methods.items(), key=lambda item: -item[1]['time']):
+            print "%-50s %6d %8d %9.2f %8.1f %8.1f %9.1f %9.1f %6d" % (
+                name, entry['calls'], entry['objects'], entry['time'], 1000 * entry['time'] / entry['calls'],
+                1000 * entry['max'], entry['sent'] / 1024.0, entry['received'] / 1024.0, entry['errors'])
+
+        totals = self.totals()
+        parents = set([span['parent'] for span in self.spans if span['parent'] is not None])
+
+        def depth(span):
+            level = 0
+            while span['parent'] is not None:
+                span = self.spans[span['parent']]
+                level += 1
+            return level
+
+        # Stages are the spans with others inside them, objects the spans without
+        print " "
+        print "%-50s %9s %6s %9s" % ('Stage', 'Wall s', 'Calls', 'In calls')
+        for span in self.spans:
+            if span['id'] in parents or span['parent'] is None:
+                count, spent = totals.get(span['id'], (0, 0))
+                print "%-50s %9.2f %6d %9.2f" % (('  ' * depth(span) + span['name'])[:50],
+                                                 (span['end'] or 0) - span['start'], count, spent)
+
+        objects = [span for span in self.spans if span['id'] not in parents and span['parent'] is not None
+                   and span['end'] is not None]
+        if objects != []:
+            print " "
+            print "%-50s %9s %6s %9s" % ('Slowest objects', 'Wall s', 'Calls', 'In calls')
+            for span in sorted(objects, key=lambda span: span['start'] - span['end'])[:10]:
+                count, spent = totals.get(span['id'], (0, 0))
+                print "%-50s %9.2f %6d %9.2f" % (span['name'][:50], span['end'] - span['start'], count, spent)
+
+    def chrome_trace(self):
+        """The spans and calls as complete events for chrome://tracing or Perfetto"""
+
+        threads = {}
+        events = []
+        for kind, records in (('span', self.spans), ('icontrol', self.calls)):
+            for record in records:
+                tid = threads.setdefault(record['thread'], len(threads) + 1)
+                if kind == 'span':
+                    name = record['name']
+                    duration = (record['end'] or record['start']) - record['start']
+                    args = {'error': record['error']}
+                else:
+                    name = record['method']
+                    duration = record['duration']
+                    args = {'objects': record['objects'], 'sent': record['sent'],
+                            'received': record['received'], 'error': record['error']}
+                events.append({'name': name, 'cat': kind, 'ph': 'X', 'pid': 1, 'tid': tid,
+                               'ts': int(record['start'] * 1000000), 'dur': int(duration * 1000000),
+                               'args': args})
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def trace(connection, tracer):
+    """Record every call made through the connection, if tracing is configured"""
+
+    if tracer.enabled:
+        for client in connection.clients:
+            module = connection._get_module_object(client)
+            interface = connection._get_interface_object(client, module)
+            for method in connection._get_methods(client):
+                name = '%s.%s' % (client.sd[0].service.name, method)
+                setattr(interface, method, tracer.wrap(name, getattr(interface, method)))
+            client.set_options(plugins=[TracePlugin(tracer)])
+        atexit.register(tracer.finish)
+    connection.tracer = tracer
+
+def stage(name):
+    """Decorator running a deploy stage, a function taking the f5Connection first, in a span"""
+
+    def decorate(function):
+        def in_span(f5, *args, **kwargs):
+            with f5.tracer.span(name):
+                return function(f5, *args, **kwargs)
+        in_span.__name__ = function.__name__
+        in_span.__doc__ = function.__doc__
+        return in_span
+    return decorate
+
+def connect(config_file='f5.cfg'):
+    """Connect to the load balancer, reusing the session if one is already open"""
+
+    if config_file in _sessions:
+        return _sessions[config_file]
+
+    # Set up config file
+    config = ConfigParser.ConfigParser()
+    config.read(config_file)
+
+    # Transactions need a session, which only BIG-IP 11 and later have
+    transactions = config_option(config, 'Deploy', 'transaction', 'no').lower() in ('yes', 'true', 'on', '1')
+    wsdls = list(WSDLS)
+    if transactions:
+        wsdls.append(pc.SESSION_WSDL)
+
+    # Only ever http when talking to f5fake.py
+    proto = config_option(config, 'LoadBalancer', 'proto', 'https')
+
+    # Loading the wsdls is timed as a span of its own, the calls are only traced once connected
+    tracer = Tracer(config)
+    loading = tracer.span('connect').start()
+
+    host_dir = wsdl_cache_dir(config)
+    version = None
+    if host_dir is not None:
+        version = cached_version(host_dir, wsdls)
+
+    connection = None
+    if version is not None:
+        # Load the wsdls and their parsed state from disk
+        version_dir = os.path.join(host_dir, version)
+        connection = CachedBIGIP(
+                            hostname=config.get('LoadBalancer', 'hostname'),
+                            username=config.get('LoadBalancer', 'username'),
+                            password=config.get('LoadBalancer', 'password'),
+                            directory=version_dir,
+                            cache=ObjectCache(location=os.path.join(version_dir, 'parsed'), days=365),
+                            proto=proto,
+                            sessions=transactions,
+                            wsdls=wsdls)
+
+        # If the f5 has been upgraded since, throw the cache away
+        connection.bigip_version = connection.LocalLB.Pool.get_version()
+        if connection.bigip_version.replace(os.sep, '_') != version:
+            print "BIG-IP version has changed, refreshing wsdl cache"
+            shutil.rmtree(version_dir, True)
+            connection = None
+
+    if connection is None:
+        # Connect to the F5 once, pulling down every wsdl we need
+        connection = BIGIP(
+                            hostname=config.get('LoadBalancer', 'hostname'),
+                            username=config.get('LoadBalancer', 'username'),
+                            password=config.get('LoadBalancer', 'password'),
+                            fromurl=True,
+                            proto=proto,
+                            sessions=transactions,
+                            wsdls=wsdls)
+
+        if host_dir is not None:
+            # Keep a copy for next time
+            version = device_version(connection).replace(os.sep, '_')
+            try:
+                store_wsdls(config, host_dir, version, wsdls)
+            except (IOError, OSError, urllib2.URLError) as detail:
+                print "Unable to cache wsdls: %s" % detail
+
+    loading.stop()
+
+    # Everything from here on is traced if asked, and paced to suit the f5.  The tracing
+    # goes inside the governor, so a call's time is the f5's and not the wait for a slot.
+    trace(connection, tracer)
+    govern(connection, Governor(config))
+    connection.transaction = Transaction(connection, transactions)
+
+    _sessions[config_file] = connection
+    return connection
+
+# Largest number of objects to ask the f5 about in a single array call
+CHUNK_SIZE = 100
+
+def chunks(items, size=CHUNK_SIZE):
+    """Splits a list into lists of at most size items"""
+
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 # changes the suffix on a string separated by _
 def swap_suffix(suffix, name):
     """Swaps suffix with specified name"""
@@ -25,51 +648,511 @@ def swap_suffix(suffix, name):
 
     return new_name
 
+def config_option(config, section, name, default):
+    """Returns an optional setting from the config, or the default if it isn't set"""
+
+    try:
+        return config.get(section, name)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
+
+def check_cvs(paths):
+    """Exit unless everything under the paths has been committed to cvs"""
+
+    try:
+        with open(os.devnull,'wb') as devnull:
+            subprocess.check_call(["/usr/bin/cvs","diff"] + paths,stdout=devnull,stderr=devnull)
+    except subprocess.CalledProcessError:
+        print "Changes have not been committed to cvs.  Run 'cvs diff' confirm the changes and then commit them"
+        sys.exit(1)
+
+def static_lookup(hosts):
+    """Returns a lookup function which resolves from a fixed hostname to address map"""
+
+    def lookup(hostname):
+        """Resolve hostname from the map, failing like gethostbyname would"""
+        try:
+            return hosts[hostname]
+        except KeyError:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+    return lookup
+
+def read_hosts(hosts_file):
+    """Reads an /etc/hosts style file into a hostname to address map"""
+
+    hosts = {}
+    for line in open(hosts_file, 'r'):
+        fields = line.split('#', 1)[0].split()
+        for hostname in fields[1:]:
+            hosts.setdefault(hostname, fields[0])
+
+    return hosts
+
+# Resolves the hostnames used in pool files
+class Resolver:
+    """Resolves hostnames concurrently, remembering the answers between runs"""
+
+    config_file = 'f5.cfg'
+
+    def __init__(self, lookup=None):
+        """Initialise the resolver, by default lookups go through the system resolver"""
+
+        config = ConfigParser.ConfigParser()
+        config.read(self.config_file)
+
+        self.workers = int(config_option(config, 'Resolver', 'workers', 8))
+        self.timeout = float(config_option(config, 'Resolver', 'timeout', 5))
+        self.ttl = int(config_option(config, 'Resolver', 'ttl', 300))
+        self.cache_file = config_option(config, 'Resolver', 'cache', '')
+
+        # A hosts file in the config replaces DNS entirely, handy when working offline
+        if lookup is None:
+            hosts_file = config_option(config, 'Resolver', 'hosts', '')
+            if hosts_file:
+                lookup = static_lookup(read_hosts(hosts_file))
+            else:
+                lookup = socket.gethostbyname
+        self.lookup = lookup
+
+        # hostname -> [address, expiry time]
+        self.addresses = {}
+        self.failures = {}
+        self.load()
+
+    def load(self):
+        """Load any unexpired addresses from the cache file"""
+
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+
+        try:
+            cache_file = open(self.cache_file, 'r')
+            cached = json.load(cache_file)
+            cache_file.close()
+        except (IOError, ValueError):
+            # A broken cache just means we look everything up again
+            return
+
+        now = time.time()
+        for hostname, entry in cached.items():
+            if entry[1] > now:
+                self.addresses[str(hostname)] = [str(entry[0]), entry[1]]
+
+    def save(self):
+        """Write the addresses we know out to the cache file"""
+
+        if not self.cache_file:
+            return
+
+        scratch = self.cache_file + '.tmp'
+        cache_file = open(scratch, 'w')
+        json.dump(self.addresses, cache_file)
+        cache_file.close()
+        os.rename(scratch, self.cache_file)
+
+    def run_lookup(self, hostname, results):
+        """Thread target, resolves a single hostname into results"""
+        try:
+            results[hostname] = (self.lookup(hostname), None)
+        except Exception as detail:
+            results[hostname] = (None, detail)
+
+    def resolve_all(self, hostnames):
+        """Resolve a batch of hostnames at once, looking each one up only once"""
+
+        now = time.time()
+        pending = []
+        for hostname in hostnames:
+            if hostname in pending:
+                continue
+            if hostname in self.addresses and self.addresses[hostname][1] > now:
+                continue
+            pending.append(hostname)
+
+        if pending == []:
+            return
+
+        results = {}
+        running = []
+        while pending or running:
+
+            # Keep up to the configured number of lookups going
+            while pending and len(running) < self.workers:
+                hostname = pending.pop(0)
+                thread = threading.Thread(target=self.run_lookup, args=(hostname, results))
+                thread.setDaemon(True)
+                thread.start()
+                running.append((hostname, thread, time.time()))
+
+            running[0][1].join(0.01)
+
+            still_running = []
+            for hostname, thread, started in running:
+                if hostname in results:
+                    continue
+                if time.time() - started > self.timeout:
+                    # Give up on it, the thread is left to finish on its own
+                    results[hostname] = (None, socket.timeout('timed out resolving %s' % hostname))
+                    continue
+                still_running.append((hostname, thread, started))
+            running = still_running
+
+        expiry = time.time() + self.ttl
+        for hostname, (address, detail) in results.items():
+            if address is None:
+                self.failures[hostname] = detail
+            else:
+                self.addresses[hostname] = [address, expiry]
+                self.failures.pop(hostname, None)
+
+        self.save()
+
+    def resolve(self, hostname):
+        """Returns the address for a hostname, raising the lookup error if it can't be resolved"""
+
+        # Don't go back to DNS for a name that has already failed this run
+        if hostname not in self.failures:
+            self.resolve_all([hostname])
+        if hostname in self.failures:
+            raise self.failures[hostname]
+
+        return self.addresses[hostname][0]
+
+class TaskOutput:
+    """Stands in for sys.stdout while a Pipeline runs, keeping what each worker prints apart"""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.stdout.write(text)
+        else:
+            buffer.append(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stdout.flush()
+
+
+class Pipeline:
+    """Runs a function over a list of items on a bounded pool of threads.
+
+    Whatever each item prints is shown in the order of the items, as if they had run one
+    after another, and the first item (in order) to fail stops the run just as it would have."""
+
+    config_file = 'f5.cfg'
+
+    def __init__(self, workers=None, tracer=None):
+        """Initialise the pipeline, the number of workers comes from [Deploy] by default.
+        With a tracer each item runs in a span of its own, named after the item"""
+
+        if workers is None:
+            config = ConfigParser.ConfigParser()
+            config.read(self.config_file)
+            workers = int(config_option(config, 'Deploy', 'workers', 4))
+        self.workers = workers
+        self.tracer = tracer
+
+    def run(self, function, items):
+        """Returns [function(item) for item in items], re-raising the first failure, SystemExit included"""
+
+        if self.tracer is not None and self.tracer.enabled:
+            function = self.traced(function, self.tracer.current())
+
+        if self.workers <= 1 or len(items) <= 1:
+            return [function(item) for item in items]
+
+        results = [None] * len(items)
+        outputs = [None] * len(items)
+        failures = {}
+        # Items are handed out in order, nothing past limit is started once an item has failed
+        state = {'next': 0, 'limit': len(items)}
+        finished = threading.Condition()
+        output = TaskOutput(sys.stdout)
+
+        def work():
+            """Thread target, runs items until there are none left"""
+            while True:
+                finished.acquire()
+                index = state['next']
+                if index >= state['limit']:
+                    finished.release()
+                    return
+                state['next'] += 1
+                finished.release()
+
+                buffer = []
+                output.local.buffer = buffer
+                failure = None
+                try:
+                    results[index] = function(items[index])
+                except:
+                    failure = sys.exc_info()
+
+                finished.acquire()
+                if failure is not None:
+                    failures[index] = failure
+                    state['limit'] = min(state['limit'], index + 1)
+                outputs[index] = buffer
+                finished.notify()
+                finished.release()
+
+        sys.stdout = output
+        try:
+            threads = []
+            for count in range(min(self.workers, len(items))):
+                thread = threading.Thread(target=work)
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+
+            # Show each item's output as soon as everything before it is done
+            shown = 0
+            finished.acquire()
+            try:
+                while shown < state['limit']:
+                    if outputs[shown] is None:
+                        finished.wait(1)
+                        continue
+                    output.stdout.write(''.join(outputs[shown]))
+                    shown += 1
+            finally:
+                finished.release()
+
+            # Anything still going was started past a failure, let it tidy up after itself
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.stdout = output.stdout
+
+        if failures:
+            first = failures[min(failures.keys())]
+            raise first[0], first[1], first[2]
+
+        return results
+
+    def traced(self, function, parent):
+        """Returns function with each call in a span under parent, whichever thread it runs in"""
+
+        def in_span(item):
+            with self.tracer.span(os.path.basename(str(item)), parent):
+                return function(item)
+        return in_span
+
+# Keeps track of what exists on the f5
+class Inventory:
+    """Hash indexes of the pools, monitor templates and rules on the f5"""
+
+    config_file = 'f5.cfg'
+
+    def __init__(self, conn=None):
+        """Initialise the inventory, the listings are fetched the first time they're needed"""
+        # Use the shared connection to the f5
+        if conn is None:
+            conn = connect(self.config_file)
+        self.conn = conn
+
+        # Bare names are taken to be in this partition
+        config = ConfigParser.ConfigParser()
+        config.read(self.config_file)
+        self.partition = config_option(config, 'LoadBalancer', 'partition', 'Common')
+
+        self.pools = None
+        self.monitors = None
+        self.rules = None
+        self.classes = None
+
+        # Checks run in parallel, but each listing should only be fetched once
+        self.lock = threading.Lock()
+
+    def key(self, name):
+        """Returns the full /partition/name path we index objects under"""
+
+        # Older f5s don't use partition paths at all, and ours don't have to either
+        if name.startswith('/'):
+            return str(name)
+        return '/%s/%s' % (self.partition, name)
+
+    def index(self, names):
+        """Builds a set index from a listing of names"""
+
+        return set([self.key(name) for name in names])
+
+    def fetch(self, listing, build):
+        """Fill in a listing with build() unless another check already has"""
+
+        self.lock.acquire()
+        try:
+            if getattr(self, listing) is None:
+                setattr(self, listing, build())
+        finally:
+            self.lock.release()
+
+    def has_pool(self, name):
+        """Checks if a pool exists"""
+
+        if self.pools is None:
+            self.fetch('pools', lambda: self.index(self.conn.LocalLB.Pool.get_list()))
+        return self.key(name) in self.pools
+
+    def monitor_listing(self):
+        """The template list gives us each template's type for free, so keep that too"""
+
+        monitors = {}
+        for template in self.conn.LocalLB.Monitor.get_template_list():
+            monitors[self.key(template.template_name)] = intern(str(template.template_type))
+        return monitors
+
+    def has_monitor(self, name):
+        """Checks if a monitor template exists"""
+
+        if self.monitors is None:
+            self.fetch('monitors', self.monitor_listing)
+        return self.key(name) in self.monitors
+
+    def monitor_type(self, name):
+        """Returns the template type of an existing monitor"""
+
+        if self.has_monitor(name):
+            return self.monitors[self.key(name)]
+        return None
+
+    def has_rule(self, name):
+        """Checks if a rule exists"""
+
+        if self.rules is None:
+            self.fetch('rules', lambda: self.index(self.conn.LocalLB.Rule.get_list()))
+        return self.key(name) in self.rules
+
+    def has_class(self, name):
+        """Checks if a string data group exists"""
+
+        if self.classes is None:
+            self.fetch('classes', lambda: self.index(self.conn.LocalLB.Class.get_string_class_list()))
+        return self.key(name) in self.classes
+
+    # Called after each commit so we never have to fetch the listings again
+    def add_pool(self, name):
+        """Record a pool that has been created"""
+        if self.pools is not None:
+            self.pools.add(self.key(name))
+
+    def add_monitor(self, name, template_type):
+        """Record a monitor template that has been created"""
+        if self.monitors is not None:
+            self.monitors[self.key(name)] = intern(str(template_type))
+
+    def add_rule(self, name):
+        """Record a rule that has been created"""
+        if self.rules is not None:
+            self.rules.add(self.key(name))
+
+    def add_class(self, name):
+        """Record a string data group that has been created"""
+        if self.classes is not None:
+            self.classes.add(self.key(name))
+
+    def discard_pool(self, name):
+        """Record a pool that has been deleted"""
+        if self.pools is not None:
+            self.pools.discard(self.key(name))
+
+    def discard_monitor(self, name):
+        """Record a monitor template that has been deleted"""
+        if self.monitors is not None:
+            self.monitors.pop(self.key(name), None)
+
+    def discard_rule(self, name):
+        """Record a rule that has been deleted"""
+        if self.rules is not None:
+            self.rules.discard(self.key(name))
+
+    def refresh(self):
+        """Forget everything, the listings will be fetched again when next needed"""
+        self.pools = None
+        self.monitors = None
+        self.rules = None
+        self.classes = None
+
 # Handles all pool related stuff
 class Pool:
     """pool class manages pools on f5s"""
 
     config_file = 'f5.cfg'
-    existing_pools = 'empty'
 
-    def __init__(self):
+    def __init__(self, conn=None, inventory=None, resolver=None):
         """Initialise the Pool class"""
-        # Connect to f5 and save connection
-        conn = self.connect()
+        # Use the shared connection to the f5
+        if conn is None:
+            conn = connect(self.config_file)
+        if inventory is None:
+            inventory = Inventory(conn)
+        if resolver is None:
+            resolver = Resolver()
+        self.inventory = inventory
+        self.resolver = resolver
+
+        # How gently to go when committing changes
+        config = ConfigParser.ConfigParser()
+        config.read(self.config_file)
+        self.pace = float(config_option(config, 'Pool', 'pace', 0.5))
+        self.ready_timeout = float(config_option(config, 'Pool', 'ready_timeout', 30))
+        self.poll_interval = float(config_option(config, 'Pool', 'poll_interval', 1))
+        self.last_call = 0
+
+        # Optionally let connections to outgoing members drain before removing them
+        self.drain = config_option(config, 'Pool', 'drain', 'no').lower() in ('yes', 'true', 'on', '1')
+        self.drain_timeout = float(config_option(config, 'Pool', 'drain_timeout', 300))
 
         # Save some typing
         self.pool = conn.LocalLB.Pool
+        self.member = conn.LocalLB.PoolMember
+        self.transaction = conn.transaction
 
-    def connect(self):
-        """Connect to the load balancer"""
-        # Set up config file
-        config = ConfigParser.ConfigParser()
-        config.read(self.config_file)
+        # Known state of pools on the f5, filled in by snapshot()
+        self.state = {}
 
-        # Connect to the F5 using the propery wsdls
-        connection = pc.BIGIP(
-                            hostname=config.get('LoadBalancer', 'hostname'),
-                            username=config.get('LoadBalancer', 'username'),
-                            password=config.get('LoadBalancer', 'password'),
-                            fromurl=True,
-                            wsdls=['LocalLB.Pool'])
+        # When planning, the state is all we have and nothing is asked of the f5
+        self.offline = False
 
-        return connection
-    
     def exists(self, name):
         """Checks if a pool already exists"""
 
-        if self.existing_pools == 'empty':
-            # Get a list of existing pools to check against
-            self.existing_pools = self.pool.get_list()
+        return self.inventory.has_pool(name)
 
-        # Check if Pool Exists
-        if name in self.existing_pools:
-            exists = True
-        else:
-            exists = False
+    def snapshot(self, names):
+        """Fetch the lb method, members and monitors of the named pools in bulk"""
+
+        if self.offline:
+            return self.state
+
+        # Only ask about pools the f5 actually has
+        names = [name for name in names if self.exists(name)]
 
-        return exists
+        for chunk in chunks(names):
+            methods = self.pool.get_lb_method(pool_names=chunk)
+            members = self.pool.get_member(pool_names=chunk)
+            monitors = self.pool.get_monitor_association(pool_names=chunk)
+
+            for index, name in enumerate(chunk):
+                self.state[name] = {
+                    'method': str(methods[index]),
+                    'members': [member.address + ':' + str(member.port) for member in members[index]],
+                    'monitors': [str(template) for template in (monitors[index].monitor_rule.monitor_templates or [])]}
+
+        return self.state
+
+    def existing(self, name):
+        """Returns the known state of an existing pool, fetching it if we don't have it yet"""
+
+        if name not in self.state:
+            self.snapshot([name])
+
+        return self.state[name]
 
     # Checks if a pools config matches what the LB has
     def changed(self, pool):
@@ -81,29 +1164,20 @@ class Pool:
 
         # This Section checks if a pool is the same based on it's member's address and port and LB method
         changed = False
+        existing = self.existing(name)
 
         # Check if the lb method is different
-        existing_lb_method = self.pool.get_lb_method(pool_names=[name])
-
-        if (method != existing_lb_method[0]):
+        if (method != existing['method']):
             changed = True
 
-        existing_mem_sequence = self.pool.get_member(pool_names=[name])
-        clean_existing_mem_sequence = existing_mem_sequence[0]
+        # Create a list of existing addresses
+        existing_sockets = existing['members']
 
         # Check if the number of pool members is the same, if so then check if the pool members are the same
-        if len(clean_existing_mem_sequence) == len(mem_sequence.item):
-            # Create a list of existing addresses
-            existing_sockets = []
-            for existingitem in clean_existing_mem_sequence:
-                existing_socket = existingitem.address + ':' + str(existingitem.port)
-                existing_sockets.append(existing_socket)
+        if len(existing_sockets) == len(mem_sequence.item):
 
             # Create a list of new addresses
-            new_sockets = []
-            for new_item in mem_sequence.item:
-                new_socket = new_item.address + ':' + new_item.port
-                new_sockets.append(new_socket)
+            new_sockets = self.member_sockets(mem_sequence)
 
             #list of matching addresses
             matching_sockets = list(set(existing_sockets) & set(new_sockets))
@@ -116,6 +1190,18 @@ class Pool:
 
         return changed
 
+    def resolve(self, pool_files):
+        """Resolve every member hostname used across the pool files in one go"""
+
+        hostnames = []
+        for pool_file in pool_files:
+            for line in open(pool_file, 'r'):
+                clean_line = line.strip()
+                if clean_line:
+                    hostnames.append(clean_line.split(':')[0])
+
+        self.resolver.resolve_all(hostnames)
+
     def build(self, pool_file):
         """Builds a pool from a config file and returns a queue entry"""
 
@@ -149,7 +1235,7 @@ class Pool:
             member = self.pool.typefactory.create('Common.IPPortDefinition')
 
             # Resolve the servername
-            member_address = socket.gethostbyname(url[0])
+            member_address = self.resolver.resolve(url[0])
             member.address = member_address
             member.port = url[1]
             mem_sequence.item.append(member)
@@ -167,6 +1253,10 @@ class Pool:
 
         tmp_pool = 'tmp_' + name
 
+        # Planned changes are only checked against the snapshot
+        if self.offline:
+            return True
+
         # Create a temp pool with the name included in it so we can validate both the name and it's members
         try:
             print "Testing Pool"
@@ -183,40 +1273,206 @@ class Pool:
     def commit(self, pool):
         """Commit the pool changes to the f5"""
 
-        name = pool['name']
-        method = pool['method']
-        members = pool['members']
-
-        if pool['operation'] == 'create':
+        return self.commit_all([pool])
+
+    def commit_all(self, queue):
+        """Commit a whole queue of pool changes to the f5 in as few calls as possible"""
+
+        creates = [pool for pool in queue if pool['operation'] == 'create']
+        modifies = [pool for pool in queue if pool['operation'] == 'modify']
+
+        for chunk in chunks(creates):
+
+            # Create the new pools
+            for pool in chunk:
+                print "Creating Pool: %s" % pool['name']
+            names = [pool['name'] for pool in chunk]
+            self.paced()
+            self.pool.create(pool_names=names,
+                             lb_methods=[pool['method'] for pool in chunk],
+                             members=[pool['members'] for pool in chunk])
+            for name in names:
+                self.inventory.add_pool(name)
+
+            # Attach their monitors
+            self.paced()
+            self.attach_monitors(names)
+
+        # Modify Existing Pools, only touching the members and methods that differ
+        removals = []
+        additions = []
+        methods = []
+        for pool in modifies:
+            print "Modifying Pool: %s" % pool['name']
+            existing = self.existing(pool['name'])
+            new_sockets = self.member_sockets(pool['members'])
+
+            outgoing = [sock for sock in existing['members'] if sock not in new_sockets]
+            if outgoing != []:
+                print "Removing members from %s: %s" % (pool['name'], ', '.join(outgoing))
+                removals.append((pool['name'], outgoing))
+
+            incoming = [sock for sock in new_sockets if sock not in existing['members']]
+            if incoming != []:
+                print "Adding members to %s: %s" % (pool['name'], ', '.join(incoming))
+                additions.append((pool['name'], incoming))
+
+            if str(pool['method']) != existing['method']:
+                methods.append((pool['name'], pool['method']))
+
+        # Bring the new members in before taking the old ones out
+        for chunk in chunks(additions):
+            self.paced()
+            self.pool.add_member(pool_names=[name for name, sockets in chunk],
+                                 members=[self.member_sequence(sockets) for name, sockets in chunk])
+        for chunk in chunks(methods):
+            self.paced()
+            self.pool.set_lb_method(pool_names=[name for name, method in chunk],
+                                    lb_methods=[method for name, method in chunk])
+        if removals != []:
+            if self.drain:
+                # Members can only drain once they're really disabled, after any transaction
+                self.transaction.defer(self.drain_members, removals)
+            else:
+                self.remove_members(removals)
 
-            # Create a new pool
-            print "Creating Pool: %s" % name
-            self.pool.create(pool_names=[name], lb_methods=[method], members=[members])
-            self.attach_monitor(name)
+        # Keep our snapshot in line with what we've just done
+        for pool in queue:
+            name = pool['name']
+            monitors = self.state.get(name, {}).get('monitors', [swap_suffix('_health', name)])
+            self.state[name] = {
+                'method': str(pool['method']),
+                'members': self.member_sockets(pool['members']),
+                'monitors': monitors}
 
-        elif pool['operation'] == 'modify':
+        # New pools need their monitors to report in before they're synced
+        if creates != []:
+            self.transaction.defer(self.wait_ready, [pool['name'] for pool in creates])
 
-            # Modify Existing Pool
-            print "Modifying Pool: %s" % name
+        return True
 
-            # Get the existing pool members
-            existing_mem_sequence = self.pool.get_member(pool_names=[name])
-            clean_existing_mem_sequence = existing_mem_sequence[0]
+    def remove_members(self, removals):
+        """Remove a list of (pool name, [address:port, ...]) members from their pools"""
 
-            # Convert it to format for f5
+        for chunk in chunks(removals):
+            # Convert the outgoing pool members to format for f5
             # The API says it wants a AddressPort object, but the API lies
-            existing_mem_sequence = self.pool.typefactory.create('Common.IPPortDefinitionSequence')
-            existing_mem_sequence.item = []
+            self.paced()
+            self.pool.remove_member(pool_names=[name for name, sockets in chunk],
+                                    members=[self.member_sequence(sockets) for name, sockets in chunk])
+
+    def drain_members(self, removals):
+        """Disable outgoing members, and only remove them once their connections have drained"""
+
+        # Stop new sessions going to any of the outgoing members, across every pool at once
+        for chunk in chunks(removals):
+            session_states = []
+            for name, sockets in chunk:
+                print "Draining members of %s: %s" % (name, ', '.join(sockets))
+                states = self.member.typefactory.create('LocalLB.PoolMember.MemberSessionStateSequence')
+                states.item = []
+                for member in self.member_sequence(sockets).item:
+                    state = self.member.typefactory.create('LocalLB.PoolMember.MemberSessionState')
+                    state.member = member
+                    state.session_state = 'STATE_DISABLED'
+                    states.item.append(state)
+                session_states.append(states)
+            self.paced()
+            self.member.set_session_enabled_state(pool_names=[name for name, sockets in chunk],
+                                                  session_states=session_states)
+
+        # Poll all the draining pools together, removing members as each pool empties
+        deadline = time.time() + self.drain_timeout
+        draining = list(removals)
+        while draining != []:
+            drained = []
+            still_draining = []
+            for chunk in chunks(draining):
+                statistics = self.member.get_statistics(pool_names=[name for name, sockets in chunk],
+                                                        members=[self.member_sequence(sockets) for name, sockets in chunk])
+                for index, (name, sockets) in enumerate(chunk):
+                    if self.current_connections(statistics[index]) == 0:
+                        drained.append((name, sockets))
+                    else:
+                        still_draining.append((name, sockets))
+
+            if time.time() >= deadline:
+                for name, sockets in still_draining:
+                    print "Members of %s did not drain in time, removing anyway" % name
+                drained.extend(still_draining)
+                still_draining = []
+
+            if drained != []:
+                self.remove_members(drained)
+            draining = still_draining
+            if draining != []:
+                time.sleep(self.poll_interval)
+
+    def current_connections(self, member_statistics):
+        """Total current server side connections across the members in a get_statistics result"""
+
+        connections = 0
+        for entry in member_statistics.statistics:
+            for statistic in entry.statistics:
+                if statistic.type == 'STATISTIC_SERVER_SIDE_CURRENT_CONNECTIONS':
+                    connections += (long(statistic.value.high) << 32) + long(statistic.value.low)
+
+        return connections
+
+    def paced(self):
+        """Wait long enough since the last change that we don't hammer the f5"""
+
+        # Changes in a transaction are only queued up until it's submitted
+        if self.transaction.open:
+            return
+
+        delay = self.last_call + self.pace - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.last_call = time.time()
+
+    def wait_ready(self, names):
+        """Poll the f5 until the named pools have a known status, or we run out of patience"""
+
+        deadline = time.time() + self.ready_timeout
+        waiting = list(names)
+
+        while waiting != [] and time.time() < deadline:
+            still_waiting = []
+            for chunk in chunks(waiting):
+                statuses = self.pool.get_object_status(pool_names=chunk)
+                for index, name in enumerate(chunk):
+                    # Blue means the monitor hasn't decided yet
+                    if statuses[index].availability_status == 'AVAILABILITY_STATUS_BLUE':
+                        still_waiting.append(name)
+            waiting = still_waiting
+            if waiting != []:
+                time.sleep(self.poll_interval)
+
+        for name in waiting:
+            print "Pool %s still has an unknown status" % name
+
+        return waiting == []
+
+    def member_sockets(self, mem_sequence):
+        """Returns the members of an f5 member sequence as address:port strings"""
+
+        return [member.address + ':' + str(member.port) for member in mem_sequence.item]
+
+    def member_sequence(self, sockets):
+        """Builds an f5 member sequence from a list of address:port strings"""
 
-            for member in clean_existing_mem_sequence:
-                existing_mem_sequence.item.append(member)
+        mem_sequence = self.pool.typefactory.create('Common.IPPortDefinitionSequence')
+        mem_sequence.item = []
 
-            # Remove the existing members and add new ones
-            self.pool.remove_member(pool_names=[name], members=[existing_mem_sequence])
-            self.pool.add_member(pool_names=[name], members=[members])
-            self.pool.set_lb_method(pool_names=[name], lb_methods=[method])
+        for sock in sockets:
+            address, port = sock.rsplit(':', 1)
+            member = self.pool.typefactory.create('Common.IPPortDefinition')
+            member.address = address
+            member.port = port
+            mem_sequence.item.append(member)
 
-        return True
+        return mem_sequence
 
     def detach_monitor(self, pool_name):
         """Remove monitors from specified pool"""
@@ -227,9 +1483,26 @@ class Pool:
 
         return
 
-    # Attaches a monitor to the of the same name as the pool but suffixed with _health instead of _pool
-    def attach_monitor(self, pool_name):
-        """Attach a monitor of the same name as pool but with _health suffix instead of _pool"""
+    def attach_monitors(self, pool_names):
+        """Attach monitors to a list of pools in a single call"""
+
+        monitors = [self.monitor_association(pool_name) for pool_name in pool_names]
+        for monitor in monitors:
+            print "Attaching Monitor: %s" % monitor.monitor_rule.monitor_templates[0]
+
+        try:
+            self.pool.set_monitor_association(monitors)
+        except:
+            # One bad association fails the lot, so fall back to doing them one at a time
+            if len(pool_names) == 1:
+                return False
+            results = [self.attach_monitor(pool_name) for pool_name in pool_names]
+            return False not in results
+
+        return True
+
+    def monitor_association(self, pool_name):
+        """Build the association for the monitor of the same name as pool but with _health suffix instead of _pool"""
 
         # Build a Monitor object with the same name as the pool
         monitor = self.pool.typefactory.create('LocalLB.Pool.MonitorAssociation')
@@ -250,9 +1523,17 @@ class Pool:
         # Assign monitor to pool
         monitor.pool_name = pool_name
         monitor.monitor_rule = monitor_rule
+
+        return monitor
+
+    # Attaches a monitor to the of the same name as the pool but suffixed with _health instead of _pool
+    def attach_monitor(self, pool_name):
+        """Attach a monitor of the same name as pool but with _health suffix instead of _pool"""
+
+        monitor = self.monitor_association(pool_name)
         
         # Set Monitor Association on F5
-        print "Attaching Monitor: %s" % monitor_name
+        print "Attaching Monitor: %s" % monitor.monitor_rule.monitor_templates[0]
         try:
             self.pool.set_monitor_association([monitor])
         except:
@@ -265,47 +1546,79 @@ class Monitor:
     """monitor class manages monitors on f5s"""
 
     config_file = 'f5.cfg'
-    existing_monitors = 'empty'
 
-    def __init__(self):
+    def __init__(self, conn=None, inventory=None):
         """Initialise connection to f5"""
-        # Connect to f5 and save connection
-        conn = self.connect()
+        # Use the shared connection to the f5
+        if conn is None:
+            conn = connect(self.config_file)
+        if inventory is None:
+            inventory = Inventory(conn)
+        self.conn = conn
+        self.inventory = inventory
+
+        logging.getLogger('suds.client').setLevel(logging.CRITICAL)
 
         # Save some typing
         self.monitor = conn.LocalLB.Monitor
 
-    def connect(self):
-        """Connect to the F5"""
-        # Set up config file
-        config = ConfigParser.ConfigParser()
-        config.read(self.config_file)
-
-        logging.getLogger('suds.client').setLevel(logging.CRITICAL)
-        # Connect to the F5 using the propery wsdls
-        connection = pc.BIGIP(
-                            hostname=config.get('LoadBalancer', 'hostname'),
-                            username=config.get('LoadBalancer', 'username'),
-                            password=config.get('LoadBalancer', 'password'),
-                            fromurl=True,
-                            wsdls=['LocalLB.Monitor'])
+        # Known properties of monitors on the f5, filled in by snapshot()
+        self.state = {}
 
-        return connection
+        # When planning, the state is all we have and nothing is asked of the f5
+        self.offline = False
 
     def exists(self, name):
         """Check if a monitor already exists"""
 
-        if self.existing_monitors == 'empty':
-            # If the list hasnt been obtained, grab a copy from the LB and store it
-            self.existing_monitors = self.monitor.get_template_list()
+        return self.inventory.has_monitor(name)
+
+    def snapshot(self, names):
+        """Fetch the type, strings, interval and timeout of the named monitors in bulk"""
+
+        if self.offline:
+            return self.state
+
+        # Only ask about monitors the f5 actually has, the template list already gives us their type
+        names = [name for name in names if self.exists(name)]
+        string_types = ['STYPE_SEND', 'STYPE_RECEIVE', 'STYPE_USERNAME', 'STYPE_PASSWORD']
+        integer_types = ['ITYPE_INTERVAL', 'ITYPE_TIMEOUT']
+
+        for chunk in chunks(names):
+            for name in chunk:
+                self.state[name] = {'type': self.inventory.monitor_type(name),
+                                    'send': None, 'receive': None, 'username': None, 'password': None}
+
+            # Every template has an interval and timeout, ask for both for the whole chunk at once
+            integers = self.monitor.get_template_integer_property(
+                            template_names = [name for property_type in integer_types for name in chunk],
+                            property_types = [property_type for property_type in integer_types for name in chunk])
+            for index, name in enumerate(chunk):
+                self.state[name]['interval'] = integers[index].value
+                self.state[name]['timeout'] = integers[len(chunk) + index].value
 
-        # Check if monitor Exists
-        exists = False
-        for monitor in self.existing_monitors:
-            if monitor.template_name == name:
-                exists = True
+            # Only web checks have strings, asking for them on anything else fails the whole call
+            web = [name for name in chunk if self.state[name]['type'] in ('TTYPE_HTTP', 'TTYPE_HTTPS')]
+            if web == []:
+                continue
+            strings = self.monitor.get_template_string_property(
+                            template_names = [name for property_type in string_types for name in web],
+                            property_types = [property_type for property_type in string_types for name in web])
+            for index, name in enumerate(web):
+                self.state[name]['send'] = strings[index].value
+                self.state[name]['receive'] = strings[len(web) + index].value
+                self.state[name]['username'] = strings[2 * len(web) + index].value
+                self.state[name]['password'] = strings[3 * len(web) + index].value
 
-        return exists
+        return self.state
+
+    def existing(self, name):
+        """Returns the known properties of an existing monitor, fetching them if we don't have them yet"""
+
+        if name not in self.state:
+            self.snapshot([name])
+
+        return self.state[name]
 
     def changed(self, monitor):
         """Check if a monitor is different from the current config"""
@@ -324,39 +1637,33 @@ class Monitor:
         timeout = monitor['common_attributes']['timeout']
 
         # Get Existing values from the LB
-        existing_send_string = self.monitor.get_template_string_property(template_names = [name], property_types = ['STYPE_SEND'])
-        existing_receive_string = self.monitor.get_template_string_property(template_names = [name], property_types = ['STYPE_RECEIVE'])
-        existing_template_type = self.monitor.get_template_type(template_names = [name])
-        existing_username_string = self.monitor.get_template_string_property(template_names = [name], property_types = ['STYPE_USERNAME'])
-        existing_password_string = self.monitor.get_template_string_property(template_names = [name], property_types = ['STYPE_PASSWORD'])
-        existing_interval = self.monitor.get_template_integer_property(template_names = [name], property_types = ['ITYPE_INTERVAL'])
-        existing_timeout = self.monitor.get_template_integer_property(template_names = [name], property_types = ['ITYPE_TIMEOUT'])
+        existing = self.existing(name)
 
         if DEBUG==1:
-            print "Send_string",send_string_value.value,"\n",existing_send_string[0].value
-            print "Receive_string",receive_string_value.value,"\n",existing_receive_string[0].value
-            print "Template_type",monitor_template.template_type,"\n",existing_template_type[0]
-            print "password_string",password_string_value.value,"\n",existing_password_string[0].value
-            print "username_string",username_string_value.value,"\n",existing_username_string[0].value
-            print "interval",interval,"\n",existing_interval[0].value
-            print "timeout",timeout,"\n",existing_timeout[0].value
+            print "Send_string",send_string_value.value,"\n",existing['send']
+            print "Receive_string",receive_string_value.value,"\n",existing['receive']
+            print "Template_type",monitor_template.template_type,"\n",existing['type']
+            print "password_string",password_string_value.value,"\n",existing['password']
+            print "username_string",username_string_value.value,"\n",existing['username']
+            print "interval",interval,"\n",existing['interval']
+            print "timeout",timeout,"\n",existing['timeout']
         
         # Check for changes in send string, receive string or template type
 
-        if ((send_string_value.value == existing_send_string[0].value) and 
-           (receive_string_value.value == existing_receive_string[0].value) and
-           (monitor_template.template_type == existing_template_type[0]) and
-           (interval == existing_interval[0].value) and
-           (timeout == existing_timeout[0].value)) is False:
+        if ((send_string_value.value == existing['send']) and 
+           (receive_string_value.value == existing['receive']) and
+           (monitor_template.template_type == existing['type']) and
+           (interval == existing['interval']) and
+           (timeout == existing['timeout'])) is False:
 
             # Something in the monitor has changed
-            if ((monitor_template.template_type != existing_template_type[0]) or (interval != existing_interval[0].value) or (timeout != existing_timeout[0].value)):
+            if ((monitor_template.template_type != existing['type']) or (interval != existing['interval']) or (timeout != existing['timeout'])):
                 # If any of those attributes is different the whole monitor has to be re-created entirely, they can't be adjusted on the fly
                 return 2
             else:
                 return 1
-        elif ((password_string_value.value == existing_password_string[0].value) and (username_string_value.value == existing_username_string[0].value)) is False:
-            if ((password_string_value.value == '' and existing_password_string[0].value == None) and (username_string_value.value == '' and existing_username_string[0].value == None)):
+        elif ((password_string_value.value == existing['password']) and (username_string_value.value == existing['username'])) is False:
+            if ((password_string_value.value == '' and existing['password'] == None) and (username_string_value.value == '' and existing['username'] == None)):
                 return 0
             else:
                 return 1
@@ -452,7 +1759,7 @@ class Monitor:
 
     def test(self, monitor):
         """Test a monitor"""
-        if (monitor['monitor_template']['template_type'] == 'TTYPE_TCP_HALF_OPEN'):
+        if (monitor['monitor_template']['template_type'] == 'TTYPE_TCP_HALF_OPEN') or self.offline:
             return True
 
         monitor_template = monitor['monitor_template']
@@ -507,12 +1814,13 @@ class Monitor:
             # Recreate the monitor in cases where fundamental changes are involved
             print "Recreating %s" % name
 
-            # Connecting a connection to the F5 pool API
-            pool_api = f5Connection().pool
+            # Reuse our connection for the F5 pool API
+            pool_api = Pool(self.conn, self.inventory)
             pool_api.detach_monitor(swap_suffix('_pool',name))
 
             # Delete existing monitor
             self.monitor.delete_template([name])
+            self.inventory.discard_monitor(name)
 
             # Create new monitor
             self.monitor.create_template(templates = [monitor_template], template_attributes = [common_attributes])
@@ -534,37 +1842,72 @@ class Monitor:
         if monitor['operation'] == 'recreate':
             # Now we've re-created the monitor from scratch we need to re-associate it with its pool
             pool_api.attach_monitor(swap_suffix('_pool',name))
+
+        # Keep our snapshot in line with what we've just done
+        self.inventory.add_monitor(name, monitor_template.template_type)
+        self.state[name] = {'type': str(monitor_template.template_type),
+                            'interval': common_attributes.interval,
+                            'timeout': common_attributes.timeout,
+                            'send': None, 'receive': None, 'username': None, 'password': None}
+        if 'send_string_value' in monitor:
+            self.state[name]['send'] = monitor['send_string_value'].value
+            self.state[name]['receive'] = monitor['receive_string_value'].value
+            self.state[name]['username'] = monitor['username_string_value'].value
+            self.state[name]['password'] = monitor['password_string_value'].value
         
         return True
 
+def rule_digest(rule_text):
+    """sha1 of a rule, ignoring the Last Modified stamp and any trailing whitespace"""
+
+    lines = [line.rstrip() for line in str(rule_text).splitlines() if not line.startswith('# Last Modified')]
+    return hashlib.sha1('\n'.join(lines).strip()).hexdigest()
+
 class Irule:
     """monitor class manages monitors on f5s"""
 
     config_file = 'f5.cfg'
 
-    def __init__(self):
+    def __init__(self, conn=None, inventory=None):
         """initialise connection to f5 and save connection"""
-        conn = self.connect()
+        # Use the shared connection to the f5
+        if conn is None:
+            conn = connect(self.config_file)
+        if inventory is None:
+            inventory = Inventory(conn)
+        self.inventory = inventory
         #Creating a quick alias to save typing
         self.rule = conn.LocalLB.Rule
-        logging.getLogger('suds.client').setLevel(logging.DEBUG)
-        logging.getLogger('suds.metrics').setLevel(logging.DEBUG)
-        logging.getLogger('suds').setLevel(logging.DEBUG)
 
-    def connect(self):
-        """Connect to the F5"""
-        # Set up config file
+        self.conn = conn
+        self.tracer = conn.tracer
+
+        # Validate files all together and bisect on failure, or one at a time with 'each'
         config = ConfigParser.ConfigParser()
         config.read(self.config_file)
+        self.validation = config_option(config, 'Irule', 'validation', 'bisect')
 
-        # Connect to the F5 using the propery wsdls
-        connection = pc.BIGIP(
-                            hostname=config.get('LoadBalancer', 'hostname'),
-                            username=config.get('LoadBalancer', 'username'),
-                            password=config.get('LoadBalancer', 'password'),
-                            fromurl=True,
-                            wsdls=['LocalLB.Rule'])
-        return connection
+        # Files the f5 has already passed, by content and BIG-IP version
+        self.cache_file = config_option(config, 'Irule', 'cache', '')
+        self.validated = None
+
+        # Build plain switch rules, or move simple hostnames into data groups with 'datagroup'
+        self.compile = config_option(config, 'Irule', 'compile', 'switch')
+        self.host_pools = {}
+
+        # Request counts per hostname, used to put the busiest files first in the switch
+        self.profile_file = config_option(config, 'Irule', 'profile', '')
+        self.data_group = conn.LocalLB.Class
+
+        # Digests of the rules on the f5, fetched by load_deployed
+        self.deployed = None
+
+        # When planning, rules are only linted and compared with the snapshot
+        self.offline = False
+        self.deployed_text = {}
+        logging.getLogger('suds.client').setLevel(logging.DEBUG)
+        logging.getLogger('suds.metrics').setLevel(logging.DEBUG)
+        logging.getLogger('suds').setLevel(logging.DEBUG)
 
     def rule_build(self, src_dir, dirname):
         """Checks and collates rules under specified directory, returns Final rule"""
@@ -587,48 +1930,94 @@ when HTTP_REQUEST timing on {
     #Set default of vhost_pool in case no other pool is set by switch
     #Earlier pool statements are overridden by later statements 
     pool vhost_pool
-
-    #Check if hostname matches all known hostnames
-        switch -glob [HTTP::host]  {
-        ''')
+''')
 
         # Produce a list of all the config files
         filelist = sorted(glob.glob( os.path.join(src_dir, '*.conf')));
 
         # Clear any legacy temp_rule entries
-        try:
+        if self.inventory.has_rule('temp_rule'):
             self.rule.delete_rule(['temp_rule'])
-        except suds.WebFault:
-            # Didn't find an existing rule, no need to worry
-            pass
+            self.inventory.discard_rule('temp_rule')
 
-        # Read every file and test using temporary rule
+        # Read every file once, the contents are used for both validation and the complete rule
+        fragments = []
         for infile in filelist:
-            temp_rule = []
-            temp_rule.append("# Temporary Rule, please delete\n\nwhen HTTP_REQUEST timing on {\n\tswitch -glob [HTTP::host]  {\n")
-            print "Validating: " + infile
             conf_file = open(infile,'r')
-            for line in conf_file:
-                modline = '\t\t%s' % line
-                temp_rule.append(modline)
-            temp_rule.append("\t}\n}\n")
-            # Trying to push the temporary rule to the F5
-            temp_def = self.rule.typefactory.create('LocalLB.Rule.RuleDefinition')
-            temp_def.rule_name = 'temp_rule'
-            temp_def.rule_definition = ''.join(temp_rule)
-            try:
-                # Attempting to create test rule
-                self.rule.create(rules=[temp_def])
-                self.rule.delete_rule(['temp_rule'])
-            except suds.WebFault as detail:
-                # Caught an exception, returning just the error message
-                exitmessage = "%s\n%s" % (detail, temp_rule)
-                sys.exit(exitmessage)
+            fragments.append((infile, conf_file.readlines()))
+            conf_file.close()
+
+        # Catch what we can locally before bothering the f5
+        errors = []
+        for infile, lines in fragments:
+            errors.extend(f5lint.lint_cases(''.join(lines), infile))
+        if errors != []:
+            for infile, line, message in errors:
+                print "%s:%d: %s" % (infile, line, message)
+            sys.exit("Syntax errors found in %s... STOPPING!" % src_dir)
+
+        # Cases that can never match are almost certainly mistakes, but not fatal ones
+        for infile, line, message in f5switch.analyse(fragments):
+            print "Warning: %s:%d: %s" % (infile, line, message)
+
+        # Only files that have changed since they last passed need to go to the f5
+        unvalidated = [fragment for fragment in fragments if self.fragment_key(fragment) not in self.load_validated()]
+        if len(unvalidated) < len(fragments):
+            print "%d files unchanged since they were last validated" % (len(fragments) - len(unvalidated))
+
+        # Test the files using temporary rules
+        with self.tracer.span('validate %s' % dirname):
+            if self.offline:
+                print "%d files not validated on the f5 while planning" % len(unvalidated)
+                failures = []
+            elif self.validation == 'each':
+                failures = []
+                for fragment in unvalidated:
+                    print "Validating: " + fragment[0]
+                    failures.extend(self.bisect([fragment]))
+            else:
+                print "Validating %d files in %s" % (len(unvalidated), src_dir)
+                failures = self.bisect(unvalidated)
+        self.save_validated()
+
+        if failures != []:
+            # Caught an exception, returning just the error message
+            for infiles, detail, temp_rule in failures:
+                print "Validation failed for %s:\n%s\n" % (', '.join(infiles), detail)
+            exitmessage = "%s\n%s" % (failures[0][1], failures[0][2])
+            sys.exit(exitmessage)
+
+        # Hostnames that just pick a pool can be looked up in a data group instead of the switch
+        host_pools = {}
+        if self.compile == 'datagroup':
+            host_pools, fragments = f5switch.compile_hosts(fragments)
+        if host_pools:
+            self.host_pools[dirname] = host_pools
+            print "%d hostnames moved into data group %s_hosts" % (len(host_pools), dirname)
+            # The digest ties the rule to the data group contents, so a change to either changes the rule
+            hosts_digest = hashlib.sha1(json.dumps(sorted(host_pools.items()))).hexdigest()
+            built_rule.append('''
+    #Hostnames that only pick a pool are an exact match in the data group, contents %s
+    set host_pool [class match -value [HTTP::host] equals %s_hosts]
+    if { $host_pool ne "" } {
+        pool $host_pool
+    } else {
+''' % (hosts_digest, dirname))
+        else:
+            self.host_pools.pop(dirname, None)
+
+        # Busiest files first, only ever moving past files that can't match the same hostnames
+        if self.profile_file != '' and os.path.exists(self.profile_file):
+            fragments = f5switch.reorder(fragments, f5switch.read_profile(self.profile_file))
+
+        built_rule.append('''
+    #Check if hostname matches all known hostnames
+        switch -glob [HTTP::host]  {
+        ''')
 
         # Now we know everything is good, prepare the complete rule
-        for infile in filelist:
-            conf_file = open(infile,'r')
-            for line in conf_file:
+        for infile, lines in fragments:
+            for line in lines:
                 modline = '\t\t%s' % line
                 built_rule.append(modline)
             
@@ -639,7 +2028,10 @@ when HTTP_REQUEST timing on {
                 HTTP::respond 301 Location "http://foo.bar.baz/"
             }
     }
-
+''')
+        if host_pools:
+            built_rule.append("    }\n")
+        built_rule.append('''
     #if there are no members in the pool push to vhost_pool which will error and prompt the appropriate error pages for the app 
     if { [active_members [LB::server pool] ] < 1 } {
         pool vhost_pool
@@ -654,75 +2046,479 @@ when HTTP_REQUEST timing on {
         r_def.rule_name = dirname+'_rule'
         raw_code = ''.join(built_rule)
         # Basic syntax checking
-        if (self.syntax_check(raw_code) == 1):
-            print "Rule "+dirname+" broken, you have unmatching {}s or ()s"
+        if (self.syntax_check(raw_code, dirname+'_rule') == 1):
+            print "Rule "+dirname+" broken, see the errors above"
             sys.exit()
         r_def.rule_definition = raw_code
         # Return the rule
         return r_def
 
-    def syntax_check(self, check_rule):
-        """Carries out basic syntax checks rather than upload to F5.  Will expand & re-write as we find more obvious gotchas"""
-        if (check_rule.count('{') == check_rule.count('}')):
-            if (check_rule.count('(') == check_rule.count(')')):
-                return 0
-        return 1
+    def push_hosts(self, dirname):
+        """Create or update the hostname to pool data group the rule for dirname looks up"""
 
+        if dirname not in self.host_pools:
+            return False
 
+        host_pools = self.host_pools[dirname]
+        name = dirname + '_hosts'
+        hosts = sorted(host_pools.keys())
+
+        string_class = self.data_group.typefactory.create('LocalLB.Class.StringClass')
+        string_class.name = name
+        string_class.members = hosts
+
+        if self.inventory.has_class(name):
+            print "Updating data group %s" % name
+            self.data_group.modify_string_class(classes=[string_class])
+        else:
+            print "Creating data group %s" % name
+            self.data_group.create_string_class(classes=[string_class])
+            self.inventory.add_class(name)
+
+        self.data_group.set_string_class_member_data_value(class_members=[string_class],
+                                                           values=[[host_pools[host] for host in hosts]])
+        return True
+
+    def load_deployed(self, rule_names):
+        """Fetch the digests of the rules as they are on the f5, in one call"""
+
+        if self.offline:
+            return self.deployed
+
+        self.deployed = {}
+        rule_names = [name for name in rule_names if self.inventory.has_rule(name)]
+        if rule_names == []:
+            return self.deployed
+        for definition in self.rule.query_rule(rule_names = rule_names):
+            # BIG-IP 11 answers with the full path whichever name we asked for
+            key = self.inventory.key(str(definition.rule_name))
+            self.deployed[key] = rule_digest(definition.rule_definition)
+            self.deployed_text[key] = definition.rule_definition
+        return self.deployed
+
+    def is_current(self, r_def):
+        """Checks if the built rule is what's on the f5 already, bar the Last Modified stamp"""
+
+        if self.deployed is None:
+            self.load_deployed([r_def.rule_name])
+        return self.deployed.get(self.inventory.key(r_def.rule_name)) == rule_digest(r_def.rule_definition)
+
+    def uploaded(self, r_def):
+        """Note the digest of a rule we've just sent to the f5"""
+
+        if self.deployed is not None:
+            self.deployed[self.inventory.key(r_def.rule_name)] = rule_digest(r_def.rule_definition)
+
+    def fragment_key(self, fragment):
+        """Key for the validation cache, the file's content hash and the f5's BIG-IP version"""
+
+        return '%s:%s' % (device_version(self.conn), hashlib.sha1(''.join(fragment[1])).hexdigest())
+
+    def load_validated(self):
+        """Returns the set of validated keys, reading the cache file the first time"""
+
+        if self.validated is None:
+            self.validated = set()
+            if self.cache_file and os.path.isfile(self.cache_file):
+                try:
+                    cache_file = open(self.cache_file, 'r')
+                    self.validated = set([str(key) for key in json.load(cache_file)])
+                    cache_file.close()
+                except (IOError, ValueError):
+                    # A broken cache just means validating everything again
+                    pass
+
+        return self.validated
+
+    def save_validated(self):
+        """Write the validated keys for the current BIG-IP version out to the cache file"""
+
+        if not self.cache_file:
+            return
+
+        # Anything validated against another version is no use to us any more
+        prefix = '%s:' % device_version(self.conn)
+        keys = sorted([key for key in self.load_validated() if key.startswith(prefix)])
+
+        scratch = self.cache_file + '.tmp'
+        cache_file = open(scratch, 'w')
+        json.dump(keys, cache_file)
+        cache_file.close()
+        os.rename(scratch, self.cache_file)
+
+    def validate(self, fragments):
+        """Push a group of files to the F5 as one temporary rule, returns the fault or None if it's valid"""
+
+        temp_rule = []
+        temp_rule.append("# Temporary Rule, please delete\n\nwhen HTTP_REQUEST timing on {\n\tswitch -glob [HTTP::host]  {\n")
+        for infile, lines in fragments:
+            for line in lines:
+                modline = '\t\t%s' % line
+                temp_rule.append(modline)
+        temp_rule.append("\t}\n}\n")
+
+        # Trying to push the temporary rule to the F5
+        temp_def = self.rule.typefactory.create('LocalLB.Rule.RuleDefinition')
+        temp_def.rule_name = 'temp_rule'
+        temp_def.rule_definition = ''.join(temp_rule)
+        try:
+            # Attempting to create test rule
+            self.rule.create(rules=[temp_def])
+            self.rule.delete_rule(['temp_rule'])
+        except suds.WebFault as detail:
+            return (detail, temp_rule)
+
+        return None
+
+    def bisect(self, fragments):
+        """Validate a group of files in one go, splitting it up to find the broken ones only if it fails.
+        Returns a list of ([files], fault, temporary rule) for each failure"""
+
+        if fragments == []:
+            return []
+
+        result = self.validate(fragments)
+        if result is None:
+            # Remember these ones are good
+            for fragment in fragments:
+                self.load_validated().add(self.fragment_key(fragment))
+            return []
+        detail, temp_rule = result
+
+        if len(fragments) == 1:
+            return [([fragments[0][0]], detail, temp_rule)]
+
+        half = len(fragments) // 2
+        failures = self.bisect(fragments[:half]) + self.bisect(fragments[half:])
+
+        # Each half is fine by itself, so it's the combination that's broken
+        if failures == []:
+            failures = [([infile for infile, lines in fragments], detail, temp_rule)]
+
+        return failures
+
+    def syntax_check(self, check_rule, rule_name='<rule>'):
+        """Carries out syntax checks rather than upload to F5, printing any errors found"""
+        errors = f5lint.lint(check_rule, rule_name)
+        for filename, line, message in errors:
+            print "%s:%d: %s" % (filename, line, message)
+        if errors != []:
+            return 1
+        return 0
+
+
+
+class RuleStats:
+    """Collects the timing statistics the iRules gather with 'timing on'"""
 
-class ConfigSync:
-    """Synchronises the configuration between f5 loadbalancers""" 
     config_file = 'f5.cfg'
 
-    def __init__(self):
+    def __init__(self, conn=None):
         """Initialise connection to f5"""
-        # Connect to f5 and save connection
-        conn = self.connect()
+        # Use the shared connection to the f5
+        if conn is None:
+            conn = connect(self.config_file)
+        self.conn = conn
 
         # Save some typing
-        self.sync = conn.System.ConfigSync
+        self.rule = conn.LocalLB.Rule
 
-    # connect to the load balancer
-    def connect(self):
-        """Connect to f5"""
-        # Set up config file
+        # Snapshots are appended here, one JSON object per line
         config = ConfigParser.ConfigParser()
         config.read(self.config_file)
-        logging.getLogger('suds.client').setLevel(logging.CRITICAL)
+        self.history_file = config_option(config, 'RuleStats', 'history', '.rulestats')
 
-        # Connect to the F5 using the propery wsdls
-        connection = pc.BIGIP(
-                            hostname=config.get('LoadBalancer', 'hostname'),
-                            username=config.get('LoadBalancer', 'username'),
-                            password=config.get('LoadBalancer', 'password'),
-                            fromurl=True,
-                            wsdls=['System.ConfigSync'])
+    def fetch(self, rule_names):
+        """Returns the current statistics for the rules, see parse_rule_statistics"""
+
+        return parse_rule_statistics(self.rule.get_statistics(rule_names = rule_names))
+
+    def take(self, rule_names, label):
+        """Take a snapshot of the statistics, without saving it yet"""
 
-        return connection
+        return {'time': int(time.time()), 'label': label, 'rules': self.fetch(rule_names)}
+
+    def save(self, snapshot):
+        """Add a snapshot to the history file"""
+
+        history_file = open(self.history_file, 'a')
+        history_file.write(json.dumps(snapshot, sort_keys=True) + '\n')
+        history_file.close()
+
+    def record(self, rule_names, label):
+        """Take a snapshot of the statistics and add it to the history file, returns the snapshot"""
+
+        snapshot = self.take(rule_names, label)
+        self.save(snapshot)
+        return snapshot
+
+    def history(self, label=None):
+        """Returns the recorded snapshots, oldest first, optionally only those with the label"""
+
+        snapshots = []
+        if not os.path.isfile(self.history_file):
+            return snapshots
+        for line in open(self.history_file, 'r'):
+            try:
+                snapshot = json.loads(line)
+            except ValueError:
+                # Skip anything half written
+                continue
+            if label is None or snapshot.get('label') == label:
+                snapshots.append(snapshot)
+        return snapshots
+
+
+# iControl statistic types and what we call them in the snapshots
+RULE_STATISTICS = {'STATISTIC_RULE_MINIMUM_CYCLES': 'min',
+                   'STATISTIC_RULE_AVERAGE_CYCLES': 'avg',
+                   'STATISTIC_RULE_MAXIMUM_CYCLES': 'max',
+                   'STATISTIC_RULE_TOTAL_EXECUTIONS': 'executions',
+                   'STATISTIC_RULE_FAILURES': 'failures',
+                   'STATISTIC_RULE_ABORTS': 'aborts'}
+
+def parse_rule_statistics(statistics):
+    """Turn a LocalLB.Rule.get_statistics response into plain dicts,
+    {rule: {event: {'min': cycles, 'avg': ..., 'max': ..., 'executions': ..., 'failures': ..., 'aborts': ...}}}"""
+
+    rules = {}
+    for entry in statistics.statistics:
+        event = rules.setdefault(str(entry.rule_name), {}).setdefault(str(entry.event_name), {})
+        for statistic in entry.statistics:
+            name = RULE_STATISTICS.get(str(statistic.type))
+            if name is not None:
+                # Counters come back as two 32 bit halves
+                event[name] = (long(statistic.value.high) << 32) + long(statistic.value.low)
+    return rules
+
+def rule_baselines(history, rule_names):
+    """Pick the latest snapshot of each rule out of a history, oldest first, as recorded by
+    RuleStats.  Returns the statistics to compare against, as one parsed snapshot, the rules
+    whose counters have been zeroed since, and the snapshot each rule's statistics came from"""
+
+    before = {}
+    taken = {}
+    for snapshot in history:
+        for rule in rule_names:
+            if rule in snapshot['rules']:
+                before[rule] = snapshot['rules'][rule]
+                taken[rule] = snapshot
+
+    # A deploy snapshot is taken just before the rule is replaced, which zeroes its counters
+    reset = sorted([rule for rule in taken if taken[rule].get('label') == 'deploy'])
+    return before, reset, taken
+
+def compare_rule_statistics(before, after, reset=()):
+    """Compare two parsed snapshots, returns a list of
+    (rule, event, executions, average cycles before, average cycles since, failures, aborts).
+
+    The counters are cumulative, so the average since the first snapshot is worked out from
+    the totals, unless everything in the second snapshot happened since.  That's the case
+    for the rules in reset, whose first snapshot was taken by a deploy just before it replaced
+    them and zeroed their counters, or when the counters have gone backwards for any other reason."""
+
+    rows = []
+    for rule in sorted(after.keys()):
+        for event in sorted(after[rule].keys()):
+            now = after[rule][event]
+            then = before.get(rule, {}).get(event, {})
+            executions = now.get('executions', 0)
+            old_executions = then.get('executions', 0)
+            old_avg = then.get('avg')
+
+            if rule not in reset and executions >= old_executions and old_executions > 0:
+                executions = executions - old_executions
+                cycles = now.get('avg', 0) * now.get('executions', 0) - then.get('avg', 0) * old_executions
+                failures = now.get('failures', 0) - then.get('failures', 0)
+                aborts = now.get('aborts', 0) - then.get('aborts', 0)
+            else:
+                cycles = now.get('avg', 0) * executions
+                failures = now.get('failures', 0)
+                aborts = now.get('aborts', 0)
+
+            new_avg = None
+            if executions > 0:
+                new_avg = cycles / executions
+            rows.append((rule, event, executions, old_avg, new_avg, failures, aborts))
+    return rows
+
+
+class ConfigSync:
+    """Synchronises the configuration between f5 loadbalancers""" 
+    config_file = 'f5.cfg'
+
+    def __init__(self, conn=None):
+        """Initialise connection to f5"""
+        # Use the shared connection to the f5
+        if conn is None:
+            conn = connect(self.config_file)
+        logging.getLogger('suds.client').setLevel(logging.CRITICAL)
+
+        # Save some typing
+        self.sync = conn.System.ConfigSync
+        self.tracer = conn.tracer
 
     # sync config
     def sync_all(self):
         """Synchronise the configuration files"""
 
-        try:
-            # Set sync mode to all
-            sync_mode = self.sync.typefactory.create('System.ConfigSync.SyncMode')
-            
-            # Sync config with other F5
-            self.sync.synchronize_configuration(sync_mode.CONFIGSYNC_ALL)
-            return True
-        except:
-            return False
+        with self.tracer.span('sync'):
+            try:
+                # Set sync mode to all
+                sync_mode = self.sync.typefactory.create('System.ConfigSync.SyncMode')
+
+                # Sync config with other F5
+                self.sync.synchronize_configuration(sync_mode.CONFIGSYNC_ALL)
+                return True
+            except:
+                return False
 
 
 class f5Connection:
     """Initial processes"""
 
+    config_file = 'f5.cfg'
 
     # Create a pool and monitor object
     def __init__(self):
         """Initialise objects"""
-        self.pool = Pool()
-        self.monitor = Monitor()
-        self.irule = Irule()
-        self.config_sync = ConfigSync()
+        # All of the objects share the one session to the f5
+        self.conn = connect(self.config_file)
+        self.inventory = Inventory(self.conn)
+        self.pool = Pool(self.conn, self.inventory)
+        self.monitor = Monitor(self.conn, self.inventory)
+        self.irule = Irule(self.conn, self.inventory)
+        self.rule_stats = RuleStats(self.conn)
+        self.config_sync = ConfigSync(self.conn)
+        self.tracer = self.conn.tracer
+        self.pipeline = Pipeline(tracer=self.tracer)
+        self.transaction = self.conn.transaction
+
+
+    def take_snapshot(self, pool_names, monitor_names, rule_names):
+        """Fetch everything the checks need to know about the named objects in bulk,
+        as plain data that can be saved and restored later"""
+
+        pools = self.pool.snapshot(pool_names)
+        monitors = self.monitor.snapshot(monitor_names)
+        self.irule.load_deployed(rule_names)
+
+        snapshot = {'version': device_version(self.conn), 'pools': {}, 'monitors': {}, 'rules': {}}
+        for name in pool_names:
+            if name in pools:
+                snapshot['pools'][name] = pools[name]
+        for name in monitor_names:
+            if name in monitors:
+                snapshot['monitors'][name] = monitors[name]
+        for name in rule_names:
+            if self.inventory.key(name) in self.irule.deployed_text:
+                snapshot['rules'][name] = self.irule.deployed_text[self.inventory.key(name)]
+        return snapshot
+
+    def restore(self, snapshot):
+        """Take the state of the f5 from a snapshot, and stop the checks asking the f5 anything"""
+
+        self.inventory.pools = set([self.inventory.key(name) for name in snapshot['pools']])
+        self.inventory.monitors = {}
+        for name, state in snapshot['monitors'].items():
+            self.inventory.monitors[self.inventory.key(name)] = intern(str(state['type']))
+        self.inventory.rules = set([self.inventory.key(name) for name in snapshot['rules']])
+        self.conn.bigip_version = str(snapshot['version'])
+
+        self.pool.state = copy.deepcopy(snapshot['pools'])
+        self.monitor.state = copy.deepcopy(snapshot['monitors'])
+        self.irule.deployed = {}
+        self.irule.deployed_text = {}
+        for name, text in snapshot['rules'].items():
+            self.irule.deployed[self.inventory.key(name)] = rule_digest(text)
+            self.irule.deployed_text[self.inventory.key(name)] = text
+
+        self.pool.offline = True
+        self.monitor.offline = True
+        self.irule.offline = True
+
+def snapshot_digest(snapshot):
+    """sha1 of a snapshot, to tell if the f5 has changed since it was taken"""
+
+    return hashlib.sha1(json.dumps(snapshot, sort_keys=True)).hexdigest()
+
+# The settings that change what gets built from the files, rather than how it's deployed
+BUILD_SETTINGS = [('LoadBalancer', 'partition'), ('Pool', 'lbmeth'), ('Monitor', 'interval'),
+                  ('Monitor', 'timeout'), ('Monitor', 'addresstype'), ('Monitor', 'address'),
+                  ('Monitor', 'port'), ('Irule', 'compile'), ('Irule', 'profile'), ('Resolver', 'hosts')]
+
+class DeployRecord:
+    """Digests of the files as they were at the last successful deploy to the f5,
+    so the next deploy only has to look at the ones that have changed since"""
+
+    config_file = 'f5.cfg'
+
+    def __init__(self):
+        """Read the record for the configured f5"""
+
+        config = ConfigParser.ConfigParser()
+        config.read(self.config_file)
+
+        self.record_file = config_option(config, 'Deploy', 'record', '')
+        self.hostname = config_option(config, 'LoadBalancer', 'hostname', '')
+        self.settings = self.settings_digest(config)
+
+        # {hostname: {'settings': digest, 'stages': {stage: {file: digest}}}}
+        self.records = {}
+        if self.record_file and os.path.isfile(self.record_file):
+            try:
+                record_file = open(self.record_file, 'r')
+                self.records = json.load(record_file)
+                record_file.close()
+            except (IOError, ValueError):
+                # A broken record just means checking everything again
+                self.records = {}
+
+    def settings_digest(self, config):
+        """sha1 of the build settings, and of the hosts and profile files they name"""
+
+        settings = []
+        for section, name in BUILD_SETTINGS:
+            value = config_option(config, section, name, '')
+            settings.append('%s.%s=%s' % (section, name, value))
+            if name in ('hosts', 'profile') and value and os.path.isfile(value):
+                settings.append(hashlib.sha1(open(value, 'rb').read()).hexdigest())
+        return hashlib.sha1('\n'.join(settings)).hexdigest()
+
+    def stages(self):
+        """The recorded stages for this f5, empty if the build settings have changed since"""
+
+        record = self.records.get(self.hostname)
+        if record is None or record.get('settings') != self.settings:
+            return {}
+        return record['stages']
+
+    def changed(self, stage, digests):
+        """The files of a stage that have been changed, added or removed since the last
+        deploy, or None if there's no record of it and everything has to be checked"""
+
+        recorded = self.stages().get(stage)
+        if not self.record_file or recorded is None:
+            return None
+
+        changed = []
+        for infile in sorted(set(digests.keys()) | set(recorded.keys())):
+            if digests.get(infile) != recorded.get(infile):
+                changed.append(str(infile))
+        return changed
+
+    def save(self, stage_digests):
+        """Record the files of the stages just deployed, {stage: {file: digest}}"""
+
+        if not self.record_file:
+            return
+
+        stages = self.stages()
+        stages.update(stage_digests)
+        self.records[self.hostname] = {'settings': self.settings, 'stages': stages}
+
+        scratch = self.record_file + '.tmp'
+        record_file = open(scratch, 'w')
+        json.dump(self.records, record_file, indent=1, sort_keys=True, separators=(',', ': '))
+        record_file.close()
+        os.rename(scratch, self.record_file)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python26
+"""Tests for f5lint, run from a corpus of rule and switch case fragments
+
+    ./test_f5lint.py
+"""
+
+import unittest
+import f5lint
+
+# (description, text, [(line, message)]) for whole rules, linted with f5lint.lint
+RULES = [
+    ('braces balanced inside a comment',
+     'when HTTP_REQUEST {\n'
+     '  # pick a pool {by host}\n'
+     '  pool foo_pool\n'
+     '}\n',
+     []),
+    ('open brace in a comment still counts',
+     'when HTTP_REQUEST {\n'
+     '  # a stray { here\n'
+     '  pool foo_pool\n'
+     '}\n',
+     [(1, 'missing close-brace'), (4, 'unmatched close-brace')]),
+    ('close brace in a comment ends the body',
+     'when HTTP_REQUEST {\n'
+     '  # closing } early\n'
+     '  pool foo_pool\n'
+     '}\n',
+     [(2, 'close-brace in a comment ends the enclosing braces'), (4, 'unmatched close-brace')]),
+    ('braces balanced inside a string',
+     'when HTTP_REQUEST {\n'
+     '  log local0. "host {[HTTP::host]}"\n'
+     '}\n',
+     []),
+    ('close brace inside a string ends the body',
+     'when HTTP_REQUEST {\n'
+     '  log local0. "a } in a string"\n'
+     '}\n',
+     [(3, 'unmatched close-brace')]),
+    ('string never closed',
+     'when HTTP_REQUEST {\n'
+     '  pool "foo_pool\n'
+     '}\n',
+     [(2, 'missing "')]),
+    ('else straight after a close brace',
+     'when HTTP_REQUEST {\n'
+     '  if { [HTTP::host] eq "a" } {\n'
+     '    pool a_pool\n'
+     '  }{\n'
+     '    pool b_pool\n'
+     '  }\n'
+     '}\n',
+     []),
+    ('extra characters after a close brace',
+     'when HTTP_REQUEST {\n'
+     '  if { 1 }x {\n'
+     '    pool a_pool\n'
+     '  }\n'
+     '}\n',
+     [(2, 'extra characters after close-brace')]),
+    ('elseif and else on new lines',
+     'when HTTP_REQUEST {\n'
+     '  if { [HTTP::host] eq "a" } {\n'
+     '    pool a_pool\n'
+     '  }\n'
+     '  elseif { [HTTP::host] eq "b" } {\n'
+     '    pool b_pool\n'
+     '  }\n'
+     '  else {\n'
+     '    pool c_pool\n'
+     '  }\n'
+     '}\n',
+     []),
+    ('elseif on a new line without an if',
+     'when HTTP_REQUEST {\n'
+     '  pool a_pool\n'
+     '  elseif { 1 } {\n'
+     '    pool b_pool\n'
+     '  }\n'
+     '}\n',
+     [(3, 'elseif without a preceding if')]),
+    ('switch with pattern and body pairs',
+     'when HTTP_REQUEST {\n'
+     '  switch -glob [HTTP::host] {\n'
+     '    "a.example.com" -\n'
+     '    "b.example.com" { pool a_pool }\n'
+     '    default { pool b_pool }\n'
+     '  }\n'
+     '}\n',
+     []),
+    ('switch with an odd number of items',
+     'when HTTP_REQUEST {\n'
+     '  switch -glob [HTTP::host] {\n'
+     '    "a.example.com" { pool a_pool }\n'
+     '    "b.example.com"\n'
+     '  }\n'
+     '}\n',
+     [(4, 'extra switch pattern with no body')]),
+    ('switch with no string',
+     'when HTTP_REQUEST {\n'
+     '  switch -glob\n'
+     '}\n',
+     [(2, 'switch has no string to match')]),
+    ('missing close bracket',
+     'when HTTP_REQUEST {\n'
+     '  set host [string tolower [HTTP::host]\n'
+     '  pool a_pool\n'
+     '}\n',
+     [(2, 'missing close-bracket')]),
+    ('missing close brace at the end',
+     'when HTTP_REQUEST {\n'
+     '  pool a_pool\n',
+     [(1, 'missing close-brace')]),
+    ('unbalanced paren in an expression',
+     'when HTTP_REQUEST {\n'
+     '  if { ([HTTP::host] eq "a" } {\n'
+     '    pool a_pool\n'
+     '  }\n'
+     '}\n',
+     [(2, 'missing close paren in expression')]),
+]
+
+# The same for files of switch cases as kept under irules/, linted with f5lint.lint_cases
+CASES = [
+    ('cases sharing a body',
+     '"a.example.com" -\n'
+     '"b.example.com" {\n'
+     '  pool a_pool\n'
+     '}\n',
+     []),
+    ('pattern with no body',
+     '"a.example.com" {\n'
+     '  pool a_pool\n'
+     '}\n'
+     '"b.example.com"\n',
+     [(4, 'extra switch pattern with no body')]),
+    ('last pattern falls through to nothing',
+     '"a.example.com" -\n',
+     [(1, 'no body specified for last pattern')]),
+    ('comment between cases',
+     '# the a site\n'
+     '"a.example.com" {\n'
+     '  pool a_pool\n'
+     '}\n',
+     [(1, 'comments between switch cases are taken as patterns')]),
+    ('missing close bracket in a body',
+     '"a.example.com" {\n'
+     '  pool [string tolower a_pool\n'
+     '}\n',
+     [(2, 'missing close-bracket')]),
+    ('close brace in a comment in a body',
+     '"a.example.com" {\n'
+     '  # } oops\n'
+     '  pool a_pool\n'
+     '}\n',
+     [(2, 'close-brace in a comment ends the enclosing braces'), (4, 'unmatched close-brace'),
+      (3, 'extra switch pattern with no body')]),
+]
+
+
+class CorpusTest(unittest.TestCase):
+    """Every fragment gives exactly the errors listed for it"""
+
+    def check(self, lint, corpus):
+        for description, text, expected in corpus:
+            errors = [(line, message) for filename, line, message in lint(text, 'fragment.conf')]
+            self.assertEqual(errors, expected, '%s: %r' % (description, errors))
+
+    def test_rules(self):
+        self.check(f5lint.lint, RULES)
+
+    def test_cases(self):
+        self.check(f5lint.lint_cases, CASES)
+
+    def test_filename_and_first_line(self):
+        errors = f5lint.lint_cases('"a.example.com"\n', 'irules/http/a.conf', 10)
+        self.assertEqual(errors, [('irules/http/a.conf', 10, 'extra switch pattern with no body')])
+
+
+if __name__ == "__main__":
+    unittest.main()
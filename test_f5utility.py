@@ -0,0 +1,351 @@
+#!/usr/bin/env python26
+"""Tests for the parts of f5utility that don't need an f5
+
+    ./test_f5utility.py
+"""
+
+import ConfigParser
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+import suds
+import f5utility
+import f5deploy
+import f5irule_deploy
+import f5rulestats
+
+
+def counters(executions, avg, failures=0, aborts=0):
+    """One event's statistics, as parse_rule_statistics gives them"""
+
+    return {'http_rule': {'HTTP_REQUEST': {'min': 100, 'avg': avg, 'max': 1000, 'executions': executions,
+                                           'failures': failures, 'aborts': aborts}}}
+
+
+class CompareRuleStatisticsTest(unittest.TestCase):
+    """compare_rule_statistics works out the averages since the first snapshot"""
+
+    def test_cumulative(self):
+        # 1000 runs at 500, then 1000 more at 300
+        rows = f5utility.compare_rule_statistics(counters(1000, 500, 1), counters(2000, 400, 3))
+        self.assertEqual(rows, [('http_rule', 'HTTP_REQUEST', 1000, 500, 300, 2, 0)])
+
+    def test_counters_gone_backwards(self):
+        rows = f5utility.compare_rule_statistics(counters(1000, 500), counters(200, 450))
+        self.assertEqual(rows, [('http_rule', 'HTTP_REQUEST', 200, 500, 450, 0, 0)])
+
+    def test_reset_by_deploy(self):
+        # The new rule has already run more often than the old one had, all of it since the deploy
+        rows = f5utility.compare_rule_statistics(counters(1000, 500, 4), counters(2000, 400, 1),
+                                                  reset=['http_rule'])
+        self.assertEqual(rows, [('http_rule', 'HTTP_REQUEST', 2000, 500, 400, 1, 0)])
+
+    def test_no_earlier_snapshot(self):
+        rows = f5utility.compare_rule_statistics({}, counters(10, 400))
+        self.assertEqual(rows, [('http_rule', 'HTTP_REQUEST', 10, None, 400, 0, 0)])
+
+
+class Connection:
+    """Just enough of an f5Connection for a stage to run in"""
+
+    def __init__(self):
+        self.tracer = f5utility.Tracer(ConfigParser.ConfigParser())
+
+
+class StageTest(unittest.TestCase):
+    """stage() runs the function in a span and passes every argument on"""
+
+    def test_arguments(self):
+        @f5utility.stage('check things')
+        def check(f5, queue, only=None):
+            """Check some things"""
+            return queue, only
+
+        f5 = Connection()
+        self.assertEqual(check(f5, [1]), ([1], None))
+        self.assertEqual(check(f5, [1], only=set(['a'])), ([1], set(['a'])))
+        self.assertEqual(check(f5, queue=[2]), ([2], None))
+        self.assertEqual(check.__doc__, 'Check some things')
+        self.assertEqual(f5.tracer.current(), None)
+
+
+class Bag:
+    """An object with whatever attributes it's given, like the ones suds builds"""
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class Rules:
+    """Stands in for LocalLB.Rule, replacing a rule zeroes its counters as on the f5"""
+
+    def __init__(self, executions):
+        self.executions = executions
+        self.fail = None
+
+    def get_list(self):
+        return ['/Common/' + rule for rule in sorted(self.executions)]
+
+    def get_statistics(self, rule_names):
+        entries = []
+        for rule in rule_names:
+            values = [('STATISTIC_RULE_AVERAGE_CYCLES', 500), ('STATISTIC_RULE_TOTAL_EXECUTIONS', self.executions[rule])]
+            entries.append(Bag(rule_name=rule, event_name='HTTP_REQUEST',
+                               statistics=[Bag(type=name, value=Bag(high=0, low=value)) for name, value in values]))
+        return Bag(statistics=entries)
+
+    def modify_rule(self, rules):
+        if rules[0].rule_name == self.fail:
+            raise suds.WebFault('syntax error', None)
+        self.executions[rules[0].rule_name] = 0
+
+
+class Session:
+    """Stands in for System.Session"""
+
+    def start_transaction(self):
+        pass
+
+    def submit_transaction(self):
+        pass
+
+    def rollback_transaction(self):
+        pass
+
+
+class Deployment(Connection):
+    """Just enough of an f5Connection for f5irule_deploy.commit and f5rulestats.main"""
+
+    def __init__(self, rules):
+        Connection.__init__(self)
+        self.rules = rules
+        conn = Bag(LocalLB=Bag(Rule=rules), System=Bag(Session=Session()))
+        self.inventory = f5utility.Inventory(conn)
+        self.irule = Bag(rule=rules, push_hosts=lambda dirs: False, uploaded=lambda r_def: None)
+        self.rule_stats = f5utility.RuleStats(conn)
+        self.transaction = f5utility.Transaction(conn, True)
+
+
+class RuleStatsDeployTest(unittest.TestCase):
+    """A deploy snapshots every rule it replaces, once they're in, and the report compares with that"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tree = tempfile.mkdtemp()
+        os.chdir(self.tree)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.f5 = Deployment(Rules({'http_rule': 1000, 'ssl_rule': 200}))
+        self.queue = [(dirs, Bag(rule_name=dirs + '_rule', rule_definition='')) for dirs in ('http', 'ssl')]
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tree)
+
+    def report(self, args):
+        """Run f5rulestats.py over the stub f5, returns the rows it reports"""
+
+        rows = []
+        connection, report, argv = f5utility.f5Connection, f5rulestats.report, sys.argv
+        f5utility.f5Connection = lambda: self.f5
+        f5rulestats.report = lambda compared, since: rows.extend(compared)
+        sys.argv = ['f5rulestats.py'] + args
+        try:
+            f5rulestats.main()
+        finally:
+            f5utility.f5Connection, f5rulestats.report, sys.argv = connection, report, argv
+        return rows
+
+    def test_two_rules(self):
+        self.f5.rule_stats.record(['http_rule'], 'report')
+        self.assertEqual(self.f5.transaction.apply(f5irule_deploy.commit, self.f5, self.queue), True)
+
+        history = self.f5.rule_stats.history('deploy')
+        self.assertEqual(len(history), 1)
+        self.assertEqual(sorted(history[0]['rules']), ['http_rule', 'ssl_rule'])
+
+        # Both rules have run since, fewer times than the old ones had
+        self.f5.rules.executions.update({'http_rule': 30, 'ssl_rule': 20})
+        self.assertEqual(self.report(['http_rule', 'ssl_rule']),
+                         [('http_rule', 'HTTP_REQUEST', 30, 500, 500, 0, 0),
+                          ('ssl_rule', 'HTTP_REQUEST', 20, 500, 500, 0, 0)])
+
+    def test_rolled_back(self):
+        self.f5.rules.fail = 'ssl_rule'
+        self.assertRaises(SystemExit, self.f5.transaction.apply, f5irule_deploy.commit, self.f5, self.queue)
+        self.assertEqual(self.f5.rule_stats.history(), [])
+
+
+class InTree(unittest.TestCase):
+    """Runs each test in an empty directory of its own"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tree = tempfile.mkdtemp()
+        os.chdir(self.tree)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tree)
+
+    def write(self, name, text):
+        out = open(name, 'w')
+        out.write(text)
+        out.close()
+
+    def configure(self, record='.f5deployed', lbmeth='LB_METHOD_ROUND_ROBIN'):
+        self.write('f5.cfg', '[LoadBalancer]\nhostname=lb1\n\n[Deploy]\nrecord=%s\n\n'
+                             '[Pool]\nlbmeth=%s\n\n[Resolver]\nhosts=hosts\n' % (record, lbmeth))
+
+
+class DeployRecordTest(InTree):
+    """DeployRecord remembers the files as they were deployed, and forgets them when it can't be trusted"""
+
+    def setUp(self):
+        InTree.setUp(self)
+        self.configure()
+        self.write('hosts', '10.0.0.1 a.example.com\n')
+        self.pools = {'pools/a_pool': 'a1', 'pools/b_pool': 'b1'}
+
+    def test_changed(self):
+        f5utility.DeployRecord().save({'pools': self.pools})
+        record = f5utility.DeployRecord()
+        self.assertEqual(record.changed('pools', self.pools), [])
+        self.assertEqual(record.changed('pools', {'pools/a_pool': 'a2', 'pools/c_pool': 'c1'}),
+                         ['pools/a_pool', 'pools/b_pool', 'pools/c_pool'])
+        self.assertEqual(record.changed('irules', {}), None)
+
+    def test_missing_record(self):
+        self.assertEqual(f5utility.DeployRecord().changed('pools', self.pools), None)
+
+    def test_corrupt_record(self):
+        self.write('.f5deployed', '{"lb1": {"settings"')
+        self.assertEqual(f5utility.DeployRecord().changed('pools', self.pools), None)
+
+    def test_no_record(self):
+        self.configure(record='')
+        f5utility.DeployRecord().save({'pools': self.pools})
+        self.assertEqual(os.path.exists('.f5deployed'), False)
+        self.assertEqual(f5utility.DeployRecord().changed('pools', self.pools), None)
+
+    def test_build_settings_changed(self):
+        f5utility.DeployRecord().save({'pools': self.pools})
+        self.configure(lbmeth='LB_METHOD_LEAST_CONNECTION_MEMBER')
+        self.assertEqual(f5utility.DeployRecord().changed('pools', self.pools), None)
+
+    def test_hosts_changed(self):
+        f5utility.DeployRecord().save({'pools': self.pools})
+        self.write('hosts', '10.0.0.2 a.example.com\n')
+        self.assertEqual(f5utility.DeployRecord().changed('pools', self.pools), None)
+
+    def test_save_merges_stages(self):
+        f5utility.DeployRecord().save({'pools': self.pools, 'irules': {'irules/http/a.conf': 'h1'}})
+        f5utility.DeployRecord().save({'pools': {'pools/a_pool': 'a2'}})
+        self.assertEqual(f5utility.DeployRecord().stages(), {'pools': {'pools/a_pool': 'a2'},
+                                                             'irules': {'irules/http/a.conf': 'h1'}})
+
+
+class ScopeTest(InTree):
+    """f5deploy.scope turns the changed files into the objects to check"""
+
+    def setUp(self):
+        InTree.setUp(self)
+        self.configure()
+        os.mkdir('pools')
+        self.write('pools/a_pool', 'a')
+        self.write('pools/b_pool', 'b')
+        f5utility.DeployRecord().save({'pools': {'pools/a_pool': 'a1', 'pools/b_pool': 'b1', 'pools/gone_pool': 'g1'}})
+        self.digests = {'pools': {'pools/a_pool': 'a2', 'pools/b_pool': 'b1'}}
+
+    def test_removed_files_dropped(self):
+        self.assertEqual(f5deploy.scope(f5utility.DeployRecord(), self.digests, False), {'pools': set(['a_pool'])})
+
+    def test_full(self):
+        self.assertEqual(f5deploy.scope(f5utility.DeployRecord(), self.digests, True), {'pools': None})
+
+
+def taken_snapshot(members):
+    """A snapshot as f5Connection.take_snapshot gives it"""
+
+    return {'version': 'BIG-IP_v11.6.0',
+            'pools': {'a_pool': {'method': 'LB_METHOD_ROUND_ROBIN', 'members': members,
+                                 'monitors': ['/Common/a_health']}},
+            'monitors': {'a_health': {'type': 'TTYPE_HTTP', 'interval': 5L, 'timeout': 16L,
+                                      'send': 'GET / HTTP/1.0\\r\\n\\r\\n', 'receive': '200 OK',
+                                      'username': None, 'password': None}},
+            'rules': {'http_rule': 'when HTTP_REQUEST {\n  pool a_pool\n}\n'}}
+
+
+class SnapshotDigestTest(unittest.TestCase):
+    """snapshot_digest gives the same digest for the same f5, however the snapshot got here"""
+
+    def test_key_order(self):
+        snapshot = taken_snapshot(['10.0.0.1:80'])
+        reordered = dict(reversed(sorted(snapshot.items())))
+        reordered['monitors'] = {'a_health': dict(reversed(sorted(snapshot['monitors']['a_health'].items())))}
+        self.assertEqual(f5utility.snapshot_digest(reordered), f5utility.snapshot_digest(snapshot))
+
+    def test_json_round_trip(self):
+        snapshot = taken_snapshot(['10.0.0.1:80'])
+        saved = json.loads(json.dumps(snapshot, indent=1, sort_keys=True))
+        self.assertEqual(f5utility.snapshot_digest(saved), f5utility.snapshot_digest(snapshot))
+
+    def test_changed(self):
+        self.assertNotEqual(f5utility.snapshot_digest(taken_snapshot(['10.0.0.1:80'])),
+                            f5utility.snapshot_digest(taken_snapshot(['10.0.0.2:80'])))
+
+
+class ApplyTest(InTree):
+    """f5deploy.apply refuses a plan the files or the f5 have moved on from"""
+
+    def setUp(self):
+        InTree.setUp(self)
+        self.configure()
+        os.mkdir('pools')
+        self.write('pools/a_pool', 'members=10.0.0.1:80\n')
+        self.write('.f5plan', json.dumps({'stages': ['pools'],
+                                          'snapshot': taken_snapshot(['10.0.0.1:80']),
+                                          'digest': f5utility.snapshot_digest(taken_snapshot(['10.0.0.1:80'])),
+                                          'sources': f5deploy.source_digests(f5deploy.tree_digests(['pools'])),
+                                          'changes': {'pools': ['~ a_pool']}}))
+        self.connected = []
+        self.saved = f5utility.f5Connection, f5deploy.snapshot, sys.argv
+        f5utility.f5Connection = lambda: self.connected.append(True) or Connection()
+        sys.argv = ['./f5deploy.py', 'apply']
+
+    def tearDown(self):
+        f5utility.f5Connection, f5deploy.snapshot, sys.argv = self.saved
+        InTree.tearDown(self)
+
+    def refused(self):
+        """The message apply exits with"""
+
+        try:
+            f5deploy.apply()
+        except SystemExit, exit:
+            return exit.code
+        self.fail('apply went ahead')
+
+    def test_source_changed(self):
+        self.write('pools/a_pool', 'members=10.0.0.2:80\n')
+        self.assertEqual(self.refused(), 'Files have changed since the plan was made, run ./f5deploy.py plan again')
+        self.assertEqual(self.connected, [])
+
+    def test_source_added(self):
+        self.write('pools/b_pool', 'members=10.0.0.2:80\n')
+        self.assertEqual(self.refused(), 'Files have changed since the plan was made, run ./f5deploy.py plan again')
+
+    def test_snapshot_changed(self):
+        f5deploy.snapshot = lambda f5, stages: taken_snapshot(['10.0.0.2:80'])
+        self.assertEqual(self.refused(), 'The f5 has changed since the plan was made, run ./f5deploy.py plan again')
+        self.assertEqual(self.connected, [True])
+        self.assertEqual(os.path.exists('.f5plan'), True)
+
+
+if __name__ == "__main__":
+    unittest.main()